@@ -64,6 +64,15 @@ fi
 pushd "${FW_DIR}"
 flake8 --max-line-length 100 --ignore=Q000 --ignore=W504 --exclude=manifest.py
 micropython -c "import unittest;unittest.main('smoke_test')"
+# Fails on a regression against fw/bench_baseline.txt. Until one is committed (store it
+# with micropython bench.py --baseline bench_baseline.txt --update on the unix port) the
+# results are only recorded.
+if [ -f bench_baseline.txt ]; then
+  micropython bench.py --baseline bench_baseline.txt --out ../bench_output.txt
+else
+  echo "No fw/bench_baseline.txt, skipping the bench regression gate."
+  micropython bench.py --out ../bench_output.txt
+fi
 popd
 pushd "${MP_ROOT}/ports/esp32"
 if [ ! -d "esp-idf" ]; then
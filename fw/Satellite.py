@@ -1,4 +1,65 @@
+import time
 import uasyncio
+from micropython import const
+from nmea import NMEACodec, checksum
+from modem_msgs import Dispatcher, MMMsg, RDMsg, TDMsg, TimeMsg
+import governor
+import log
+import metrics
+
+_log = log.logger("sat")
+_M_LINES = metrics.counter("sat.lines")
+_M_BAD_LINES = metrics.counter("sat.bad_lines")
+_M_EXPECT_RETRIES = metrics.counter("sat.expect_retries")
+_M_EXPECT_FAILS = metrics.counter("sat.expect_fails")
+_H_EXPECT = metrics.histogram("sat.expect_ms")
+# ms since reset when the modem finished booting.
+_G_BOOT_MS = metrics.gauge("sat.boot_ms")
+_H_LOCK_WAIT = metrics.histogram("sat.lock_wait_ms")
+_H_LOCK_HOLD = metrics.histogram("sat.lock_hold_ms")
+
+# Max $MM R= reads in flight while draining the inbox.
+_DRAIN_WINDOW = const(8)
+
+
+# $MM errors only a command naming a msg id (R=, D=, M=) can get, never a C= count.
+_MM_ID_ERRORS = ("$MM ERR,DBXNOMORE", "$MM ERR,DBXINVMSGID")
+
+
+def _mm_count(line: str) -> bool:
+    """A $MM C= reply (a bare count) or an error a count can get, not another $MM
+    command's reply or a msg id error meant for an R= in flight with it."""
+    if line.startswith("$MM ERR"):
+        return not line.startswith(_MM_ID_ERRORS)
+    return line.startswith("$MM ") and line[4:].isdigit()
+
+
+def _mm_read(line: str) -> bool:
+    """A $MM R= reply (or error), anything $MM but a count or the other commands' replies."""
+    return line.startswith("$MM ") and not line[4:].isdigit() and \
+        not line.startswith("$MM OK") and not line.startswith("$MM DELETED") and \
+        not line.startswith("$MM MARKED")
+
+
+class _Pending():
+    """A command waiting for a response line starting with one of prefixes, or for
+    which prefixes (a callable) returns True."""
+    __slots__ = ("prefixes", "line", "event")
+
+    def __init__(self, prefixes):
+        if isinstance(prefixes, str):
+            prefixes = (prefixes,)
+        self.prefixes = prefixes
+        self.line = None
+        self.event = uasyncio.Event()
+
+    def matches(self, line: str) -> bool:
+        if callable(self.prefixes):
+            return self.prefixes(line)
+        for prefix in self.prefixes:
+            if line.startswith(prefix):
+                return True
+        return False
 
 
 class Satellite():
@@ -18,7 +79,10 @@ class Satellite():
                  client_ready=None,
                  max_retries=-1,
                  myconn=None,
-                 delay=30):
+                 delay=30,
+                 delete_on_read=True,
+                 expect_timeout=30.0,
+                 passes=None):
         """Initialize a connection to the satelite modem. Allows setting myconn for testing.
         uart_id is the ID of the uart controller to use
         new_msg_callback should take app_id (str) and data (str, base64 encoded)
@@ -32,9 +96,22 @@ class Satellite():
         ready_callback is a callback to indicate the modem can receive msgs
         client_ready is a ThreadSafeFlag of when the client is ready.
         max_retries the number of retries at each level of retrying.
+        delete_on_read deletes msgs from the modem once delivered, turn it off when
+        new_msg_callback only stores them & call clear_delivered later.
+        expect_timeout is how long (seconds) send_expect waits for each response.
+        passes is a PassPredictor to feed with the modem's clock, satellites heard ($RT)
+        and acks ($TD SENT).
         """
-        print(f"Constructing connection to M138 w/ uart {uart_id} on {uart_tx} + {uart_rx}")
-        self.lock = uasyncio.Lock()
+        _log.info("Constructing connection to M138 w/ uart %s on %s + %s",
+                  uart_id, uart_tx, uart_rx)
+        # Only needed for raw access to the uart, commands are demuxed by the reader.
+        self.lock = metrics.TimedLock(_H_LOCK_WAIT, _H_LOCK_HOLD)
+        # Commands sent and waiting on a response, oldest first.
+        self._pending = []
+        self.reader_task = None
+        self.client_task = None
+        # Shared framing buffers, avoids per line allocations.
+        self.codec = NMEACodec()
         try:
             if myconn is None:
                 from machine import UART
@@ -42,8 +119,8 @@ class Satellite():
             else:
                 self.conn = myconn
         except Exception as e:
-            print(f"Error creating uart {e}")
-        print(f"Using uart {self.conn}")
+            _log.error("Error creating uart %s", e)
+        _log.debug("Using uart %s", self.conn)
         self.modem_started = False
         self.new_msg_callback = new_msg_callback
         self.msg_acked_callback = msg_acked_callback
@@ -55,18 +132,37 @@ class Satellite():
         self.client_ready = client_ready
         self._device_id = None
         self._prob_device_id = None
+        # The modem's firmware, from $FV in device_id.
+        self.firmware_version = None
         self.transmit_ready = False
         self.misc_callback = misc_callback
         self.delay = delay
+        self.delete_on_read = delete_on_read
+        self.expect_timeout = expect_timeout
+        self.passes = passes
+        self.msg_watch = False
         self.tx_pin = tx_pin
+        self.rx_pin = rx_pin
+        # Cleared while the modem sleeps ($SL), set again by its $SL WAKE.
+        self.awake = True
+        self.wake_reason = None
         self.txing_callback = txing_callback
         self.done_txing_callback = done_txing_callback
-        print("Initilizing UART.")
+        self.last_datetime = None
+        # Unsolicited msg handlers, other modules may register more with register_handler.
+        self.dispatcher = Dispatcher()
+        self.dispatcher.register("M138", self._on_m138)
+        self.dispatcher.register("DT", self._on_dt, TimeMsg)
+        self.dispatcher.register("RD", self._on_rd, RDMsg)
+        self.dispatcher.register("RT", self._on_rt, TimeMsg)
+        self.dispatcher.register("SL", self._on_sl)
+        self.dispatcher.register("TD", self._on_td, TDMsg)
+        _log.debug("Initilizing UART.")
         try:
             self.conn.init(baudrate=115200, tx=uart_tx, rx=uart_rx)
         except Exception as e:
-            print(f"Error initializing uart {e}")
-        print("Initialized, making stream r/w.")
+            _log.error("Error initializing uart %s", e)
+        _log.debug("Initialized, making stream r/w.")
         if myconn is None:
             self.swriter = uasyncio.StreamWriter(self.conn, {})
         else:
@@ -75,7 +171,7 @@ class Satellite():
             self.sreader = uasyncio.StreamReader(self.conn)
         else:
             self.sreader = myconn
-        print("Streams set up")
+        _log.debug("Streams set up")
 
     def start(self):
         try:
@@ -86,185 +182,237 @@ class Satellite():
                 pin.irq(trigger=Pin.IRQ_RISING, handler=self.txing_callback)
                 pin.irq(trigger=Pin.IRQ_FALLING, handler=self.done_txing_callback)
         except Exception as e:
-            print(f"Error {e} trying to register TXING callback.")
+            _log.error("Error %s trying to register TXING callback.", e)
 
-        print("Seting up satelite msg handler...")
+        _log.debug("Seting up satelite msg handler...")
         self.satelite_task = uasyncio.create_task(self.main_loop())
-        print(f"Task created for msg handles - {self.satelite_task}")
+        _log.debug("Task created for msg handles - %s", self.satelite_task)
 
     async def main_loop(self):
-        print("Waiting for satelite modem to boot, plz say hi soon!")
+        _log.debug("Waiting for satelite modem to boot, plz say hi soon!")
         async with self.lock:
-            print("Modem locked until ready.")
+            _log.debug("Modem locked until ready.")
+            # Each check waits for the next boot line, so there's no need to sleep here.
             while not await self._modem_ready():
-                print("Yielding...")
-                await uasyncio.sleep(1)
+                _log.debug("Still booting...")
         retries = 0
-        print("Sat modem started, entering main loop.")
+        metrics.set_gauge(_G_BOOT_MS, time.ticks_ms())
+        _log.info("Sat modem started, entering main loop.")
+        # From here on this task is the only reader of the uart.
+        self.reader_task = uasyncio.current_task()
+        self.client_task = uasyncio.create_task(self._client_loop())
         while self.max_retries == -1 or retries < self.max_retries:
-            print("Waiting for phone client to become ready...")
-            # Temporary: Disable phone check.
+            try:
+                await self._read_line()
+            # Error reading a msg from the satelite modem.
+            except Exception as e:
+                # If we encounter an error validate that the client is still connected
+                self.ready = False
+                _log.error("Error in main loop %s", e)
+                await uasyncio.sleep(self.delay * retries)
+                retries = retries + 1
+                _log.debug("Retries in main sat loop is now %s", retries)
+        self.reader_task = None
+        _log.info("Finishing main satelite loop with %s retries", retries)
+
+    async def _client_loop(self):
+        """Each time the phone client becomes ready flush the inbox & enable msg watch."""
+        while True:
+            _log.debug("Waiting for phone client to become ready...")
             await self.client_ready.wait()
-            print("Phone client ready!")
+            _log.info("Phone client ready!")
+            # Commands would wake a sleeping modem but the first one would be lost.
+            await self.wake()
             self.ready = True
             if self.ready_callback is not None:
                 self.ready_callback()
             try:
-                print("ready callback done.")
                 await self.read_all_msgs()
-                print("all queued msgs read.")
+                _log.debug("all queued msgs read.")
                 await self._enable_msg_watch()
-                print("msg watch enabled.")
-                print(f"Yeee-haw {retries} in.")
-                await uasyncio.sleep(self.delay)
-                line = None
-                line_retries = 0
-                # Seperate out reading from the satelite it's self
-                while line is None and line_retries < 3:
-                    try:
-                        line = await self.sreader.readline()
-                    except Exception as e:
-                        print(f"Error reading from satelite device... {e} attempt {line_retries}")
-                        line_retries = line_retries + 1
-                        await uasyncio.sleep(self.delay * line_retries)
-                        if line_retries >= 2:
-                            print(f"Re-raising error {e}")
-                            raise e
-                await self._line_handle(line)
-                await uasyncio.sleep(1)
-            # Error processing a msg from the satelite modem.
+                _log.debug("msg watch enabled.")
+                # Msgs which arrived during the drain weren't pushed and clear_delivered
+                # would mark them read, so read them now. One arriving right as watch came
+                # on may be delivered twice, never lost.
+                await self.read_all_msgs()
             except Exception as e:
-                # If we encounter an error validate that the client is still connected
+                _log.error("Error %s setting up client, disabling msg watch.", e)
                 self.ready = False
-                print(f"Error in main loop {e}")
                 await self._disable_msg_watch()
-                await uasyncio.sleep(self.delay * retries)
-                retries = retries + 1
-                print(f"Retries in main sat loop is now {retries}")
-        print(f"Finishing main satelite loop with {retries} retries")
+
+    async def _read_line(self):
+        """Read one line, handing it to the waiting command or the dispatcher."""
+        raw_msg = await self.sreader.readline()
+        # Parse (and handle whatever follows) at full speed.
+        governor.busy()
+        msg = self._validate_msg(raw_msg)
+        if msg is None:
+            _log.warn("Invalid msg %s", raw_msg)
+            return
+        if self._route(msg):
+            return
+        try:
+            await self._line_handle_validated(msg)
+        except Exception as e:
+            # A broken handler shouldn't take down the reader.
+            _log.error("Error %s handling %s", e, msg)
+
+    def _route(self, msg: str) -> bool:
+        """Complete the oldest pending command expecting msg."""
+        pending = self._pending
+        for i in range(len(pending)):
+            p = pending[i]
+            if p.matches(msg):
+                del pending[i]
+                p.line = msg
+                p.event.set()
+                return True
+        return False
 
     async def _modem_ready(self):
         """Handle messages waiting for system to boot."""
         # Note the developer docs have incorrect checksums for the boot sequence
         # so (for now) we'll support both of them.
-        print("Checking modem readiness.")
+        _log.debug("Checking modem readiness.")
         if self.modem_started:
-            print("Modem ready!")
+            _log.debug("Modem ready!")
             return True
-        print("Modem not yet ready, checking serial port.")
+        _log.debug("Modem not yet ready, checking serial port.")
         raw_message = None
         while raw_message is None:
-            print("Waiting to get a message from modem.")
-            print(f"Current conn {self.conn} reader {self.sreader}")
+            _log.debug("Waiting to get a message from modem.")
+            _log.debug("Current conn %s reader %s", self.conn, self.sreader)
             try:
                 raw_message = await uasyncio.wait_for(
                     self.sreader.readline(),
                     timeout=60.0)
                 if hasattr(raw_message, "decode"):
                     raw_message = raw_message.decode("UTF-8")
-                print(f"Read line {raw_message}")
+                if __debug__:
+                    _log.debug("Read line %s", raw_message)
             except uasyncio.TimeoutError:
-                print("Took longer than 60s for modem to boot, query modem.")
+                _log.warn("Took longer than 60s for modem to boot, query modem.")
                 await self.send_command("$CS")
             except Exception as e:
-                print(f"Error reading line during modem boot - {e} {self.conn}")
+                _log.error("Error reading line during modem boot - %s %s", e, self.conn)
                 await uasyncio.sleep(1)
         msg = self._validate_msg(raw_message)
         if raw_message == "$M138 BOOT,RUNNING*49":
-            print("Modem enabled")
+            _log.info("Modem enabled")
             self.modem_started = True
         elif raw_message == "$M138 DATETIME*35":
-            print("t e")
+            _log.debug("t e")
             return True
         elif msg is not None:
             if msg == "$M138 BOOT,RUNNING":
-                print("Modem enabled")
+                _log.info("Modem enabled")
                 self.modem_started = True
                 return True
             elif msg == "$M138 DATETIME":
-                print("t e")
+                _log.debug("t e")
                 self.modem_started = True
                 return True
             elif msg.startswith("$CS"):
-                print("Modem provided valid command, missed boot seq.")
+                _log.info("Modem provided valid command, missed boot seq.")
                 self.modem_started = True
                 return True
             elif msg.startswith("$M138 BOOT,DEVICEID,DI="):
                 _, id = msg.split("=")
                 self._prob_device_id = id
-                print(f"Modem almost ready _possible_ device id {id}")
-        print("Nope :/")
+                _log.info("Modem almost ready _possible_ device id %s", id)
+        _log.debug("Nope :/")
         return False
 
     async def _line_handle(self, raw_msg):
         msg = self._validate_msg(raw_msg)
         if msg is None:
-            print(f"Invalid msg {raw_msg}")
+            _log.warn("Invalid msg %s", raw_msg)
             return
         return await self._line_handle_validated(msg)
 
     async def _line_handle_validated(self, msg):
         """Handle post boot messages from the M138 modem."""
-        print(f"Valid msg {msg}")
-        cmd = msg.split(" ")[0][1:]
-        contents = " ".join(msg.split(" ")[1:])
-        if msg == "$M138 BOOT,RUNNING":
-            self.modem_started = True
-        elif msg == "$M138 DATETIME":
-            self.transmit_ready = True
-        elif cmd == "$DT":
-            self._update_dt(msg)
-        elif cmd == "$RD":
-            if self.new_msg_callback is not None:
-                app_id, rssi, snr, fdev, msg_data = contents.split(",")
-                # Wait until the msg call back succeeds before removing it from the modem.
-                self.new_msg_callback(int(app_id), msg_data)
-                # We don't have a msg id here, but for safety leave it to the client (phone)
-                # to explicitily call delete msgs later.
-        elif cmd == "$RT":
-            self._update_rt_time(contents)
-        elif cmd == "$TD":
-            if contents.starts_with("SENT"):
-                msg_id = contents.split(",")[-1]
-                if self.msg_acked_callback is not None:
-                    self.msg_acked_callback(msg_id)
-            elif "ERR" in contents:
-                if self.error_callback is not None:
-                    self.error_callback(msg)
-        elif self.misc_callback is not None:
+        if __debug__:
+            _log.debug("Valid msg %s", msg)
+        if self.dispatcher.dispatch(msg):
+            return
+        if self.misc_callback is not None:
             self.misc_callback(msg)
         else:
-            print(f"Unhandled msg {msg} with no misc callback.")
+            _log.warn("Unhandled msg %s with no misc callback.", msg)
+
+    def register_handler(self, cmd: str, handler, msg_cls=None):
+        """Register a handler for an unsolicited modem sentence (cmd is e.g. "GP", no $).
+        handler is called with a ModemMsg (or msg_cls) instance."""
+        if msg_cls is None:
+            self.dispatcher.register(cmd, handler)
+        else:
+            self.dispatcher.register(cmd, handler, msg_cls)
+
+    def _on_m138(self, msg):
+        contents = msg.contents
+        if contents == "BOOT,RUNNING":
+            self.modem_started = True
+        elif contents == "DATETIME":
+            self.transmit_ready = True
+
+    def _on_dt(self, msg):
+        self.last_datetime = msg.timestamp
+        if self.passes is not None:
+            self.passes.set_time(self.last_datetime)
+
+    def _on_rd(self, msg):
+        if self.new_msg_callback is not None:
+            # Wait until the msg call back succeeds before removing it from the modem.
+            self.new_msg_callback(msg.app_id, msg.data)
+            # We don't have a msg id here, but for safety leave it to the client (phone)
+            # to explicitily call delete msgs later.
+
+    def _on_rt(self, msg):
+        ts = msg.timestamp
+        if ts is not None:
+            self.last_date = ts
+            if self.passes is not None:
+                self.passes.heard(ts)
+
+    def _on_sl(self, msg):
+        contents = msg.contents
+        if contents.startswith("WAKE"):
+            self.awake = True
+            self.wake_reason = contents[5:]
+            _log.info("Modem awake (%s)", self.wake_reason)
+
+    def _on_td(self, msg):
+        status = msg.status
+        if status == "SENT":
+            if self.passes is not None:
+                self.passes.acked()
+            if self.msg_acked_callback is not None:
+                self.msg_acked_callback(msg.msg_id)
+        elif status == "ERR":
+            if self.error_callback is not None:
+                self.error_callback(msg.raw)
 
     async def _enable_msg_watch(self):
-        await self.send_command("$MM N=E")
+        await self._mm("$MM N=E", "$MM OK")
+        self.msg_watch = True
 
     async def _disable_msg_watch(self):
-        await self.send_command("$MM N=D")
-
-    def _update_rt_time(self, contents):
-        """Update the last rt time."""
-        elems = contents.split(",")
-        for e in elems:
-            if "TS" in e:
-                self.last_date = e
+        self.msg_watch = False
+        await self._mm("$MM N=D", "$MM OK")
 
     def _checksum(self, data) -> int:
         """Compute the checksum for a given message."""
+        if isinstance(data, str):
+            data = data.encode()
+        end = len(data)
         # Drop the trailing newline
-        data.strip()
-        compute_me = data
-        # Drop the leading $ if present
-        if len(compute_me) > 1 and compute_me[0] == '$':
-            compute_me = data[1:]
+        while end > 0 and (data[end - 1] == 0x0A or data[end - 1] == 0x0D):
+            end -= 1
         # Drop the trailing *xx
-        if len(compute_me) > 3 and compute_me[-3] == '*':
-            compute_me = compute_me[:-3]
-        calc_cksum = 0
-
-        for s in compute_me:
-            calc_cksum ^= ord(s)
-        return calc_cksum
+        if end > 3 and data[end - 3] == 0x2A:
+            end -= 3
+        return checksum(data, 0, end)
 
     def _checksum_formatted(self, data) -> str:
         """Format the checksum as tw digit hex"""
@@ -272,51 +420,50 @@ class Satellite():
 
     def _validate_msg(self, data):
         """Validate a msg matches the checksum."""
-        if hasattr(data, "decode"):
-            data = data.decode('UTF-8')
-        if len(data) > 1 and data[-1] == '\n':
-            data = data[0:-1]
-        # Parse the trailing *xx
-        if len(data) > 3 and data[-3] == '*':
-            cksum = data[-2:]
-            data = data[:-3]
-        else:
+        metrics.inc(_M_LINES)
+        if self.codec.frame(data) < 0:
+            metrics.inc(_M_BAD_LINES)
             return None
+        return self.codec.text()
 
-        calc_cksum = self._checksum(data)
-
-        if calc_cksum == int(cksum, 16):
-            return data
-        else:
-            return None
-
-    async def send_expect(self, command, expect_prefix, retry=4, timeout=30.0):
+    async def send_expect(self, command, expect_prefix, retry=4, timeout=None):
         """
-        Send a command, look for response of type expected_prefix.
-        Retry at most retry times with a timeout of timeout.
+        Send a command, look for response of type expected_prefix (a str or tuple of str,
+        or a callable taking the line).
+        Retry at most retry times with a timeout of timeout (default expect_timeout).
+        Responses are matched to commands in the order they were sent, so several
+        commands may be in flight at once.
         """
-        print(f"Send expect {command} {expect_prefix}")
-        await self.send_command(command)
-        line = None
-        attempt = 0
-        while ((line is None) or
-               (not line.startswith(expect_prefix))):
-            if line is not None:
-                print(f"un-expected line {line}, creatig task to handle later.")
-                uasyncio.create_task(self._line_handle_validated(line))
-                line = None
-            try:
-                line = await uasyncio.wait_for(
-                    self.sreader.readline(),
-                    timeout=timeout)
-                line = self._validate_msg(line)
-            except Exception as e:
-                print(f"Failed {e} to fetch line in {timeout}")
-                attempt = attempt + 1
-                if attempt > retry:
-                    print("Giving up")
-                    raise e
-        return line
+        if __debug__:
+            _log.debug("Send expect %s %s", command, expect_prefix)
+        if timeout is None:
+            timeout = self.expect_timeout
+        pending = _Pending(expect_prefix)
+        self._pending.append(pending)
+        start = time.ticks_ms()
+        try:
+            await self.send_command(command)
+            attempt = 0
+            while pending.line is None:
+                try:
+                    if self.reader_task is None:
+                        # Nobody else is reading (e.g. not started yet), pump the uart.
+                        await uasyncio.wait_for(self._read_line(), timeout=timeout)
+                    else:
+                        await uasyncio.wait_for(pending.event.wait(), timeout=timeout)
+                except Exception as e:
+                    _log.error("Failed %s to fetch line in %s", e, timeout)
+                    attempt = attempt + 1
+                    if attempt > retry:
+                        _log.warn("Giving up")
+                        metrics.inc(_M_EXPECT_FAILS)
+                        raise e
+                    metrics.inc(_M_EXPECT_RETRIES)
+            metrics.observe(_H_EXPECT, time.ticks_diff(time.ticks_ms(), start))
+            return pending.line
+        finally:
+            if pending in self._pending:
+                self._pending.remove(pending)
 
     async def send_raw(self, data):
         self.swriter.write(data)
@@ -325,119 +472,195 @@ class Satellite():
         """Send a command to the modem. Calculates the checksum.
         Caller should hold the lock otherwise bad things may happen.
         """
-        print(f"Asked to send {data}")
-        checksum = self._checksum_formatted(data)
-        cmd = f"{data}*{checksum}\n"
-        print(f"Sending command {cmd} to sat modem.")
-        self.swriter.write(cmd)
+        if __debug__:
+            _log.debug("Asked to send %s", data)
+        n = self.codec.encode(data)
+        self.swriter.write(self.codec.tx_mv[0:n])
         return await self.swriter.drain()
 
+    async def _mm(self, command: str, reply: str) -> bool:
+        """Send a $MM command answered by reply (or $MM ERR), True if it was reply.
+        Waiting for the answer keeps it from being taken by another $MM command."""
+        try:
+            line = await self.send_expect(command, (reply, "$MM ERR"))
+        except Exception as e:
+            _log.error("Error %s sending %s", e, command)
+            return False
+        return line.startswith(reply)
+
     async def del_msg(self, mid: str) -> bool:
         """Delete a message from the modem."""
-        # We don't care about the response so much so just yeet it
-        await self.send_command(f"$MM D={mid}")
+        return await self._mm(f"$MM D={mid}", "$MM DELETED")
+
+    async def del_read_msgs(self) -> bool:
+        """Delete every message already read from the modem in one command."""
+        return await self._mm("$MM D=R", "$MM DELETED")
+
+    async def clear_delivered(self):
+        """Clear the modem copies of msgs that were delivered (and stored elsewhere).
+        Msgs pushed with $RD are still unread on the modem, while msg watch is on every
+        msg has been pushed so it's safe to mark them all read first."""
+        if self.msg_watch:
+            await self._mm("$MM M=**", "$MM MARKED")
+        await self.del_read_msgs()
 
     async def check_for_msgs(self) -> int:
         """Check msgs, returns number of messages."""
-        # We care about the response so disable the interrupt handler
-        async with self.lock:
-            msg = await self.send_expect("$MM C=U", "$MM")
-            try:
-                parsed = int(msg.split(" ")[1])
-                print(f"We have {parsed} messages.")
-                return parsed
-            except Exception as e:
-                print(f"Error fetching msgs... {e}")
-                return -1
+        msg = await self.send_expect("$MM C=U", _mm_count)
+        try:
+            parsed = int(msg.split(" ")[1])
+            if __debug__:
+                _log.debug("We have %s messages.", parsed)
+            return parsed
+        except Exception as e:
+            _log.error("Error fetching msgs... %s", e)
+            return -1
+
+    async def read_firmware_version(self) -> str:
+        """Ask the modem which firmware it runs ($FV)."""
+        fv = await self.send_expect("$FV", "$FV")
+        self.firmware_version = fv.split(" ", 1)[1]
+        return self.firmware_version
 
     async def device_id(self) -> str:
         """Return the device id."""
         if self._device_id is not None:
             return self._device_id
         try:
-            async with self.lock:
-                await uasyncio.sleep(1)
-                await self.send_command("$FV")
-                await uasyncio.sleep(1)
-                line = await self.send_expect("$CS", "$CS")
-                cmd_data = " ".join(line.split(" ")[1:])
-                raw_device_id, device_name = cmd_data.split(",")
-                _, device_id = raw_device_id.split("=")
-                self._device_id = device_id
-                return device_id
+            await self.read_firmware_version()
+            line = await self.send_expect("$CS", "$CS")
+            cmd_data = " ".join(line.split(" ")[1:])
+            raw_device_id, device_name = cmd_data.split(",")
+            _, device_id = raw_device_id.split("=")
+            self._device_id = device_id
+            return device_id
         except Exception as e:
-            print(f"Error {e} reading device id, using probable device")
+            _log.error("Error %s reading device id, using probable device", e)
             self._device_id = self._prob_device_id
             return self._device_id
 
     async def read_msg(self, id=None) -> tuple[str, str, str]:
         """Read either a specific msg id or the most recent msg."""
-        print("read_msg called")
-        async with self.lock:
-            print("lock acquited.")
-            if id is None:
-                id = "N"
-            line = await self.send_expect(
-                command=f"$MM R={id}",
-                expect_prefix="$MM")
-            try:
-                cmd_data = " ".join(line.split(" ")[1:])
-                app_id, msg_data, msg_id, es = cmd_data.split(",")
-                app_id = int(app_id)
-                return (app_id, msg_data, msg_id)
-            except Exception as e:
-                print(f"Exception {e} while reading msg.")
-                return None
+        if __debug__:
+            _log.debug("read_msg called")
+        if id is None:
+            id = "N"
+        line = await self.send_expect(
+            command=f"$MM R={id}",
+            expect_prefix=_mm_read)
+        try:
+            msg = MMMsg(line, "MM", line.find(" "))
+            return (msg.app_id, msg.data, msg.msg_id)
+        except Exception as e:
+            _log.error("Exception %s while reading msg.", e)
+            return None
 
-    async def read_all_msgs(self):
-        """Read all the msgs and delete as we go."""
+    async def read_all_msgs(self, window=_DRAIN_WINDOW, delete=None):
+        """Drain the inbox: count once, pipeline reads oldest first (window at a time),
+        deliver them in order and then clear the delivered msgs from the modem."""
+        if delete is None:
+            delete = self.delete_on_read
         msg_count = await self.check_for_msgs()
+        delivered = []
+        clean = True
         while msg_count > 0:
-            print("Reading msg.")
-            (app_id, msg_data, msg_id) = self.read_msg()
-            if self.new_msg_callback is not None:
-                self.new_msg_callback(app_id, msg_data)
-                self.delete_msg(msg_id)
-            msg_count = await self.check_for_msgs()
-        print("Done reading all msgs")
+            governor.busy()
+            batch = min(msg_count, window)
+            if __debug__:
+                _log.debug("Reading %s of %s msgs.", batch, msg_count)
+            msgs = await uasyncio.gather(*[self.read_msg("O") for _ in range(batch)])
+            for msg in msgs:
+                if msg is None:
+                    clean = False
+                    continue
+                (app_id, msg_data, msg_id) = msg
+                try:
+                    if self.new_msg_callback is not None:
+                        self.new_msg_callback(app_id, msg_data)
+                    delivered.append(msg_id)
+                except Exception as e:
+                    _log.error("Error %s delivering msg %s", e, msg_id)
+                    clean = False
+            msg_count -= batch
+        if delete and len(delivered) > 0:
+            if clean:
+                # Everything read was delivered so one bulk delete clears them all.
+                await self.del_read_msgs()
+            else:
+                for msg_id in delivered:
+                    await self.del_msg(msg_id)
+        _log.info("Done reading all msgs, delivered %s", len(delivered))
+        return len(delivered)
 
     def is_ready(self) -> bool:
         """Returns if the modem is ready for msgs."""
-        return self.modem_ready
+        return self.ready and self.awake
 
-    async def send_msg(self, app_id, data) -> str:
+    async def send_msg(self, app_id, data, hold=None, expiry=None) -> str:
         """Send a message, returning the message ID.
         app_id is the application id.
         Data *must be* base64 encoded.
+        hold is how long (in seconds) the modem should keep trying, expiry an epoch time
+        after which it should give up.
         """
         if not self.ready:
             raise Exception("satelite modem not ready.")
-        async with self.lock:
-            line = self.send_expect(f"$TD AI={app_id},{data}", "$TD")
-            try:
-                cmd_data = " ".join(line.split(" ")[1:])
-                if cmd_data.startswith("OK"):
-                    status, msg_id = cmd_data.split(",")
-                    return msg_id
-                else:
-                    if self.error_callback is not None:
-                        self.error_callback(line)
-                    return ""
-            except Exception as e:
-                raise e
+        opts = ""
+        if hold is not None:
+            opts = f"HD={hold},"
+        if expiry is not None:
+            opts = f"{opts}ET={expiry},"
+        # Don't match the unsolicited $TD SENT acks.
+        line = await self.send_expect(f"$TD {opts}AI={app_id},{data}", ("$TD OK", "$TD ERR"))
+        cmd_data = " ".join(line.split(" ")[1:])
+        if cmd_data.startswith("OK"):
+            status, msg_id = cmd_data.split(",")
+            return msg_id
+        else:
+            if self.error_callback is not None:
+                self.error_callback(line)
+            return ""
 
     def last_rt_time(self) -> str:
         """Last received test time (from swarm)."""
         return self.last_date
 
-    def sleep_until_rx_watch(self):
-        """Configure RX pin goes hi."""
+    async def sleep_until_rx_watch(self) -> bool:
+        """Drive the modem's GPIO1 high while unread msgs are waiting ($GP 6), so rx_pin
+        can wake us from sleep."""
+        line = await self.send_expect("$GP 6", "$GP")
+        return line.startswith("$GP OK")
+
+    async def unsent_count(self) -> int:
+        """Msgs queued on the modem which haven't been sent yet, -1 if unknown."""
+        line = await self.send_expect("$MT C=U", "$MT")
         try:
-            self.lock.acquire()
-            uasyncio.create_task(self.send_command("GP 6"))
-            line = await self.sreader.readline()
-            while (not line.startswith("$GP")):
-                uasyncio.create_task(self._line_handle(line))
-                line = await self.sreader.readline()
-        finally:
-            self.lock.release()
+            return int(line.split(" ")[1])
+        except Exception as e:
+            _log.error("Error %s counting unsent msgs in %s", e, line)
+            return -1
+
+    async def sleep(self, seconds: int) -> bool:
+        """Put the modem to sleep ($SL) for seconds, it can't send or receive until it
+        wakes (on the timer, or on serial input, see wake)."""
+        line = await self.send_expect(f"$SL S={seconds}", ("$SL OK", "$SL ERR"))
+        if not line.startswith("$SL OK"):
+            _log.warn("Modem refused to sleep: %s", line)
+            return False
+        self.awake = False
+        return True
+
+    async def wake(self, timeout=None) -> bool:
+        """Wake a sleeping modem. Any serial input wakes it (and is lost), if it already
+        woke and we missed its $SL WAKE it answers instead."""
+        if self.awake:
+            return True
+        try:
+            line = await self.send_expect("$CS", ("$CS", "$SL WAKE"), retry=1, timeout=timeout)
+        except Exception as e:
+            _log.error("Modem didn't wake %s", e)
+            return False
+        self.awake = True
+        if line.startswith("$SL WAKE"):
+            self.wake_reason = line[9:]
+        return True
@@ -1,8 +1,45 @@
 import micropython
+import struct
+import time
 import uasyncio
+from micropython import const
 from display_wrapper import DisplayWrapper
+from outbox import QueueFull
+from ble_rx import Reassembler
+import advertising
+import binproto
+import governor
+import log
+import metrics
+
+_log = log.logger("ble")
+_M_NOTIFY_BYTES = metrics.counter("ble.notify_bytes")
+_M_NOTIFY_FAILS = metrics.counter("ble.notify_fails")
+_M_RX_FRAMES = metrics.counter("ble.rx_frames")
+_M_RX_ERRORS = metrics.counter("ble.rx_errors")
+_M_RX_DROPPED = metrics.counter("ble.rx_dropped")
+_M_TX_DROPPED = metrics.counter("ble.tx_dropped")
+_M_TX_RESYNCS = metrics.counter("ble.tx_resyncs")
 
 _BMS_MTU = 128
+# ATT MTU before the exchange completes, usable payload is the MTU less the ATT header.
+_DEFAULT_ATT_MTU = const(23)
+_ATT_HEADER = const(3)
+# Backoff when the controller is out of notify buffers.
+_NOTIFY_RETRY_MS = const(5)
+_MAX_NOTIFY_RETRIES = const(100)
+# Outbound bytes (frames and their 4 byte lengths) queued for the phone.
+_TX_BUF = const(2048)
+
+
+def _text(view, start: int) -> str:
+    """Decode view[start:] without surrounding whitespace, in a single allocation."""
+    end = len(view)
+    while end > start and view[end - 1] <= 0x20:
+        end -= 1
+    while start < end and view[start] <= 0x20:
+        start += 1
+    return str(view[start:end], 'utf8')
 
 
 class UARTBluetooth():
@@ -10,10 +47,13 @@ class UARTBluetooth():
     def __init__(self, name: str, display=None, msg_callback=None, ble=None,
                  client_ready_callback=None, set_phone_id=None,
                  get_phone_id=None,
-                 get_device_id=None):
-        """Initialize the UART BLE handler. For testing allows ble to be supplied."""
+                 get_device_id=None, ack_msgs=None, firmware=None, write_firmware=None):
+        """Initialize the UART BLE handler. For testing allows ble to be supplied.
+        firmware is the FirmwareStore uploads ('F') go to, write_firmware(progress) an
+        async callable writing it to the modem ('W') and returning the version only once
+        the modem reports running it, without one 'W' replies an error."""
 
-        print("Starting UART BLuetooth interface.")
+        _log.info("Starting UART BLuetooth interface.")
         self.name = name
         self.modem_ready = False
         if ble is None:
@@ -21,52 +61,88 @@ class UARTBluetooth():
             try:
                 import mac_setup
                 mac_bits = 1
-                print(dir(mac_setup))
+                _log.debug("%s", dir(mac_setup))
                 mac_setup.setup(mac_bits)
             except Exception as e:
                 print(help('modules'))
-                print(f"Weird error {e} trying to configure MAC prefix, will use ESP32 prefix")
+                _log.error("Weird error %s trying to configure MAC prefix, will use ESP32 prefix",
+                           e)
             self.ble = bluetooth.BLE()
         else:
             self.ble = ble
-        print("Stopping advertise.")
+        _log.debug("Stopping advertise.")
         self.stop_advertise()
         self.services = ()
         self.service_uuids = []
+        self.tx = None
+        self.rx = None
         self.conn_handle = 0
-        print("Enable.")
+        _log.debug("Enable.")
         self.enable()
         self.connected = False
         self.display = DisplayWrapper(display)
-        self.target_length = 0
-        self.mtu = 10
+        self.mtu = _DEFAULT_ATT_MTU
+        # Outbound msgs are queued and notified by _tx_loop so we can pace & retry.
+        # Outbound frames (length then data) in a byte ring, _tx_in / _tx_out count the
+        # bytes written / notified so far.
+        self._tx_buf = bytearray(_TX_BUF)
+        self._tx_mv = memoryview(self._tx_buf)
+        self._tx_in = 0
+        self._tx_out = 0
+        self._tx_writing = False
+        self._tx_late = []
+        self.tx_dropped = 0
+        self._tx_flag = uasyncio.ThreadSafeFlag()
+        # Length prefixes being queued, and the one being notified (a send while a
+        # notify retries mustn't change what the phone gets).
+        self._len_buf = bytearray(4)
+        self._notify_len = bytearray(4)
+        self.tx_bytes = 0
+        self.tx_ms = 0
+        self.notify_failures = 0
         self.client_ready_callback = client_ready_callback
+        self.msg_callback = msg_callback
+        self.ack_msgs = ack_msgs
         self.set_phone_id_callback_ref = set_phone_id
-        self.msg_buffer = bytearray(1000)
-        self.mv_msg_buffer = memoryview(self.msg_buffer)
-        self.msg_buffer_idx = 0
-        self.ready = False
+        self.rx_frames = Reassembler(1024)
+        # Negotiated per connection with 'B', unsolicited msgs are sent as binary frames.
+        self.binary = False
+        # Request ids of binary 'send msg' requests by outbox ticket.
+        self._ticket_reqs = {}
+        self._rx_scheduled = False
         self.get_phone_id = get_phone_id
         self.get_device_id = get_device_id
+        self.firmware = firmware
+        self.write_firmware = write_firmware
         # We need to avoid allocs in the IRQ
         # (see https://docs.micropython.org/en/latest/reference/isr_rules.html?highlight=isr)
         self._get_phone_id_ref = self._get_phone_id
         self._get_device_id_ref = self._get_device_id
         self._msg_handle_ref = self._msg_handle
         self._send_ready_ref = self.send_ready
+        self._drain_rx_ref = self._drain_rx
         # Setup a call-back for ble msgs
         self.ble.irq(self.ble_irq)
         if ble is None:
-            print("Prepairing to register")
+            _log.debug("Prepairing to register")
             self.register()
-        print("Prepairing to advertise.")
+        _log.debug("Prepairing to advertise.")
+        try:
+            adv_data, resp_data = advertising.payloads(
+                name, self.service_uuids, advertising.APPEARANCE_OUTDOOR)
+        except ValueError as e:
+            _log.error("Error %s building the advertising payload, leaving out services", e)
+            adv_data, resp_data = advertising.payloads(name, (), advertising.APPEARANCE_OUTDOOR)
+        self.advertiser = advertising.Advertiser(self.ble, adv_data, resp_data)
         self.advertise()
-        print("Ok!")
+        self.adv_task = uasyncio.create_task(self.advertiser.run())
+        self.tx_task = uasyncio.create_task(self._tx_loop())
+        _log.debug("Ok!")
 
     def enable(self):
         self.ble.config(gap_name=self.name)
         self.ble.active(True)
-        print(f"BLE MAC address is {self.ble.config('mac')}")
+        _log.info("BLE MAC address is %s", self.ble.config('mac'))
         self.ble.config(gap_name=self.name)
 
     def disable(self):
@@ -76,27 +152,27 @@ class UARTBluetooth():
 
     def ble_irq(self, event: int, data):
         """Handle BlueTooth Event."""
-        print(f"Handling {event} {data}")
-        print(f"DEBUG: Current event loop task is {uasyncio.current_task()}")
-        print(f"DEBUG: state: {uasyncio.current_task().state}")
-        print(str(event))
-        print(str(data))
+        if __debug__:
+            # Only the event, data is only valid for the duration of the IRQ.
+            _log.debug("IRQ event %d", event)
         # Handle bluetooth events
         if event == 1:
             # Paired
             self.display.write("Connected!")
+            self.display.status(0, "Phone")
             self.connected = True
+            self.advertiser.stop()
             conn_handle, _, _ = data
             self.conn_handle = conn_handle
             # Negotiate MTU
             try:
                 self.ble.gattc_exchange_mtu(_BMS_MTU)
             except Exception as e:
-                print(f"Error negotiating MTU {e}")
+                _log.error("Error negotiating MTU %s", e)
                 try:
                     self.ble.gattc_exchange_mtu(int(_BMS_MTU / 2))
                 except Exception as e:
-                    print(f"Error negotiating MTU {e}")
+                    _log.error("Error negotiating MTU %s", e)
 
             # If the modem is ready, let the client know.
             if self.modem_ready:
@@ -109,93 +185,213 @@ class UARTBluetooth():
             # Disconnected
             if self.display is not None:
                 self.display.write("Phone disconnected, turn off if done :)")
+                self.display.status(0, "No phone")
             self.connected = False
+            self.mtu = _DEFAULT_ATT_MTU
+            self.binary = False
+            self._ticket_reqs = {}
             self.advertise()
             self.client_ready_callback(False)
         elif event == 3:  # _IRQ_GATTS_WRITE
             # msg received, note that BLE UART spec means msg data may be chunked
+            governor.busy()
             buffer = self.ble.gatts_read(self.rx)
-            if (self.target_length == 0):
-                # Little endian like x86
-                self.target_length = int.from_bytes(buffer, 'little')
-                # Wrap the buffer if needed.
-                if self.target_length + self.msg_buffer_idx >= len(buffer):
-                    self.msg_buffer_idx = 0
-                return
-            # If we're still processing the last message ask the client to repeat it.
-            if not self.ready:
+            errors = self.rx_frames.errors
+            dropped = self.rx_frames.dropped
+            completed = self.rx_frames.feed(buffer)
+            if completed > 0:
+                metrics.inc(_M_RX_FRAMES, completed)
+                if not self._rx_scheduled:
+                    self._rx_scheduled = True
+                    micropython.schedule(self._drain_rx_ref, None)
+            if self.rx_frames.errors != errors:
+                metrics.inc(_M_RX_ERRORS, self.rx_frames.errors - errors)
+                self.send("ERROR: INVALID MSG LEN")
+            # Out of room for more frames, ask the client to repeat it.
+            if self.rx_frames.dropped != dropped:
+                metrics.inc(_M_RX_DROPPED, self.rx_frames.dropped - dropped)
                 self.send("REPEAT")
-            self.target_length -= len(buffer)
-            new_end = self.msg_buffer_idx + len(buffer)
-            self.msg_buffer[self.msg_buffer_idx:new_end] = buffer
-            if self.target_length == 0:
-                # Use mv_msg_buffer to avoid allocation
-                micropython.schedule(self._handle_phone_buffer, self.mv_msg_buffer[:new_end])
-            elif self.target_length < 0:
-                self.msg_buffer_idx = 0
-                # Error
-                e = "ERROR: INVALID MSG LEN"
-                self.send(e)
-                self.target_length = 0
-            else:
-                self.msg_buffer_idx = new_end + 1
             return True
 
+    def _drain_rx(self, _):
+        """Handle every completed frame from the phone."""
+        self._rx_scheduled = False
+        while True:
+            view = self.rx_frames.peek()
+            if view is None:
+                return
+            try:
+                self._handle_phone_buffer(view)
+            finally:
+                self.rx_frames.release()
+
     def _handle_phone_buffer(self, buffer_veiw):
         try:
+            if binproto.is_binary(buffer_veiw[0]):
+                return self._handle_binary(buffer_veiw)
             command = chr(buffer_veiw[0])
-            print(f"Handling command {command}")
+            if __debug__:
+                _log.debug("Handling command %s", command)
             if command == 'M':
                 self.display.write("Sending msg to modem")
                 # Two bytes for app ID
                 app_id = int.from_bytes(buffer_veiw[1:3], 'little')
-                print(f"App id {app_id}")
-                msg_str = str(buffer_veiw[3:], 'utf8').strip()
-                print(f"Msg is {msg_str}")
+                if __debug__:
+                    _log.debug("App id %s", app_id)
+                msg_str = _text(buffer_veiw, 3)
+                if __debug__:
+                    _log.debug("Msg is %s", msg_str)
                 uasyncio.create_task(self._msg_handle_ref(app_id, msg_str))
             elif command == 'P':
                 self.display.write("Configuring modem profile.")
-                msg_str = str(buffer_veiw[1:], 'utf8').strip()
-                print(f"Setting phone id to {msg_str}")
+                msg_str = _text(buffer_veiw, 1)
+                _log.info("Setting phone id to %s", msg_str)
                 uasyncio.create_task(self.set_phone_id_callback_ref(msg_str))
-                print("Task created :)")
+                if __debug__:
+                    _log.debug("Task created :)")
             elif command == 'Q':
                 self.display.write("Creating task to fetch phone id")
                 uasyncio.create_task(self._get_phone_id_ref())
             elif command == 'D':
                 self.display.write("Creating task to fetch device id")
                 uasyncio.create_task(self._get_device_id_ref())
+            elif command == 'A':
+                seq = int(_text(buffer_veiw, 1))
+                if self.ack_msgs is not None:
+                    self.ack_msgs(seq)
+            elif command == 'S':
+                self.send(f"STATS {metrics.snapshot()}")
+            elif command == 'F':
+                self._firmware_upload(buffer_veiw)
+            elif command == 'W':
+                uasyncio.create_task(self._write_firmware())
+            elif command == 'B':
+                # Switch to binary frames for this connection.
+                self.binary = True
+                self.send(f"BIN {binproto.VERSION}")
             else:
-                print(f"IDK what to do with {command}")
-            print("Done!")
+                _log.warn("IDK what to do with %s", command)
+            if __debug__:
+                _log.debug("Done!")
         except Exception as e:
-            print(f"Error {e} handling {buffer_veiw}.")
-        finally:
-            self.ready = True
+            # Copy, the view is released once we return.
+            _log.error("Error %s handling %s.", e, bytes(buffer_veiw))
+
+    def _firmware_upload(self, view):
+        """FB{size},{sha256},{version} starts or resumes an upload, FD{u32 offset}{data}
+        is a chunk. Both reply with the progress, the chunk goes straight to flash."""
+        store = self.firmware
+        try:
+            if store is None:
+                raise ValueError("firmware upload not supported")
+            op = chr(view[1])
+            if op == 'B':
+                size, sha256, version = _text(view, 2).split(",", 2)
+                store.begin(int(size), sha256, version)
+            elif op == 'D':
+                store.write(struct.unpack_from("<I", view, 2)[0], view[6:])
+            else:
+                raise ValueError(f"unknown firmware op {op}")
+        except Exception as e:
+            self.send(f"ERROR: {e}")
+            return
+        self.send(f"FW {store.offset} {store.size} {store.rate()}")
+        if op == 'D' and store.offset == store.size:
+            self.send(f"FWOK {store.version}")
+        elif op == 'D' and store.size is None:
+            self.send("ERROR: firmware hash mismatch")
 
-    async def _get_phone_id(self):
-        print("Getting phone id.")
+    async def _write_firmware(self):
+        self.display.write("Updating modem firmware")
+
+        def progress(offset, rate):
+            self.send(f"FLASH {offset} {self.firmware.size} {rate}")
+
+        try:
+            if self.write_firmware is None:
+                raise ValueError("firmware update not supported")
+            version = await self.write_firmware(progress)
+            self.send(f"FLASHED {version}")
+            self.display.write("Modem firmware updated")
+        except Exception as e:
+            self.send(f"ERROR: {e}")
+            self.display.write("Modem firmware update failed")
+
+    def _handle_binary(self, view):
+        op, req_id, app_id, payload = binproto.decode(view)
+        if __debug__:
+            _log.debug("Handling binary op %s req %s", op, req_id)
+        if op == binproto.OP_SEND_MSG:
+            uasyncio.create_task(self._msg_handle_ref(app_id, binproto.to_hex(payload), req_id))
+        elif op == binproto.OP_SET_PHONE_ID:
+            uasyncio.create_task(self._set_phone_id(_text(payload, 0), req_id))
+        elif op == binproto.OP_GET_PHONE_ID:
+            uasyncio.create_task(self._get_phone_id_ref(req_id))
+        elif op == binproto.OP_GET_DEVICE_ID:
+            uasyncio.create_task(self._get_device_id_ref(req_id))
+        elif op == binproto.OP_GET_STATS:
+            self.send(binproto.encode(binproto.OP_STATS, req_id, 0, metrics.snapshot()))
+        elif op == binproto.OP_ACK_MSGS:
+            seq = struct.unpack_from("<I", payload, 0)[0]
+            if self.ack_msgs is not None:
+                self.ack_msgs(seq)
+            self.send(binproto.encode(binproto.OP_OK, req_id))
+        else:
+            self.send(binproto.encode(binproto.OP_ERROR, req_id, 0, f"unknown op {op}"))
+
+    async def _set_phone_id(self, phone_id, req_id):
+        await self.set_phone_id_callback_ref(phone_id)
+        self.send(binproto.encode(binproto.OP_OK, req_id))
+
+    async def _get_phone_id(self, req_id=None):
+        _log.debug("Getting phone id.")
         phone_id = await self.get_phone_id()
-        print(f"Got phone id {phone_id}")
+        _log.debug("Got phone id %s", phone_id)
         if phone_id is None:
-            self.send(f"ERROR: \"{await self.get_device_id()}\" not configured.")
-        else:
+            error = f"\"{await self.get_device_id()}\" not configured."
+            if req_id is None:
+                self.send(f"ERROR: {error}")
+            else:
+                self.send(binproto.encode(binproto.OP_ERROR, req_id, 0, error))
+        elif req_id is None:
             self.send(f"PHONEID: {phone_id}")
+        else:
+            self.send(binproto.encode(binproto.OP_PHONE_ID, req_id, 0, phone_id))
 
-    async def _get_device_id(self):
+    async def _get_device_id(self, req_id=None):
         device_id = await self.get_device_id()
-        print(f"Got device id {device_id}")
-        self.send(f"{device_id}")
+        _log.debug("Got device id %s", device_id)
+        if req_id is None:
+            self.send(f"{device_id}")
+        else:
+            self.send(binproto.encode(binproto.OP_DEVICE_ID, req_id, 0, f"{device_id}"))
 
-    async def _msg_handle(self, app_id, completed_msg):
+    async def _msg_handle(self, app_id, completed_msg, req_id=None):
+        """Queue a msg for the modem. Binary requests (req_id set) carry hex data."""
         if self.msg_callback is not None:
             try:
-                id = await self.msg_callback(app_id, completed_msg)
-                self.send(f"MSGID: {id}")
+                if req_id is None:
+                    ticket, position = await self.msg_callback(app_id, completed_msg)
+                    self.send(f"QUEUED {ticket} {position}")
+                else:
+                    ticket, position = await self.msg_callback(
+                        app_id, completed_msg, raw=True)
+                    self._ticket_reqs[ticket] = req_id
+                    self.send(binproto.encode(binproto.OP_QUEUED, req_id, app_id,
+                                              struct.pack("<IH", ticket, position)))
+                # Just the counter, not a whole redraw.
+                self.display.status(1, f"Q {position}")
+            except QueueFull:
+                if req_id is None:
+                    self.send("FULL")
+                else:
+                    self.send(binproto.encode(binproto.OP_FULL, req_id, app_id))
+                self.display.write("Outbound queue full")
             except Exception as e:
-                self.send(f"ERROR: sat modem error {e}")
-            self.display.write(str("".join(self.msg)))
-            self.display.show()
+                if req_id is None:
+                    self.send(f"ERROR: sat modem error {e}")
+                else:
+                    self.send(binproto.encode(binproto.OP_ERROR, req_id, app_id, f"{e}"))
 
     def register(self):
         """Register nordic UART service."""
@@ -218,128 +414,190 @@ class UARTBluetooth():
         rxbuf = 500
         self.ble.gatts_set_buffer(self.rx, rxbuf, True)
 
-    def send(self, data):
+    def send(self, data) -> bool:
+        """Queue data (str or bytes) to be notified to the phone, prefixed by its length.
+        Returns False (dropping it) if the tx buffer is full."""
+        if isinstance(data, str):
+            data = data.encode()
+        governor.busy()
+        if self._tx_writing:
+            # A scheduled callback interrupted another send mid copy, _tx_loop queues it.
+            self._tx_late.append(bytes(data))
+            self._tx_flag.set()
+            return True
+        self._tx_writing = True
+        try:
+            queued = self._enqueue(data)
+        finally:
+            self._tx_writing = False
+        self._tx_flag.set()
+        return queued
+
+    def _enqueue(self, data) -> bool:
+        n = len(data)
+        if n + 4 > len(self._tx_buf) - (self._tx_in - self._tx_out):
+            self.tx_dropped += 1
+            metrics.inc(_M_TX_DROPPED)
+            _log.warn("TX buffer full, dropped %s bytes", n)
+            return False
+        struct.pack_into("<I", self._len_buf, 0, n)
+        self._copy_in(self._len_buf)
+        self._copy_in(data)
+        return True
+
+    def _copy_in(self, data):
+        """Append data to the tx ring (the caller checked there's room)."""
+        size = len(self._tx_buf)
+        pos = self._tx_in % size
+        n = len(data)
+        first = min(n, size - pos)
+        src = memoryview(data)
+        self._tx_mv[pos:pos + first] = src[:first]
+        if first < n:
+            self._tx_mv[0:n - first] = src[first:]
+        self._tx_in += n
+
+    def _take_late(self):
+        self._tx_writing = True
+        try:
+            while len(self._tx_late) > 0:
+                self._enqueue(self._tx_late.pop(0))
+        finally:
+            self._tx_writing = False
+
+    def payload_size(self) -> int:
+        """Bytes of data that fit in one notification at the negotiated MTU."""
+        return self.mtu - _ATT_HEADER
+
+    def tx_rate(self) -> int:
+        """Bytes/sec while notifying."""
+        if self.tx_ms == 0:
+            return 0
+        return self.tx_bytes * 1000 // self.tx_ms
+
+    async def _tx_loop(self):
+        while True:
+            await self._tx_flag.wait()
+            self._take_late()
+            while self._tx_in != self._tx_out:
+                await self._notify_frame()
+                self._take_late()
+
+    async def _notify_frame(self):
+        """Notify the oldest frame in the tx ring, its length then its data as views of
+        the ring. If the phone only got part of it (retries ran out) its length prefixed
+        stream is out of sync for good, so disconnect and let it start over."""
+        start = time.ticks_ms()
+        buf = self._tx_buf
+        size = len(buf)
+        pos = self._tx_out % size
+        n = 0
+        for i in range(4):
+            n |= buf[(pos + i) % size] << (8 * i)
+        end = self._tx_out + 4 + n
+        sent = 0
         try:
-            print(f"Preparing to send {data} to UART BTLE.")
-            # Send how many bytes were going to have, we always use 4 bytes to send this.
-            self.ble.gatts_notify(self.conn_handle, self.tx, int.to_bytes(len(data), 4, 'little'))
-            # Send all of the bytes
-            idx = 0
-            while (idx < len(data)):
-                self.ble.gatts_notify(self.conn_handle, self.tx, data[idx:idx + self.mtu])
-                idx = idx + self.mtu
-            print("Done.")
+            struct.pack_into("<I", self._notify_len, 0, n)
+            await self._notify(self._notify_len)
+            sent = 4
+            while sent < n + 4:
+                # Re-read each chunk in case the MTU exchange finishes mid msg.
+                pos = (self._tx_out + sent) % size
+                step = min(self.payload_size(), n + 4 - sent, size - pos)
+                await self._notify(self._tx_mv[pos:pos + step])
+                sent += step
         except Exception as e:
-            print(f"Failed to send {data} to UART BTLE - {e}")
-            # TODO: Better exception handling?
+            _log.error("Failed to send %s bytes to UART BTLE - %s", n, e)
+            if sent > 0 and self.connected:
+                self._resync()
+                return
+        self._tx_out = end
+        self.tx_bytes += sent
+        metrics.inc(_M_NOTIFY_BYTES, sent)
+        self.tx_ms += time.ticks_diff(time.ticks_ms(), start)
+
+    def _resync(self):
+        """Drop everything queued and disconnect, the phone reconnects in sync."""
+        self._tx_out = self._tx_in
+        metrics.inc(_M_TX_RESYNCS)
+        try:
+            self.ble.gap_disconnect(self.conn_handle)
+        except Exception as e:
+            _log.error("Error %s disconnecting to resync", e)
 
-    def send_msg(self, app_id: str, msg: str):
-        self.display("Loading msg from satelites")
-        self.send(f"MSG {app_id} {msg}")
+    async def _notify(self, chunk):
+        """Notify chunk, when the controller is out of buffers back off and retry."""
+        retries = 0
+        while True:
+            try:
+                self.ble.gatts_notify(self.conn_handle, self.tx, chunk)
+                return
+            except OSError:
+                self.notify_failures += 1
+                metrics.inc(_M_NOTIFY_FAILS)
+                retries += 1
+                if retries > _MAX_NOTIFY_RETRIES or not self.connected:
+                    raise
+                await uasyncio.sleep_ms(_NOTIFY_RETRY_MS * min(retries, 10))
+
+    def send_msg(self, app_id: str, msg: str, seq: int) -> bool:
+        """Queue a msg from the satellites, False if there's no room for it yet. Raises
+        ValueError if it's too big to ever fit in the tx buffer."""
+        self.display.write("Loading msg from satelites")
+        if self.binary:
+            frame = binproto.encode(binproto.OP_MSG, 0, int(app_id),
+                                    struct.pack("<I", seq) + binproto.from_hex(msg))
+        else:
+            frame = f"MSG {app_id} {msg} {seq}".encode()
+        if len(frame) + 4 > len(self._tx_buf):
+            raise ValueError(f"Msg {seq} is {len(frame)} bytes, over the tx buffer")
+        return self.send(frame)
 
     def send_error(self, error):
-        self.send(f"ERROR {error}")
+        if self.binary:
+            self.send(binproto.encode(binproto.OP_ERROR, 0, 0, f"{error}"))
+        else:
+            self.send(f"ERROR {error}")
 
     # v so that schedule can be called.
     def send_ready(self, v=None):
-        print("Set modem ready.")
+        _log.debug("Set modem ready.")
         self.modem_ready = True
         try:
-            print("Sending.")
-            self.send("READY")
-            print("Sent.")
+            if __debug__:
+                _log.debug("Sending.")
+            if self.binary:
+                self.send(binproto.encode(binproto.OP_READY))
+            else:
+                self.send("READY")
+            if __debug__:
+                _log.debug("Sent.")
         except Exception as e:
-            print(f"Failed to send {e}")
+            _log.error("Failed to send %s", e)
+
+    def send_msg_id(self, ticket: int, msgid: str):
+        """A queued msg has been handed to the modem."""
+        req_id = self._ticket_reqs.pop(ticket, None)
+        if req_id is None:
+            self.send(f"MSGID: {ticket} {msgid}")
+        else:
+            self.send(binproto.encode(binproto.OP_MSGID, req_id, 0, binproto.pack_msg_id(msgid)))
 
     def send_msg_acked(self, msgid: str):
-        self.send(f"ACK {msgid}")
+        if self.binary:
+            self.send(binproto.encode(binproto.OP_SENT, 0, 0, binproto.pack_msg_id(msgid)))
+        else:
+            self.send(f"ACK {msgid}")
 
     def stop_advertise(self):
         self.ble.gap_advertise(None, b'')
 
     def advertise(self):
-        print(f"Advertising {self.name}")
-        from micropython import const
-        import struct
-        device_type = 5184  # Generic outdoor
-        # Generate a payload to be passed to gap_advertise(adv_data=...).
-        # From:
-        # https://github.com/micropython/micropython/blob/master/examples/bluetooth/
-        # This is MIT licensed.
-
-        def advertising_payload(limited_disc=False, br_edr=False, name=None, services=None,
-                                appearance=0):
-            _ADV_TYPE_FLAGS = const(0x01)
-            _ADV_TYPE_NAME = const(0x09)
-            _ADV_TYPE_UUID16_COMPLETE = const(0x3)
-            _ADV_TYPE_UUID32_COMPLETE = const(0x5)
-            _ADV_TYPE_UUID128_COMPLETE = const(0x7)
-            _ADV_TYPE_APPEARANCE = const(0x19)
-
-            payload = bytearray()
-
-            def _append(adv_type, value):
-                nonlocal payload
-                payload += struct.pack("BB", len(value) + 1, adv_type) + value
-
-            _append(
-                _ADV_TYPE_FLAGS,
-                struct.pack("B", (0x01 if limited_disc else 0x02) + (0x18 if br_edr else 0x04)),
-            )
-
-            if name:
-                _append(_ADV_TYPE_NAME, name)
-
-            if services:
-                print("Adding services to advertising payload.")
-                for uuid in services:
-                    print(f"Service {uuid} in {services}")
-                    # Return here and fix the cast issue.
-                    b = bytes(uuid)
-                    if len(b) == 2:
-                        _append(_ADV_TYPE_UUID16_COMPLETE, b)
-                    elif len(b) == 4:
-                        _append(_ADV_TYPE_UUID32_COMPLETE, b)
-                    elif len(b) == 16:
-                        _append(_ADV_TYPE_UUID128_COMPLETE, b)
-
-            # See org.bluetooth.characteristic.gap.appearance.xml
-            if appearance:
-                _append(_ADV_TYPE_APPEARANCE, struct.pack("<h", appearance))
-
-            return payload
-
-        print("Creating advertise payload")
-        print(self.name)
-        print("Service UUIDs:")
-        print(self.service_uuids)
-        print("Device type")
-        print(device_type)
-        _payload = advertising_payload(
-            name=self.name,
-            services=self.service_uuids,
-            appearance=device_type)
-        try:
-            print("Created payload :)")
-            self.ble.gap_advertise(
-                100,
-                _payload,
-                resp_data=_payload)
-        except Exception as e:
-            print(f"Error using long payload for BTLE {e}")
-            _short_payload = advertising_payload(
-                name=self.name,
-                services=[],
-                appearance=device_type)
-            try:
-                print("Advertising short payload :)")
-                self.ble.gap_advertise(
-                    100,
-                    _short_payload,
-                    resp_data=_payload)
-            except Exception as e:
-                print(f"Error using long resp payload - {e}")
-                self.ble.gap_advertise(
-                    100,
-                    _short_payload,
-                    resp_data=_short_payload)
+        """(Re)start advertising at the fast interval, see advertising.Advertiser."""
+        _log.info("Advertising %s", self.name)
+        self.advertiser.start()
+
+    def boost_advertising(self):
+        """Something is waiting for the phone, advertise fast if it isn't connected."""
+        if not self.connected:
+            self.advertiser.boost()
@@ -0,0 +1,149 @@
+import struct
+import time
+import uasyncio
+from micropython import const
+import log
+import metrics
+
+# BLE advertising: payloads built once and an interval schedule which advertises fast
+# when a phone is likely to (re)connect and slowly otherwise.
+_log = log.logger("adv")
+_M_ADV_MS = metrics.counter("ble.adv_ms")
+_M_ADV_EVENTS = metrics.counter("ble.adv_events")
+_G_INTERVAL = metrics.gauge("ble.adv_interval_ms")
+_H_RECONNECT = metrics.histogram("ble.reconnect_ms")
+
+_ADV_TYPE_FLAGS = const(0x01)
+_ADV_TYPE_UUID16_COMPLETE = const(0x03)
+_ADV_TYPE_UUID32_COMPLETE = const(0x05)
+_ADV_TYPE_UUID128_COMPLETE = const(0x07)
+_ADV_TYPE_SHORT_NAME = const(0x08)
+_ADV_TYPE_NAME = const(0x09)
+_ADV_TYPE_APPEARANCE = const(0x19)
+# Legacy advertising and scan response data are at most 31 bytes each.
+MAX_PAYLOAD = const(31)
+APPEARANCE_OUTDOOR = const(5184)
+
+# (interval us, how long in ms or None for until further notice). Fast for the first
+# 30s after boot, a disconnect or a boost, then Apple's recommended 152.5ms and 1022.5ms.
+STAGES = ((20000, 30000), (152500, 120000), (1022500, None))
+
+
+def _append(payload, adv_type, value):
+    payload.append(len(value) + 1)
+    payload.append(adv_type)
+    payload.extend(value)
+
+
+def payloads(name: str, services=(), appearance=0, limited_disc=False, br_edr=False):
+    """(adv_data, resp_data) for gap_advertise. Flags, appearance and the services go in
+    the advertisement (phones filter scans on them), the name in the scan response,
+    shortened if it doesn't fit. Raises ValueError if the advertisement doesn't fit."""
+    adv = bytearray()
+    _append(adv, _ADV_TYPE_FLAGS,
+            bytes(((0x01 if limited_disc else 0x02) + (0x18 if br_edr else 0x04),)))
+    if appearance:
+        _append(adv, _ADV_TYPE_APPEARANCE, struct.pack("<h", appearance))
+    for uuid in services:
+        b = bytes(uuid)
+        if len(b) == 2:
+            _append(adv, _ADV_TYPE_UUID16_COMPLETE, b)
+        elif len(b) == 4:
+            _append(adv, _ADV_TYPE_UUID32_COMPLETE, b)
+        elif len(b) == 16:
+            _append(adv, _ADV_TYPE_UUID128_COMPLETE, b)
+    if len(adv) > MAX_PAYLOAD:
+        raise ValueError(f"Advertising payload is {len(adv)} bytes")
+    resp = bytearray()
+    name = name.encode()
+    if len(name) + 2 <= MAX_PAYLOAD:
+        _append(resp, _ADV_TYPE_NAME, name)
+    else:
+        _append(resp, _ADV_TYPE_SHORT_NAME, name[:MAX_PAYLOAD - 2])
+    return (bytes(adv), bytes(resp))
+
+
+class Advertiser():
+    """Steps through STAGES from the fastest interval down to the slowest.
+
+    start (on boot & disconnects) and boost (e.g. msgs waiting for the phone) go back to
+    the fast interval, stop (on connect) records how long the phone took to connect.
+    Time spent advertising and the estimated advertising events are in the ble.adv_*
+    metrics.
+    """
+
+    def __init__(self, ble, adv_data, resp_data, stages=STAGES):
+        self.ble = ble
+        self.adv_data = adv_data
+        self.resp_data = resp_data
+        self.stages = stages
+        # -1 when not advertising.
+        self.stage = -1
+        self.adv_ms = 0
+        self.events = 0
+        self._since = time.ticks_ms()
+        self._started = None
+        self._flag = uasyncio.ThreadSafeFlag()
+
+    def _account(self):
+        now = time.ticks_ms()
+        if self.stage >= 0:
+            ms = time.ticks_diff(now, self._since)
+            events = ms * 1000 // self.stages[self.stage][0]
+            self.adv_ms += ms
+            self.events += events
+            metrics.inc(_M_ADV_MS, ms)
+            metrics.inc(_M_ADV_EVENTS, events)
+        self._since = now
+
+    def _set_stage(self, stage: int):
+        self._account()
+        interval = self.stages[stage][0]
+        try:
+            self.ble.gap_advertise(interval, self.adv_data, resp_data=self.resp_data)
+        except Exception as e:
+            _log.error("Error %s advertising", e)
+            self.stage = -1
+            return
+        self.stage = stage
+        metrics.set_gauge(_G_INTERVAL, interval // 1000)
+        if __debug__:
+            _log.debug("Advertising every %sus", interval)
+
+    def start(self):
+        """Advertise fast, on boot or after a disconnect."""
+        self._started = time.ticks_ms()
+        self._set_stage(0)
+        self._flag.set()
+
+    def boost(self):
+        """Back to the fast interval if we're advertising slower."""
+        if self.stage > 0:
+            self._set_stage(0)
+            self._flag.set()
+
+    def slow(self) -> bool:
+        """True unless advertising at one of the faster stages, e.g. so a light sleep
+        (which suspends advertising) doesn't slow a phone (re)connecting."""
+        return self.stage < 0 or self.stages[self.stage][1] is None
+
+    def stop(self):
+        """A phone connected (which stops advertising)."""
+        self._account()
+        self.stage = -1
+        if self._started is not None:
+            metrics.observe(_H_RECONNECT, time.ticks_diff(time.ticks_ms(), self._started))
+            self._started = None
+        self._flag.set()
+
+    async def run(self):
+        """Steps the interval down as each stage's time runs out."""
+        while True:
+            hold = None if self.stage < 0 else self.stages[self.stage][1]
+            if hold is None:
+                await self._flag.wait()
+                continue
+            try:
+                await uasyncio.wait_for_ms(self._flag.wait(), hold)
+            except uasyncio.TimeoutError:
+                self._set_stage(self.stage + 1)
@@ -0,0 +1,272 @@
+"""Micro benchmarks for the firmware hot paths.
+
+Run from fw/ on the unix port (or CPython with uasyncio / micropython available):
+
+    micropython bench.py [--out FILE] [--baseline FILE] [--update] [--tolerance PCT]
+
+Each result is a line of `name rate unit alloc_per_op`, alloc is bytes allocated per
+op (from gc.mem_alloc, "-" where it isn't available). With --baseline results are
+compared to a stored run and the exit status is 1 on a regression: a rate more than
+tolerance percent slower (only against a baseline from the same implementation) or
+more bytes allocated per op, or no baseline file (so a gate can't pass by checking
+nothing). --update writes the results as the new baseline.
+"""
+import gc
+import sys
+import time
+import uasyncio
+import log
+from Satellite import Satellite
+from UARTBluetooth import UARTBluetooth
+from ble_rx import Reassembler
+from test_utils import FakeBLE, FakeUART, nmea
+
+_ALLOC_OPS = 50
+_DEFAULT_TOLERANCE = 25
+
+_LINES = [
+    nmea("$RD AI=42,RSSI=-100,SNR=4,FDEV=-980,48656c6c6f20776f726c64").encode(),
+    nmea("$TD SENT RSSI=-102,SNR=-1,FDEV=-1100,5354468575855").encode(),
+    nmea("$DT 20230102030405,V").encode(),
+    nmea("$RT RSSI=-104,SNR=-2,FDEV=0,TS=2023-01-02 03:04:05,DI=0x0012ab").encode(),
+]
+
+
+class _NullWriter():
+    def write(self, data):
+        pass
+
+    async def drain(self):
+        return True
+
+
+def _now_us() -> int:
+    if hasattr(time, "ticks_us"):
+        return time.ticks_us()
+    return int(time.perf_counter() * 1000000)
+
+
+def _elapsed_us(start: int) -> int:
+    if hasattr(time, "ticks_diff"):
+        return time.ticks_diff(_now_us(), start)
+    return _now_us() - start
+
+
+def _satellite():
+    s = Satellite(1, myconn=FakeUART(verbose=False), new_msg_callback=lambda a, m: None)
+    s.swriter = _NullWriter()
+    return s
+
+
+# Each bench_* sets up what it needs and returns an async run(n) doing n ops and returning
+# the units done, so construction isn't part of the rate or the allocations measured.
+def bench_validate_msg():
+    s = _satellite()
+
+    async def run(n):
+        for i in range(n):
+            s._validate_msg(_LINES[i & 3])
+        return n
+    return run
+
+
+def bench_checksum():
+    s = _satellite()
+
+    async def run(n):
+        for i in range(n):
+            s._checksum(_LINES[i & 3])
+        return n
+    return run
+
+
+def bench_send_command():
+    s = _satellite()
+
+    async def run(n):
+        for _ in range(n):
+            await s.send_command("$TD AI=42,48656c6c6f20776f726c64")
+        return n
+    return run
+
+
+def bench_dispatch():
+    s = _satellite()
+    msgs = [s._validate_msg(line) for line in _LINES]
+
+    async def run(n):
+        for i in range(n):
+            await s._line_handle_validated(msgs[i & 3])
+        return n
+    return run
+
+
+def bench_rx_reassembly():
+    """Bytes/sec through the BLE RX ring, 100 byte frames in 20 byte writes."""
+    r = Reassembler(1024)
+    frame = (100).to_bytes(4, "little") + bytes(100)
+    writes = [frame[i:i + 20] for i in range(0, len(frame), 20)]
+
+    async def run(n):
+        for _ in range(n):
+            for w in writes:
+                r.feed(w)
+            while r.peek() is not None:
+                r.release()
+        return n * len(frame)
+    return run
+
+
+def bench_send_chunking():
+    """Bytes/sec queued and notified for 200 byte msgs at a 64 byte MTU."""
+    f = FakeBLE()
+    b = UARTBluetooth("bench", ble=f)
+    b.connected = True
+    b.mtu = 64
+    data = bytes(200)
+
+    async def run(n):
+        for _ in range(n):
+            b.send(data)
+            await b._notify_frame()
+            f.notified.clear()
+        return n * len(data)
+    return run
+
+
+BENCHES = (
+    ("validate_msg", 2000, "lines/s", bench_validate_msg),
+    ("checksum", 2000, "lines/s", bench_checksum),
+    ("send_command", 1000, "cmds/s", bench_send_command),
+    ("dispatch", 1000, "msgs/s", bench_dispatch),
+    ("rx_reassembly", 500, "bytes/s", bench_rx_reassembly),
+    ("send_chunking", 500, "bytes/s", bench_send_chunking),
+)
+
+
+def _allocated(op, n) -> int:
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.mem_alloc()
+        uasyncio.run(op(n))
+        return gc.mem_alloc() - before
+    finally:
+        gc.enable()
+
+
+def _alloc_per_op(setup):
+    """Bytes allocated per op, past the setup, a warm up op and uasyncio.run itself."""
+    if not hasattr(gc, "mem_alloc"):
+        return None
+    op = setup()
+    uasyncio.run(op(1))
+    overhead = _allocated(op, 0)
+    return max(0, _allocated(op, _ALLOC_OPS) - overhead) // _ALLOC_OPS
+
+
+def run():
+    """Run every benchmark, returns [(name, rate, unit, alloc_per_op)]."""
+    results = []
+    for name, n, unit, setup in BENCHES:
+        op = setup()
+        gc.collect()
+        start = _now_us()
+        units = uasyncio.run(op(n))
+        us = max(_elapsed_us(start), 1)
+        results.append((name, units * 1000000 // us, unit, _alloc_per_op(setup)))
+    return results
+
+
+def format_results(results) -> str:
+    lines = [f"# impl {sys.implementation.name}"]
+    for name, rate, unit, alloc in results:
+        lines.append(f"{name} {rate} {unit} {'-' if alloc is None else alloc}")
+    return "\n".join(lines) + "\n"
+
+
+def parse_results(text: str):
+    """Returns (impl, {name: (rate, alloc)})."""
+    impl = None
+    results = {}
+    for line in text.split("\n"):
+        parts = line.split()
+        if len(parts) == 0:
+            continue
+        if parts[0] == "#":
+            if len(parts) == 3 and parts[1] == "impl":
+                impl = parts[2]
+            continue
+        results[parts[0]] = (int(parts[1]), None if parts[3] == "-" else int(parts[3]))
+    return (impl, results)
+
+
+def compare(results, baseline_text: str, tolerance=_DEFAULT_TOLERANCE):
+    """Returns a list of regression descriptions."""
+    impl, baseline = parse_results(baseline_text)
+    same_impl = impl == sys.implementation.name
+    regressions = []
+    for name, rate, unit, alloc in results:
+        base = baseline.get(name)
+        if base is None:
+            continue
+        base_rate, base_alloc = base
+        if same_impl and rate * 100 < base_rate * (100 - tolerance):
+            regressions.append(f"{name} {rate} {unit} vs baseline {base_rate}")
+        if alloc is not None and base_alloc is not None and alloc > base_alloc:
+            regressions.append(f"{name} allocates {alloc} bytes/op vs baseline {base_alloc}")
+    return regressions
+
+
+def main(argv):
+    out = None
+    baseline = None
+    update = False
+    tolerance = _DEFAULT_TOLERANCE
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg == "--out":
+            i += 1
+            out = argv[i]
+        elif arg == "--baseline":
+            i += 1
+            baseline = argv[i]
+        elif arg == "--tolerance":
+            i += 1
+            tolerance = int(argv[i])
+        elif arg == "--update":
+            update = True
+        else:
+            print(f"Unknown argument {arg}")
+            return 2
+        i += 1
+    # Logging isn't what's being measured.
+    log.set_level("*", log.OFF)
+    results = run()
+    text = format_results(results)
+    print(text, end="")
+    if out is not None:
+        with open(out, "w") as f:
+            f.write(text)
+    if baseline is None:
+        return 0
+    if update:
+        with open(baseline, "w") as f:
+            f.write(text)
+        print(f"Updated baseline {baseline}")
+        return 0
+    try:
+        with open(baseline) as f:
+            baseline_text = f.read()
+    except OSError:
+        print(f"No baseline at {baseline}, run with --update to store one.")
+        return 1
+    regressions = compare(results, baseline_text, tolerance)
+    for r in regressions:
+        print(f"REGRESSION {r}")
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,67 @@
+import binascii
+import struct
+from micropython import const
+
+# Binary framing for the phone link, negotiated with the text 'B' command.
+# Each frame (inside the usual 4 byte length prefix) is:
+#   opcode (u8), request id (u16), app id (u16), payload (raw bytes)
+# Opcodes are below 0x20 so they can't be confused with the text commands.
+VERSION = const(1)
+HEADER = "<BHH"
+HEADER_LEN = const(5)
+
+# Phone -> device
+OP_SEND_MSG = const(0x01)  # payload: raw msg bytes
+OP_SET_PHONE_ID = const(0x02)  # payload: phone id
+OP_GET_PHONE_ID = const(0x03)
+OP_GET_DEVICE_ID = const(0x04)
+OP_ACK_MSGS = const(0x05)  # payload: u32 seq
+OP_GET_STATS = const(0x06)
+
+# Device -> phone, replies carry the request id they answer.
+OP_OK = const(0x10)
+OP_QUEUED = const(0x11)  # payload: u32 ticket, u16 position
+OP_MSGID = const(0x12)  # payload: u64 modem msg id
+OP_PHONE_ID = const(0x13)  # payload: phone id
+OP_DEVICE_ID = const(0x14)  # payload: device id
+OP_FULL = const(0x15)
+OP_STATS = const(0x16)  # payload: utf8 metrics snapshot
+OP_ERROR = const(0x1F)  # payload: utf8 error
+# Device -> phone, unsolicited (request id 0).
+OP_MSG = const(0x18)  # payload: u32 seq, raw msg bytes
+OP_SENT = const(0x19)  # payload: u64 modem msg id
+OP_READY = const(0x1A)
+
+
+def is_binary(first_byte: int) -> bool:
+    return first_byte < 0x20
+
+
+def encode(opcode: int, req_id=0, app_id=0, payload=b"") -> bytes:
+    """Build a frame, payload may be bytes or str."""
+    if isinstance(payload, str):
+        payload = payload.encode()
+    return struct.pack(HEADER, opcode, req_id, app_id) + payload
+
+
+def decode(view):
+    """Split a frame into (opcode, req_id, app_id, payload view)."""
+    opcode, req_id, app_id = struct.unpack_from(HEADER, view, 0)
+    return (opcode, req_id, app_id, view[HEADER_LEN:])
+
+
+def pack_msg_id(msg_id) -> bytes:
+    """Modem msg ids are decimal, send them as a u64."""
+    return struct.pack("<Q", int(msg_id))
+
+
+def from_hex(data: str) -> bytes:
+    """Modem payloads are hex, fall back to the raw text if they aren't."""
+    try:
+        return binascii.unhexlify(data)
+    except Exception:
+        return data.encode()
+
+
+def to_hex(data) -> str:
+    return str(binascii.hexlify(data), "utf8")
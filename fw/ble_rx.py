@@ -0,0 +1,131 @@
+from micropython import const
+
+_LEN_BYTES = const(4)
+_MAX_FRAMES = const(8)
+
+
+class Reassembler():
+    """Rebuilds length prefixed frames from BLE writes in a ring buffer.
+
+    Each frame is a 4 byte little endian length followed by the payload, either may be
+    split across writes and several frames may arrive in one write. Completed frames are
+    kept contiguous in the ring (wrapping to the start when needed) and queued until the
+    handler releases them. feed runs in the BLE IRQ while peek/release run in the
+    handler, so the queue uses separate produced/consumed counters and doesn't allocate.
+    """
+
+    def __init__(self, size=1024, max_frames=_MAX_FRAMES):
+        self.buf = bytearray(size)
+        self.mv = memoryview(self.buf)
+        self.max_frames = max_frames
+        self._starts = [0] * max_frames
+        self._lens = [0] * max_frames
+        # Only feed touches _produced and only release touches _consumed.
+        self._produced = 0
+        self._consumed = 0
+        # In progress frame.
+        self._write = 0
+        self._fill = 0
+        self._target = -1
+        self._hdr = 0
+        self._hdr_bytes = 0
+        # Bytes left of an oversized / dropped frame.
+        self._discard = 0
+        self.frames = 0
+        self.errors = 0
+        self.dropped = 0
+
+    def pending(self) -> int:
+        """Completed frames waiting for the handler."""
+        return self._produced - self._consumed
+
+    def feed(self, data) -> int:
+        """Consume a BLE write, returns the number of frames it completed."""
+        buf = self.buf
+        n = len(data)
+        i = 0
+        done = 0
+        while i < n:
+            if self._discard > 0:
+                skip = min(self._discard, n - i)
+                self._discard -= skip
+                i += skip
+                continue
+            if self._target < 0:
+                self._hdr |= data[i] << (8 * self._hdr_bytes)
+                self._hdr_bytes += 1
+                i += 1
+                if self._hdr_bytes == _LEN_BYTES:
+                    self._start_frame(self._hdr)
+                    self._hdr = 0
+                    self._hdr_bytes = 0
+                    if self._target == 0:
+                        done += self._complete()
+                continue
+            take = min(self._target - self._fill, n - i)
+            pos = self._write + self._fill
+            for j in range(take):
+                buf[pos + j] = data[i + j]
+            i += take
+            self._fill += take
+            if self._fill == self._target:
+                done += self._complete()
+        return done
+
+    def _start_frame(self, length: int):
+        size = len(self.buf)
+        if length > size:
+            self.errors += 1
+            self._discard = length
+            return
+        count = self._produced - self._consumed
+        if count >= self.max_frames:
+            self.dropped += 1
+            self._discard = length
+            return
+        start = -1
+        if count == 0:
+            start = 0
+        else:
+            head = self._starts[self._consumed % self.max_frames]
+            last = (self._produced - 1) % self.max_frames
+            tail = self._starts[last] + self._lens[last]
+            # Frames are placed in order, so the newest starting before the oldest means
+            # the ring has wrapped (and tail == head is then full, not empty).
+            if self._starts[last] >= head:
+                # Free space is [tail, size) and [0, head)
+                if size - tail >= length:
+                    start = tail
+                elif head >= length:
+                    start = 0
+            elif head - tail >= length:
+                start = tail
+        if start < 0:
+            self.dropped += 1
+            self._discard = length
+            return
+        self._write = start
+        self._fill = 0
+        self._target = length
+
+    def _complete(self) -> int:
+        slot = self._produced % self.max_frames
+        self._starts[slot] = self._write
+        self._lens[slot] = self._target
+        self._target = -1
+        self.frames += 1
+        self._produced += 1
+        return 1
+
+    def peek(self):
+        """A view of the oldest completed frame, or None. Valid until release."""
+        if self._produced == self._consumed:
+            return None
+        slot = self._consumed % self.max_frames
+        start = self._starts[slot]
+        return self.mv[start:start + self._lens[slot]]
+
+    def release(self):
+        """Free the oldest completed frame."""
+        if self._produced != self._consumed:
+            self._consumed += 1
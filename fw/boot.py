@@ -1,5 +1,16 @@
 from UARTBluetooth import UARTBluetooth
 from Satellite import Satellite
+from outbox import Outbox
+from inbox import Inbox
+from payload import PayloadCodec
+import governor
+from power import PowerManager
+from passes import PassPredictor
+from config import Config
+from firmware import FirmwareStore
+from serial_bridge import SerialBridge
+import log
+import metrics
 import uasyncio
 import machine
 from machine import Pin, SoftI2C
@@ -7,41 +18,32 @@ import ssd1306
 import micropython
 import time
 import os
-import select
-import sys
 
 
-go_slow = False
+_log = log.logger("boot")
+# Boot phases, ms since reset. Also see sat.boot_ms for when the modem finished booting.
+_G_ADVERTISING = metrics.gauge("boot.advertising_ms")
+_G_SETUP = metrics.gauge("boot.setup_ms")
+_G_READY = metrics.gauge("boot.ready_ms")
+# Units are power cycled to save battery, so production boots skip waiting for a
+# debugger to attach and other debug only setup.
+fast_boot = True
+# Look for an SSD1306 (in the background, after boot).
+probe_display = False
+
 micropython.alloc_emergency_exception_buf(200)
 print("Allocated buffer for ISR failure.")
-time.sleep(1)
-print("Waiting to allow debugger to attach....")
-time.sleep(1)
-print("Continuing pandas :D")
-
-
-def find_lowest_freq():
-    lowest = machine.freq()
-    clock_speeds = [20000000, 40000000, 80000000, 1600000000, 2400000000]
-    for x in clock_speeds:
-        try:
-            if x < lowest:
-                machine.freq(x)
-                lowest = x
-        except Exception as e:
-            print(f"We can't run at {x} because {e}")
-            pass  # We don't run at that speed I guess...
-    return lowest
-
-
-if go_slow:
-    print("Finding target machine frequency.")
-    default_freq = machine.freq
+if not fast_boot:
+    time.sleep(1)
+    print("Waiting to allow debugger to attach....")
+    time.sleep(1)
+    print("Continuing pandas :D")
 
-    lowest_freq = find_lowest_freq()
 
-    # Go slow cause YOLO
-    machine.freq(lowest_freq)
+def boot_phase(gauge: int, name: str):
+    ms = time.ticks_ms()
+    metrics.set_gauge(gauge, ms)
+    _log.info("Boot phase %s at %sms", name, ms)
 
 
 # Try and find a display if one is present
@@ -61,73 +63,105 @@ def find_display():
 print("Created globals...")
 global s
 global b
-global phone_id
 
-print("Getting ready to read phone id.")
-phone_id = None
-
-try:
-    print("System directories:")
-    print(os.listdir())
-    if "phone_id" in os.listdir():
-        print("Phone id found.")
-        with open("phone_id", "r") as p:
-            phone_id = p.read()
-            print(f"Loaded phone id {phone_id}")
-    else:
-        print("Phone id not yet stored.")
-except Exception as e:
-    print(f"Error reading phone id: {e}")
+# phone_id, device_id and tunables, one read here and cached after.
+config = Config()
+config.migrate("phone_id", "phone_id")
+uasyncio.create_task(config.run())
 
 
 async def set_phone_id(new_phone_id: str):
-    print("Setting phone id.")
-    global phone_id
-    phone_id = new_phone_id
-    try:
-        with open("phone_id", "w") as p:
-            p.write(phone_id)
-            print(f"Set phone id to {phone_id}")
-    except Exception as e:
-        print(f"Error persisting phone id {e}")
+    _log.info("Setting phone id")
+    config.set("phone_id", new_phone_id)
+    # Written right away, it's what the device is for.
+    config.flush()
     return new_phone_id
 
 
 async def get_phone_id():
-    global phone_id
-    if phone_id is None:
-        try:
-            with open("phone_id", "r") as p:
-                phone_id = p.readline()
-        except Exception as e:
-            print(f"Couldnt read phone id {e}")
-    return phone_id
+    return config.get("phone_id")
 
 
 async def get_device_id():
-    global s
-    print(f"Getting device id on {s}")
-    return await s.device_id()
+    """The modem's id, only asked for ($FV / $CS) the first time."""
+    device_id = config.get("device_id")
+    if device_id is None:
+        device_id = await s.device_id()
+        if device_id is not None:
+            config.set("device_id", device_id)
+    return device_id
+
+
+# Modem firmware uploaded from the phone, see firmware.py. Writing it to the modem ('W')
+# needs the M138's update handshake, which isn't implemented, so 'W' replies an error
+# rather than streaming an image nothing checks the modem took.
+modem_firmware = FirmwareStore(config)
+
+
+def parse_outbound(msg: str):
+    """Split [HD=<secs>,][ET=<epoch>,]app_id,data into (app_id, data, hold, expiry)."""
+    hold = None
+    expiry = None
+    while msg.startswith("HD=") or msg.startswith("ET="):
+        opt, msg = msg.split(",", 1)
+        if opt[0] == "H":
+            hold = int(opt[3:])
+        else:
+            expiry = int(opt[3:])
+    app_id, data = msg.split(",", 1)
+    return (app_id, data, hold, expiry)
+
+
+async def copy_msg_to_sat_modem(app_id, msg: str, raw=False):
+    """Queue a msg from the phone, raw msgs (binary protocol) are just the hex data."""
+    if __debug__:
+        _log.debug("Queueing msg for the sat modem")
+    if config.get("phone_id") is None:
+        raise Exception(f"Device {await get_device_id()} not configured")
+    if raw:
+        data, hold, expiry = msg, None, None
+    else:
+        app_id, data, hold, expiry = parse_outbound(msg)
+    app_id = int(app_id)
+    data = codec.encode(app_id, data)
+    return outbox.put(app_id, data, hold=hold, expiry=expiry)
 
 
-async def copy_msg_to_sat_modem(app_id, msg: str) -> str:
-    global s
-    global phone_id
-    print("Copying message to sat modem.")
-    if phone_id is None:
-        raise Exception(f"Device {await s.device_id()} not configured")
-    app_id, data = msg.split(",")
-    return await s.send_msg(app_id, data)
+def msg_sent(ticket: int, msgid: str):
+    global b
+    b.send_msg_id(ticket, msgid)
 
 
 def msg_acked(msgid: str):
     global b
-    b.send_msg_acked(msgid)
+    # Fragmented msgs are only acked to the phone once every fragment is sent.
+    msgid = outbox.acked(msgid)
+    if msgid is not None:
+        b.send_msg_acked(msgid)
 
 
-def copy_msg_to_ble(msg: str) -> str:
+def copy_msg_to_ble(seq: int, app_id: int, msg: str):
     global b
-    b.send_msg(msg)
+    if not b.connected:
+        raise Exception("No phone connected")
+    return b.send_msg(app_id, msg, seq)
+
+
+def store_msg(app_id: int, msg: str):
+    # Aggregate packets are split back into the msgs they carry.
+    for msg_app_id, data in codec.decode_all(app_id, msg):
+        inbox.put(msg_app_id, data)
+    # Help the phone find us sooner.
+    b.boost_advertising()
+
+
+def ack_msgs(seq: int):
+    inbox.ack(seq)
+
+
+def msgs_acked(seq: int):
+    # The phone has them now, so the modem copies can go.
+    uasyncio.create_task(s.clear_delivered())
 
 
 def copy_error_to_ble(error: str) -> str:
@@ -148,39 +182,52 @@ def done_txing_callback():
 def modem_ready():
     global b
     b.send_ready()
+    if metrics.value("boot.ready_ms") == 0:
+        boot_phase(_G_READY, "ready")
 
 
-display = None
-# display = find_display()
 client_ready = uasyncio.ThreadSafeFlag()
 
 
+# Compresses outbound payloads (and decodes inbound ones) to cut packets sent.
+codec = PayloadCodec()
+# Per app_id compression ratios in the stats ('S').
+metrics.add_source(codec.report)
+
+# Msgs from the satellites are stored on flash until the phone acks them.
+inbox = Inbox(copy_msg_to_ble, acked_callback=msgs_acked)
+
+
 def client_ready_callback(flag: bool):
-    print(f"Called for client ready with flag {flag}")
+    _log.info("Phone client ready %s", flag)
+    inbox.set_connected(flag)
     if flag:
         client_ready.set()
-        print("Set client to ready :)")
-
 
-print("Creating bluetooth and satelite.")
 
+# Full clock while BLE, the modem or the inbox have work, the lowest stable clock
+# otherwise (see governor.py).
 try:
-    b = UARTBluetooth("SpaceBeaver (PCFL LLC)", display, msg_callback=copy_msg_to_sat_modem,
-                      client_ready_callback=client_ready_callback, set_phone_id=set_phone_id,
-                      get_device_id=get_device_id, get_phone_id=get_phone_id)
+    cpu = governor.install(governor.Governor())
+    _log.info("CPU clock %s, governing between %s and %s", cpu.freq, cpu.low, cpu.high)
 except Exception as e:
-    print("BTLE error.")
-    print(f"Couldnt create btle {e}")
+    cpu = None
+    print(f"Couldn't start the CPU governor {e}")
+
+# Learns when satellites pass over, so sends and sleeps can follow them.
+passes = PassPredictor()
 
 print("Creating satellite connection.")
 try:
     global s
     s = Satellite(uart_id=1,
                   # Testing hack
-                  new_msg_callback=copy_msg_to_ble, msg_acked_callback=msg_acked,
+                  new_msg_callback=store_msg, msg_acked_callback=msg_acked,
                   error_callback=copy_error_to_ble, txing_callback=txing_callback,
                   done_txing_callback=done_txing_callback, ready_callback=modem_ready,
                   client_ready=client_ready,
+                  delete_on_read=False,
+                  passes=passes,
                   uart_tx=19,
                   uart_rx=18)
     print(f"Set sat device to {s}")
@@ -192,46 +239,94 @@ except Exception as e:
 print("Hi!")
 print("Running!")
 
+# Start the modem's boot handshake before BLE, the BLE stack takes a while to come up
+# and the modem boots in parallel with it.
 try:
     s.start()
 except Exception as e:
     print(f"Couldnt start satelite comm {e}")
 
+print("Creating bluetooth.")
+
+try:
+    b = UARTBluetooth("SpaceBeaver (PCFL LLC)", None, msg_callback=copy_msg_to_sat_modem,
+                      client_ready_callback=client_ready_callback, set_phone_id=set_phone_id,
+                      get_device_id=get_device_id, get_phone_id=get_phone_id,
+                      ack_msgs=ack_msgs, firmware=modem_firmware)
+    boot_phase(_G_ADVERTISING, "advertising")
+except Exception as e:
+    print("BTLE error.")
+    print(f"Couldnt create btle {e}")
+
+
+def modem_ready_to_send() -> bool:
+    # Msgs wait in the outbox until a pass is predicted, rather than in the modem.
+    return s.is_ready() and passes.in_window()
 
-start_magic = "MODEM"
-end_magic = "TIMBITLOVESYOU"
-max_buff = 100
-
-
-# See the discussion in https://github.com/micropython/micropython/issues/6415
-async def always_busy():
-    # poll interface to see if we've got anything from the serial port to handle.
-    poll = select.poll()
-    poll.register(sys.stdin, select.POLLIN)
-    buff = ""
-    while True:
-        c = poll.poll(1)
-        print(f"Looping in always busy -- checking for any cmd buffer is {c}")
-        # Pass serial port commands along to the modem iff they have the right magic
-        while len(c) > 0:
-            buff += sys.stdin.read(1)
-            c = poll.poll(1)
-            print(f"stdin buffer: {buff}")
-            if len(buff) > len(start_magic):
-                buff = buff[1:len(start_magic)]
-                print(f"truncated to {buff}")
-            if buff == start_magic:
-                buff = ""
-                async with s.lock:
-                    while not buff.endswith(end_magic):
-                        buff += sys.stdin.read(1)
-                        if len(buff) > max_buff:
-                            s.send_raw(buff[:-len(end_magic)])
-                            buff = buff[-len(end_magic):]
-        await uasyncio.sleep(10)
-
-uasyncio.create_task(always_busy())
 
+# Phone msgs are queued (and journaled) until the modem takes them. With outbox.aggregate_ms
+# set small msgs are held for up to that long so several can share one packet, off by
+# default since it delays every small msg.
+outbox = Outbox(s.send_msg, ready=modem_ready_to_send, sent_callback=msg_sent,
+                error_callback=copy_error_to_ble,
+                aggregate_ms=config.get("outbox.aggregate_ms", 0))
+uasyncio.create_task(outbox.run())
+uasyncio.create_task(inbox.run())
+
+# ESP32 GPIO wired to the M138's GPIO1 (high while msgs are waiting), it depends on the
+# board so it's the power.modem_gpio1 setting, without it the modem wakes on timers only.
+modem_gpio1 = config.get("power.modem_gpio1")
+
+
+def device_idle() -> bool:
+    return not b.connected and (len(outbox) == 0 or not passes.in_window())
+
+
+# Sleep the modem & light sleep the ESP32 while no phone is connected (see power.py).
+try:
+    rx_pin = None
+    if modem_gpio1 is not None:
+        rx_pin = Pin(modem_gpio1, Pin.IN)
+        rx_pin.irq(trigger=Pin.WAKE_HIGH, wake=machine.SLEEP)
+    power = PowerManager(s, device_idle, rx_pin=rx_pin, lightsleep=machine.lightsleep,
+                         passes=passes, advertiser=b.advertiser,
+                         listen_s=config.get("power.listen_s", 300),
+                         modem_sleep_s=config.get("power.modem_sleep_s", 900),
+                         latency_ms=config.get("power.latency_ms", 1000))
+    uasyncio.create_task(power.run())
+except Exception as e:
+    print(f"Couldn't start power management {e}")
+
+
+# Modem commands over USB serial (MODEM...TIMBITLOVESYOU), see serial_bridge.py.
+bridge = SerialBridge(s)
+uasyncio.create_task(bridge.run())
+
+
+async def deferred_setup():
+    """Setup nothing on the way to READY needs, run once the event loop is going."""
+    if probe_display:
+        try:
+            oled = find_display()
+            if oled is not None:
+                b.display.attach(oled)
+        except Exception as e:
+            print(f"Error {e} looking for a display.")
+    if not fast_boot:
+        print("System directories:")
+        print(os.listdir())
+
+
+uasyncio.create_task(deferred_setup())
+if cpu is not None:
+    uasyncio.create_task(cpu.run())
+# Buffered log lines are formatted & printed from here, never from IRQs.
+uasyncio.create_task(log.drain())
+# Counters carry over soft resets in RTC memory.
+metrics.restore()
+uasyncio.create_task(metrics.run())
+
+boot_phase(_G_SETUP, "setup")
 while True:
     try:
         print("Starting event loop...")
@@ -240,4 +335,5 @@ while True:
         print("Event loop complete?")
         time.sleep(5)
     except Exception as e:
+        log.flush()
         print(f"Error {e} running event loop.")
@@ -0,0 +1,98 @@
+import json
+import os
+import uasyncio
+from micropython import const
+import log
+import metrics
+
+# Settings kept on flash: the phone id, the modem's device id & firmware and tunables.
+#
+# Everything is one JSON file read once at startup, reads come from RAM. Writes are
+# debounced (a burst of sets is one flash write) and atomic: the new file is written
+# next to the old one and renamed over it, so a reset mid write leaves the old settings.
+_log = log.logger("config")
+_M_SAVES = metrics.counter("config.saves")
+
+_DEFAULT_DELAY_MS = const(2000)
+
+
+class Config():
+    """Cached key value store. get/set never touch flash, run (or flush) saves."""
+
+    def __init__(self, path="config", delay_ms=_DEFAULT_DELAY_MS):
+        self.path = path
+        self.delay_ms = delay_ms
+        self._values = {}
+        self.dirty = False
+        self.saves = 0
+        self._flag = uasyncio.ThreadSafeFlag()
+        self._load()
+
+    def _load(self):
+        # A reset between removing the old file and the rename (filesystems which
+        # can't rename over a file) leaves only the new one.
+        for path in (self.path, self.path + ".tmp"):
+            try:
+                with open(path, "r") as f:
+                    self._values = json.loads(f.read())
+                return
+            except OSError:
+                pass
+            except Exception as e:
+                _log.error("Error %s reading %s", e, path)
+
+    def get(self, key: str, default=None):
+        return self._values.get(key, default)
+
+    def set(self, key: str, value):
+        """Set key (None deletes it), saved within delay_ms."""
+        if self._values.get(key) == value:
+            return
+        if value is None:
+            del self._values[key]
+        else:
+            self._values[key] = value
+        self.dirty = True
+        self._flag.set()
+
+    def migrate(self, key: str, path: str):
+        """Import key from an older one value file, which is then removed."""
+        if key in self._values:
+            return
+        try:
+            with open(path, "r") as f:
+                value = f.read().strip()
+        except OSError:
+            return
+        if len(value) > 0:
+            self.set(key, value)
+            self.flush()
+        try:
+            os.remove(path)
+        except OSError as e:
+            _log.error("Error %s removing %s", e, path)
+
+    def flush(self):
+        """Save now if anything changed."""
+        if not self.dirty:
+            return
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                f.write(json.dumps(self._values))
+            try:
+                os.rename(tmp, self.path)
+            except OSError:
+                os.remove(self.path)
+                os.rename(tmp, self.path)
+            self.dirty = False
+            self.saves += 1
+            metrics.inc(_M_SAVES)
+        except Exception as e:
+            _log.error("Error %s saving config", e)
+
+    async def run(self):
+        while True:
+            await self._flag.wait()
+            await uasyncio.sleep_ms(self.delay_ms)
+            self.flush()
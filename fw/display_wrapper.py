@@ -1,30 +1,132 @@
-import micropython
+import uasyncio
+from micropython import const
+import log
+import metrics
+
+# Text rows line up with the SSD1306's 8 pixel pages so a changed row is one page to
+# send. Row 0 is the status line, split into fields, the rest is the body.
+_log = log.logger("display")
+_M_RENDERS = metrics.counter("display.renders")
+_M_PAGES = metrics.counter("display.pages")
+_M_COALESCED = metrics.counter("display.coalesced")
+
+_ROW_PX = const(8)
+_CHAR_PX = const(8)
+_STATUS_FIELDS = const(2)
+# Writes this close together are drawn once (e.g. "Connected!" then a command status).
+_COALESCE_MS = const(50)
+# SSD1306 commands.
+_SET_COL_ADDR = const(0x21)
+_SET_PAGE_ADDR = const(0x22)
 
 
 class DisplayWrapper():
-    def __init__(self, display=None):
+    """Status display. write and status (both safe from IRQs) only record the latest
+    text, the render task draws it: only the last of back to back writes is drawn and
+    only rows which changed are redrawn and sent to the display."""
+
+    def __init__(self, display=None, width=128, height=64):
         self.display = display
-        # Make a wrapper so as to avoid alloc.
-        self._write_ref = self.write
-        self._do_write_ref = self.do_write
-        self.length = 15
-        self.space = 10
+        self.width = width
+        self.rows = height // _ROW_PX
+        self.length = width // _CHAR_PX
+        self._body = ""
+        self._fields = [""] * _STATUS_FIELDS
+        # What's on screen by row.
+        self._lines = [""] * self.rows
+        self._flag = uasyncio.ThreadSafeFlag()
+        self._pending = False
+        self.renders = 0
+        self.pages_sent = 0
+        self.coalesced = 0
+        self.task = None
+        if display is not None:
+            self.task = uasyncio.create_task(self.run())
+
+    def attach(self, display):
+        """Start drawing on display, e.g. once it's been found after boot."""
+        self.display = display
+        self._lines = [""] * self.rows
+        if self.task is None:
+            self.task = uasyncio.create_task(self.run())
+        self._changed()
+
+    def _changed(self):
+        if self._pending:
+            self.coalesced += 1
+            metrics.inc(_M_COALESCED)
+        self._pending = True
+        self._flag.set()
 
     def write(self, txt):
+        """Replace the body text, wrapped over the rows below the status line."""
+        self._body = txt
         if self.display is None:
-            print("No display, skipping")
-            print(txt)
+            _log.info("%s", txt)
             return
-        else:
-            print("Scheduling display update")
-            micropython.schedule(self._do_write_ref, txt)
-
-    def do_write(self, txt):
-        print("Doing write for:")
-        print(txt)
-        self.display.fill(0)
-        i = 0
-        while i < len(txt):
-            self.display.text(txt[i:(i + self.length)], 0, int((i * self.space / self.length)))
-            i = i + self.length
-        self.display.show()
+        self._changed()
+
+    def status(self, field: int, txt):
+        """Set one field of the status line, e.g. a connection state or a counter."""
+        self._fields[field] = txt
+        if self.display is not None:
+            self._changed()
+
+    def _layout(self):
+        w = self.length // _STATUS_FIELDS
+        lines = ["".join([f[:w] + " " * (w - len(f[:w])) for f in self._fields]).rstrip()]
+        body = self._body
+        for r in range(1, self.rows):
+            i = (r - 1) * self.length
+            lines.append(body[i:i + self.length])
+        return lines
+
+    def render(self):
+        """Draw the latest text, sending only the pages which changed."""
+        self._pending = False
+        lines = self._layout()
+        d = self.display
+        first = -1
+        last = -1
+        for r in range(self.rows):
+            if lines[r] == self._lines[r]:
+                continue
+            d.fill_rect(0, r * _ROW_PX, self.width, _ROW_PX, 0)
+            d.text(lines[r], 0, r * _ROW_PX)
+            self._lines[r] = lines[r]
+            if first < 0:
+                first = r
+            last = r
+        if first < 0:
+            return 0
+        self.renders += 1
+        metrics.inc(_M_RENDERS)
+        pages = last - first + 1
+        self._show(first, last)
+        self.pages_sent += pages
+        metrics.inc(_M_PAGES, pages)
+        return pages
+
+    def _show(self, first: int, last: int):
+        """Send pages first..last, the whole frame for displays without the SSD1306's
+        addressing commands."""
+        d = self.display
+        if not hasattr(d, "write_cmd") or not hasattr(d, "buffer"):
+            d.show()
+            return
+        d.write_cmd(_SET_COL_ADDR)
+        d.write_cmd(0)
+        d.write_cmd(self.width - 1)
+        d.write_cmd(_SET_PAGE_ADDR)
+        d.write_cmd(first)
+        d.write_cmd(last)
+        d.write_data(memoryview(d.buffer)[first * self.width:(last + 1) * self.width])
+
+    async def run(self):
+        while True:
+            await self._flag.wait()
+            await uasyncio.sleep_ms(_COALESCE_MS)
+            try:
+                self.render()
+            except Exception as e:
+                _log.error("Error %s updating the display", e)
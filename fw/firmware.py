@@ -0,0 +1,144 @@
+import binascii
+import hashlib
+import os
+import time
+from micropython import const
+import log
+import metrics
+
+# Modem firmware uploaded from the phone ('F') to be written to the modem ('W').
+#
+# Chunks go straight to a file on flash as they arrive with a running sha256, nothing
+# holds the whole image. The image's size, hash and version are kept in the Config so
+# an upload which stopped (a BLE drop, or a reset) resumes from what's on flash.
+_log = log.logger("fw")
+_M_UPLOAD_BYTES = metrics.counter("fw.upload_bytes")
+
+# Read size when re-hashing after a reset.
+_REHASH_CHUNK = const(512)
+
+
+def is_newer(version: str, current: str) -> bool:
+    """True if version (as $FV reports it, e.g. 2021-07-16T00:28:00,v1.1.0) is newer than
+    current, or current is unknown. The build time leads so comparing strings works."""
+    return current is None or version > current
+
+
+def rate(count: int, start_ms: int) -> int:
+    """Bytes per second for count bytes since start_ms."""
+    return count * 1000 // max(1, time.ticks_diff(time.ticks_ms(), start_ms))
+
+
+class FirmwareStore():
+    """The uploaded image at path. config is a Config for the image's details."""
+
+    def __init__(self, config, path="modem_fw"):
+        self.config = config
+        self.path = path
+        self.size = config.get("fw.size")
+        self.sha256 = config.get("fw.sha256")
+        self.version = config.get("fw.version")
+        self.verified = config.get("fw.ok", False)
+        self.offset = 0
+        # Hash of the image up to offset, None until an upload (re)starts.
+        self._hash = None
+        self._file = None
+        self._start_ms = time.ticks_ms()
+        self._start_offset = 0
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _rehash(self):
+        """Hash what's on flash, bounded reads so the image is never all in RAM."""
+        self._hash = hashlib.sha256()
+        self.offset = 0
+        buf = bytearray(_REHASH_CHUNK)
+        mv = memoryview(buf)
+        try:
+            with open(self.path, "rb") as f:
+                while self.offset < self.size:
+                    n = f.readinto(buf)
+                    if not n:
+                        break
+                    n = min(n, self.size - self.offset)
+                    self._hash.update(mv[:n])
+                    self.offset += n
+        except OSError:
+            pass
+
+    def begin(self, size: int, sha256: str, version: str) -> int:
+        """Start (or resume) uploading an image, returns the offset to send from."""
+        self._close()
+        if size != self.size or sha256 != self.sha256 or version != self.version:
+            with open(self.path, "wb"):
+                pass
+            self.size = size
+            self.sha256 = sha256
+            self.version = version
+            self.verified = False
+            self.offset = 0
+            self._hash = hashlib.sha256()
+            self.config.set("fw.size", size)
+            self.config.set("fw.sha256", sha256)
+            self.config.set("fw.version", version)
+            self.config.set("fw.ok", None)
+        elif self.verified:
+            self.offset = size
+        elif self._hash is None:
+            self._rehash()
+        self._start_ms = time.ticks_ms()
+        self._start_offset = self.offset
+        _log.info("Firmware %s upload from %s of %s", version, self.offset, size)
+        return self.offset
+
+    def write(self, offset: int, data) -> int:
+        """Append data if it's at offset, returns the offset the next chunk should be at
+        (the current one for out of order chunks, e.g. repeats after a resume)."""
+        if self.verified:
+            return self.offset
+        if self._hash is None:
+            raise ValueError("No firmware upload started")
+        if offset != self.offset:
+            return self.offset
+        if offset + len(data) > self.size:
+            raise ValueError("Firmware chunk past the end of the image")
+        try:
+            if self._file is None:
+                self._file = open(self.path, "ab")
+            self._file.write(data)
+        except Exception:
+            # Unknown how much made it, start over from what's on flash.
+            self._close()
+            self._hash = None
+            raise
+        self._hash.update(data)
+        self.offset += len(data)
+        metrics.inc(_M_UPLOAD_BYTES, len(data))
+        if self.offset == self.size:
+            self._finish()
+        return self.offset
+
+    def _finish(self):
+        self._close()
+        digest = binascii.hexlify(self._hash.digest()).decode()
+        self._hash = None
+        if digest == self.sha256.lower():
+            self.verified = True
+            self.config.set("fw.ok", True)
+            _log.info("Firmware %s uploaded", self.version)
+            return
+        _log.error("Firmware hash %s, expected %s", digest, self.sha256)
+        self.size = None
+        self.offset = 0
+        self.config.set("fw.size", None)
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def rate(self) -> int:
+        """Upload speed in bytes per second since begin."""
+        return rate(self.offset - self._start_offset, self._start_ms)
@@ -0,0 +1,164 @@
+import time
+import uasyncio
+from micropython import const
+import log
+import metrics
+
+# Activity driven CPU clock.
+#
+# Modules signal work with governor.busy() (cheap & IRQ safe, a no-op until a Governor
+# is installed). The clock goes up as soon as work is signalled and only comes back
+# down once nothing has signalled for idle_ms, so a burst of BLE writes or modem lines
+# runs at full speed without flapping between clocks on every line.
+_log = log.logger("cpu")
+_M_BOOSTS = metrics.counter("cpu.boosts")
+_M_LOW_MS = metrics.counter("cpu.low_ms")
+_M_HIGH_MS = metrics.counter("cpu.high_ms")
+_G_MHZ = metrics.gauge("cpu.mhz")
+
+# Clocks to probe, machine.freq rejects the ones a chip can't do (the C3 does 80 & 160).
+CANDIDATES = (20000000, 40000000, 80000000, 160000000, 240000000)
+# Below 80MHz the CPU runs from the crystal and the radio (and so BLE) stops working.
+_DEFAULT_MIN_FREQ = 80000000
+_DEFAULT_IDLE_MS = const(2000)
+# How often time at the low clock is added to the metrics while idle.
+_ACCOUNT_MS = const(30000)
+
+
+def probe(freq=None, candidates=CANDIDATES, min_freq=_DEFAULT_MIN_FREQ) -> list:
+    """The candidate clocks (>= min_freq) this chip accepts, ascending. Leaves the clock
+    where it was."""
+    if freq is None:
+        import machine
+        freq = machine.freq
+    current = freq()
+    supported = []
+    for f in candidates:
+        if f < min_freq:
+            continue
+        try:
+            freq(f)
+            supported.append(f)
+        except Exception as e:
+            _log.debug("Can't run at %s: %s", f, e)
+    freq(current)
+    if current not in supported:
+        supported.append(current)
+        supported.sort()
+    return supported
+
+
+class Governor():
+    """Switches between the lowest and highest supported clocks.
+
+    freq is machine.freq (or a stand in for tests), freqs the supported clocks from
+    probe. Time spent at each clock is kept in time_ms and the cpu.* metrics.
+    """
+
+    def __init__(self, freq=None, freqs=None, idle_ms=_DEFAULT_IDLE_MS):
+        if freq is None:
+            import machine
+            freq = machine.freq
+        if freqs is None:
+            freqs = probe(freq)
+        self._freq = freq
+        self.low = freqs[0]
+        self.high = freqs[-1]
+        self.idle_ms = idle_ms
+        self.freq = freq()
+        self.time_ms = {}
+        for f in freqs:
+            self.time_ms[f] = 0
+        self.time_ms[self.freq] = 0
+        self.boosts = 0
+        now = time.ticks_ms()
+        self._last_busy = now
+        self._since = now
+        self._flag = uasyncio.ThreadSafeFlag()
+        metrics.set_gauge(_G_MHZ, self.freq // 1000000)
+
+    def busy(self):
+        """Work is queued, run at full speed. Safe to call from IRQs."""
+        self._last_busy = time.ticks_ms()
+        if self.freq != self.high:
+            self._flag.set()
+
+    def quiet_ms(self) -> int:
+        """ms since work was last signalled."""
+        return time.ticks_diff(time.ticks_ms(), self._last_busy)
+
+    def _account(self):
+        now = time.ticks_ms()
+        ms = time.ticks_diff(now, self._since)
+        self._since = now
+        self.time_ms[self.freq] += ms
+        metrics.inc(_M_HIGH_MS if self.freq == self.high else _M_LOW_MS, ms)
+
+    def _set(self, f: int) -> bool:
+        if f == self.freq:
+            return True
+        self._account()
+        try:
+            self._freq(f)
+        except Exception as e:
+            _log.error("Error %s setting the clock to %s", e, f)
+            return False
+        self.freq = f
+        metrics.set_gauge(_G_MHZ, f // 1000000)
+        if f == self.high:
+            self.boosts += 1
+            metrics.inc(_M_BOOSTS)
+        if __debug__:
+            _log.debug("Clock now %s", f)
+        return True
+
+    def report(self) -> str:
+        """Seconds spent at each clock, e.g. "80MHz=120s 160MHz=15s"."""
+        self._account()
+        parts = []
+        for f in sorted(self.time_ms):
+            parts.append(f"{f // 1000000}MHz={self.time_ms[f] // 1000}s")
+        return " ".join(parts)
+
+    async def run(self):
+        if self.low == self.high:
+            return
+        while True:
+            if self.freq == self.high:
+                idle = self.quiet_ms()
+                if idle < self.idle_ms:
+                    await uasyncio.sleep_ms(self.idle_ms - idle)
+                elif not self._set(self.low):
+                    await uasyncio.sleep_ms(self.idle_ms)
+                continue
+            try:
+                await uasyncio.wait_for_ms(self._flag.wait(), _ACCOUNT_MS)
+            except uasyncio.TimeoutError:
+                self._account()
+                continue
+            if self.quiet_ms() < self.idle_ms:
+                self._set(self.high)
+
+
+_governor = None
+
+
+def install(governor: Governor) -> Governor:
+    """Make governor the one busy() signals."""
+    global _governor
+    _governor = governor
+    return governor
+
+
+def busy():
+    g = _governor
+    if g is not None:
+        g.busy()
+
+
+def quiet_ms():
+    """ms since work was last signalled, None without a governor."""
+    g = _governor
+    if g is None:
+        return None
+    return g.quiet_ms()
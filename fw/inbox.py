@@ -0,0 +1,194 @@
+import os
+import struct
+import uasyncio
+from micropython import const
+import log
+
+_log = log.logger("inbox")
+# kind, seq, app_id, length
+_HEADER = "<BIHH"
+_HEADER_LEN = const(9)
+_KIND_MSG = const(0x4D)  # M
+_KIND_ACK = const(0x41)  # A
+_KIND_SEQ = const(0x53)  # S, keeps seqs increasing across compactions
+_DEFAULT_MAX_BYTES = const(16384)
+# Wait before retrying a msg the phone couldn't take yet.
+_RETRY_MS = const(50)
+
+
+class Inbox():
+    """Store and forward log of msgs received from the satellites.
+
+    Each msg is appended to a log on flash as a fixed header (kind, seq, app_id, length)
+    followed by the payload, and streamed to the phone (oldest first) whenever one is
+    connected. When the phone acks a seq an ack record is appended, once everything is
+    acked (or the log grows past max_bytes) it's compacted down to the unacked msgs and
+    acked_callback is called so the modem side copies can be cleared.
+    send is a callable (seq, app_id, data) which raises if the phone can't take the msg,
+    or returns False if it can't take it yet (e.g. BLE's tx buffer is full). A ValueError
+    means the msg can never be sent (e.g. too big for BLE's tx buffer), it's dropped.
+    """
+
+    def __init__(self, send=None, path="inbox", max_bytes=_DEFAULT_MAX_BYTES,
+                 acked_callback=None):
+        self.send = send
+        self.path = path
+        self.max_bytes = max_bytes
+        self.acked_callback = acked_callback
+        self.connected = False
+        # (seq, offset) of unacked msgs, oldest first.
+        self._index = []
+        # Position in _index of the next msg to stream to the phone.
+        self._next = 0
+        self._next_seq = 1
+        self._size = 0
+        self._header = bytearray(_HEADER_LEN)
+        self._wake = uasyncio.ThreadSafeFlag()
+        self._load()
+
+    def __len__(self):
+        return len(self._index)
+
+    def _load(self):
+        """Replay the log, dropping any partially written record at the end."""
+        acked = 0
+        offset = 0
+        clean = True
+        try:
+            with open(self.path, "rb") as f:
+                while True:
+                    if f.readinto(self._header) != _HEADER_LEN:
+                        break
+                    kind, seq, app_id, length = struct.unpack(_HEADER, self._header)
+                    if kind == _KIND_MSG:
+                        if len(f.read(length)) != length:
+                            clean = False
+                            break
+                        self._index.append((seq, offset))
+                    elif kind == _KIND_ACK:
+                        acked = max(acked, seq)
+                    elif kind != _KIND_SEQ:
+                        clean = False
+                        break
+                    if seq >= self._next_seq:
+                        self._next_seq = seq + 1
+                    offset = f.tell()
+        except OSError:
+            # No log yet.
+            return
+        self._size = offset
+        self._drop_acked(acked)
+        _log.info("Loaded %s unacked msgs from the inbox", len(self._index))
+        if not clean or acked > 0:
+            self._compact()
+
+    def _drop_acked(self, seq):
+        i = 0
+        while i < len(self._index) and self._index[i][0] <= seq:
+            i += 1
+        if i > 0:
+            self._index = self._index[i:]
+            self._next = max(0, self._next - i)
+
+    def _drop(self, i: int):
+        """Remove the unacked msg at i in _index from the log."""
+        del self._index[i]
+        self._compact()
+
+    def _append(self, kind, seq, app_id, data):
+        struct.pack_into(_HEADER, self._header, 0, kind, seq, app_id, len(data))
+        offset = self._size
+        with open(self.path, "ab") as f:
+            f.write(self._header)
+            f.write(data)
+        self._size += _HEADER_LEN + len(data)
+        return offset
+
+    def _read(self, offset):
+        """Read the (app_id, data) of the msg at offset."""
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            f.readinto(self._header)
+            _, _, app_id, length = struct.unpack(_HEADER, self._header)
+            return (app_id, str(f.read(length), "utf8"))
+
+    def _compact(self):
+        """Rewrite the log with just the unacked msgs (write to temp then rename)."""
+        tmp = self.path + ".tmp"
+        index = []
+        offset = 0
+        try:
+            with open(tmp, "wb") as out:
+                struct.pack_into(_HEADER, self._header, 0, _KIND_SEQ, self._next_seq - 1, 0, 0)
+                out.write(self._header)
+                offset = _HEADER_LEN
+                for seq, old in self._index:
+                    app_id, data = self._read(old)
+                    data = data.encode()
+                    struct.pack_into(_HEADER, self._header, 0, _KIND_MSG, seq, app_id,
+                                     len(data))
+                    out.write(self._header)
+                    out.write(data)
+                    index.append((seq, offset))
+                    offset += _HEADER_LEN + len(data)
+            os.rename(tmp, self.path)
+            self._index = index
+            self._size = offset
+        except Exception as e:
+            _log.error("Error %s compacting inbox", e)
+
+    def put(self, app_id: int, data: str) -> int:
+        """Store a msg from the modem and wake the sender, returns its seq."""
+        seq = self._next_seq
+        self._next_seq += 1
+        encoded = data.encode()
+        if self._size + _HEADER_LEN + len(encoded) > self.max_bytes:
+            self._compact()
+            # Still full, the oldest msg has to go.
+            while len(self._index) > 0 and \
+                    self._size + _HEADER_LEN + len(encoded) > self.max_bytes:
+                _log.warn("Inbox full, dropping msg %s", self._index[0][0])
+                self._drop_acked(self._index[0][0])
+                self._compact()
+        self._index.append((seq, self._append(_KIND_MSG, seq, int(app_id), encoded)))
+        self._wake.set()
+        return seq
+
+    def ack(self, seq: int):
+        """The phone has everything up to and including seq."""
+        self._append(_KIND_ACK, seq, 0, b"")
+        self._drop_acked(seq)
+        if len(self._index) == 0 or self._size > self.max_bytes // 2:
+            self._compact()
+        if self.acked_callback is not None:
+            self.acked_callback(seq)
+
+    def set_connected(self, connected: bool):
+        """Start streaming on connect, unacked msgs are re-sent on every connect.
+        Safe to call from an IRQ / BLE callback."""
+        self.connected = connected
+        self._next = 0
+        if connected:
+            self._wake.set()
+
+    async def run(self):
+        """Stream unacked msgs to the phone while it's connected."""
+        while True:
+            await self._wake.wait()
+            while self.connected and self._next < len(self._index):
+                seq, offset = self._index[self._next]
+                try:
+                    app_id, data = self._read(offset)
+                    if self.send(seq, app_id, data) is False:
+                        await uasyncio.sleep_ms(_RETRY_MS)
+                        continue
+                except ValueError as e:
+                    _log.error("Dropping msg %s, it can't be sent: %s", seq, e)
+                    self._drop(self._next)
+                    continue
+                except Exception as e:
+                    _log.error("Error %s streaming msg %s, waiting for reconnect", e, seq)
+                    break
+                self._next += 1
+                # Let the BLE stack & other tasks run between msgs.
+                await uasyncio.sleep(0)
@@ -0,0 +1,212 @@
+import uasyncio
+from micropython import const
+
+# Leveled logging which is cheap enough for IRQ handlers and hot paths.
+#
+# Loggers only store a reference to the format string and its args in a preallocated
+# ring, nothing is formatted (or allocated) until the ring is drained outside of IRQ
+# context. Disabled levels return before touching the ring. Wrap hot path debug calls
+# in `if __debug__:` so release builds (frozen with opt >= 1) compile them out entirely.
+DEBUG = const(10)
+INFO = const(20)
+WARN = const(30)
+ERROR = const(40)
+OFF = const(100)
+
+_LEVEL_CHARS = {DEBUG: "D", INFO: "I", WARN: "W", ERROR: "E"}
+_MAX_ARGS = const(4)
+_DEFAULT_SLOTS = const(64)
+_DEFAULT_FILE_BYTES = const(8192)
+# Marks unused args so None can still be logged.
+_NA = object()
+
+
+class Ring():
+    """Preallocated ring of unformatted log records.
+
+    Writers reserve a slot before filling it and the drain only runs from a task, so an
+    IRQ can't see (or clobber) a half written record. When full new records are dropped
+    and counted.
+    """
+
+    def __init__(self, slots=_DEFAULT_SLOTS):
+        self.slots = slots
+        self._loggers = [None] * slots
+        self._levels = bytearray(slots)
+        self._fmts = [None] * slots
+        self._args = [_NA] * (slots * _MAX_ARGS)
+        self._produced = 0
+        self._consumed = 0
+        self.dropped = 0
+        self.flag = uasyncio.ThreadSafeFlag()
+
+    def __len__(self):
+        return self._produced - self._consumed
+
+    def write(self, logger, level, fmt, a, b, c, d):
+        i = self._produced
+        if i - self._consumed >= self.slots:
+            self.dropped += 1
+            return
+        self._produced = i + 1
+        slot = i % self.slots
+        self._loggers[slot] = logger
+        self._levels[slot] = level
+        self._fmts[slot] = fmt
+        j = slot * _MAX_ARGS
+        args = self._args
+        args[j] = a
+        args[j + 1] = b
+        args[j + 2] = c
+        args[j + 3] = d
+        self.flag.set()
+
+    def pop(self):
+        """Format and free the oldest record, returns None when empty."""
+        if self._produced == self._consumed:
+            return None
+        slot = self._consumed % self.slots
+        j = slot * _MAX_ARGS
+        args = []
+        for k in range(j, j + _MAX_ARGS):
+            if self._args[k] is _NA:
+                break
+            args.append(self._args[k])
+            self._args[k] = _NA
+        fmt = self._fmts[slot]
+        try:
+            msg = fmt % tuple(args) if len(args) > 0 else fmt
+        except Exception:
+            msg = f"{fmt} {args}"
+        line = f"{_LEVEL_CHARS.get(self._levels[slot], '?')} {self._loggers[slot].name}: {msg}"
+        self._loggers[slot] = None
+        self._fmts[slot] = None
+        self._consumed += 1
+        return line
+
+
+class Logger():
+    __slots__ = ("name", "level")
+
+    def __init__(self, name, level):
+        self.name = name
+        self.level = level
+
+    def enabled(self, level) -> bool:
+        return level >= self.level
+
+    def log(self, level, fmt, a=_NA, b=_NA, c=_NA, d=_NA):
+        if level >= self.level:
+            _ring.write(self, level, fmt, a, b, c, d)
+
+    def debug(self, fmt, a=_NA, b=_NA, c=_NA, d=_NA):
+        if DEBUG >= self.level:
+            _ring.write(self, DEBUG, fmt, a, b, c, d)
+
+    def info(self, fmt, a=_NA, b=_NA, c=_NA, d=_NA):
+        if INFO >= self.level:
+            _ring.write(self, INFO, fmt, a, b, c, d)
+
+    def warn(self, fmt, a=_NA, b=_NA, c=_NA, d=_NA):
+        if WARN >= self.level:
+            _ring.write(self, WARN, fmt, a, b, c, d)
+
+    def error(self, fmt, a=_NA, b=_NA, c=_NA, d=_NA):
+        if ERROR >= self.level:
+            _ring.write(self, ERROR, fmt, a, b, c, d)
+
+
+class FileSink():
+    """Appends log lines to a file on flash, keeping one rotated copy at path.1."""
+
+    def __init__(self, path="log", max_bytes=_DEFAULT_FILE_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._size = 0
+        try:
+            import os
+            self._size = os.stat(path)[6]
+        except OSError:
+            pass
+
+    def __call__(self, line: str):
+        import os
+        data = line.encode()
+        if self._size + len(data) + 1 > self.max_bytes:
+            try:
+                os.rename(self.path, self.path + ".1")
+            except OSError:
+                pass
+            self._size = 0
+        with open(self.path, "ab") as f:
+            f.write(data)
+            f.write(b"\n")
+        self._size += len(data) + 1
+
+
+_ring = Ring()
+_loggers = {}
+_levels = {}
+_default_level = INFO
+_sink = print
+
+
+def logger(name: str) -> Logger:
+    """The logger for a module, modules usually keep it in a module level _log."""
+    lg = _loggers.get(name)
+    if lg is None:
+        lg = Logger(name, _levels.get(name, _default_level))
+        _loggers[name] = lg
+    return lg
+
+
+def set_level(name: str, level: int):
+    """Set the level for one module, or "*" for the default and every module."""
+    global _default_level
+    if name == "*":
+        _default_level = level
+        _levels.clear()
+        for lg in _loggers.values():
+            lg.level = level
+        return
+    _levels[name] = level
+    lg = _loggers.get(name)
+    if lg is not None:
+        lg.level = level
+
+
+def set_sink(sink):
+    """Where drained lines go, a callable taking the line. Defaults to print."""
+    global _sink
+    _sink = sink
+
+
+def dropped() -> int:
+    return _ring.dropped
+
+
+def flush():
+    """Drain everything buffered now, e.g. before a reset."""
+    while True:
+        line = _ring.pop()
+        if line is None:
+            return
+        try:
+            _sink(line)
+        except Exception as e:
+            print(f"Error {e} writing log, {line}")
+
+
+async def drain():
+    """Task draining the ring to the sink, yields between lines."""
+    while True:
+        await _ring.flag.wait()
+        while True:
+            line = _ring.pop()
+            if line is None:
+                break
+            try:
+                _sink(line)
+            except Exception as e:
+                print(f"Error {e} writing log, {line}")
+            await uasyncio.sleep(0)
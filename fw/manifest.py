@@ -1,3 +1,5 @@
+import os
+
 include("$(BOARD_DIR)/../manifest.py")
 freeze("$(MPY_DIR)/drivers/display", "ssd1306.py")
 
@@ -5,8 +7,26 @@ freeze("$(MPY_DIR)/drivers/display", "ssd1306.py")
 freeze(".",
        ("boot.py",
         "Satellite.py",
+        "nmea.py",
+        "modem_msgs.py",
+        "outbox.py",
+        "inbox.py",
         "UARTBluetooth.py",
+        "ble_rx.py",
+        "binproto.py",
+        "payload.py",
         "test_utils.py",
         "display_wrapper.py",
+        "log.py",
+        "metrics.py",
+        "governor.py",
+        "power.py",
+        "passes.py",
+        "advertising.py",
+        "config.py",
+        "firmware.py",
+        "serial_bridge.py",
        ),
+       # Release builds (FW_RELEASE=1) compile out `if __debug__:` debug logging.
+       opt=1 if os.environ.get("FW_RELEASE") else 0,
 )
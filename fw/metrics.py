@@ -0,0 +1,238 @@
+import array
+import binascii
+import gc
+import struct
+import time
+import uasyncio
+from micropython import const
+
+# Counters, gauges and histograms in fixed arrays.
+#
+# Modules register their metrics once at import (e.g. _M_LINES = metrics.counter("x")),
+# after that updating one is just an array store, so it's safe on hot paths and in IRQs.
+# Counters are saved to RTC memory so they survive soft resets, see save / restore.
+# Room for the firmware's metrics with headroom (MetricsTest checks there's some left),
+# the counters also have to fit in RTC memory (2KB on the ESP32).
+_MAX_COUNTERS = const(64)
+_MAX_GAUGES = const(32)
+_MAX_HISTOGRAMS = const(16)
+# Histogram buckets are powers of 4 (< 1, < 4, < 16 ... < 4096), the last is the rest.
+_BUCKETS = const(8)
+# count, sum, max then the buckets.
+_HIST_WIDTH = const(11)
+_RTC_MAGIC = const(0x4D54)
+# magic, number of counters, crc32 of their names.
+_RTC_HEADER = "<HHI"
+_RTC_HEADER_LEN = const(8)
+_DEFAULT_PERIOD = const(30)
+
+_counter_names = []
+_counters = array.array("L", [0] * _MAX_COUNTERS)
+_gauge_names = []
+_gauges = array.array("l", [0] * _MAX_GAUGES)
+_histogram_names = []
+_histograms = array.array("L", [0] * (_MAX_HISTOGRAMS * _HIST_WIDTH))
+# Callables returning more name=value text for snapshot, for stats keyed at run time.
+_sources = []
+
+
+def _register(names, name, limit) -> int:
+    if name in names:
+        return names.index(name)
+    if len(names) >= limit:
+        raise ValueError(f"No room for metric {name}")
+    names.append(name)
+    return len(names) - 1
+
+
+def counter(name: str) -> int:
+    return _register(_counter_names, name, _MAX_COUNTERS)
+
+
+def gauge(name: str) -> int:
+    return _register(_gauge_names, name, _MAX_GAUGES)
+
+
+def histogram(name: str) -> int:
+    return _register(_histogram_names, name, _MAX_HISTOGRAMS)
+
+
+def inc(i: int, n=1):
+    _counters[i] += n
+
+
+def set_gauge(i: int, v: int):
+    _gauges[i] = v
+
+
+def observe(i: int, v: int):
+    """Add a sample (e.g. ms) to histogram i."""
+    j = i * _HIST_WIDTH
+    h = _histograms
+    h[j] += 1
+    h[j + 1] += v
+    if v > h[j + 2]:
+        h[j + 2] = v
+    b = 0
+    limit = 1
+    while b < _BUCKETS - 1 and v >= limit:
+        limit <<= 2
+        b += 1
+    h[j + 3 + b] += 1
+
+
+def headroom():
+    """Free (counter, gauge, histogram) slots."""
+    return (_MAX_COUNTERS - len(_counter_names), _MAX_GAUGES - len(_gauge_names),
+            _MAX_HISTOGRAMS - len(_histogram_names))
+
+
+def add_source(fn):
+    """Include fn()'s name=value text (space separated) in snapshot."""
+    _sources.append(fn)
+
+
+def value(name: str) -> int:
+    """Current value of a counter or gauge, mostly for tests."""
+    if name in _counter_names:
+        return _counters[_counter_names.index(name)]
+    return _gauges[_gauge_names.index(name)]
+
+
+def snapshot() -> str:
+    """Compact text snapshot: name=value for counters & gauges and
+    name=count/sum/max/b0,b1,... for histograms."""
+    parts = []
+    for i in range(len(_counter_names)):
+        parts.append(f"{_counter_names[i]}={_counters[i]}")
+    for i in range(len(_gauge_names)):
+        parts.append(f"{_gauge_names[i]}={_gauges[i]}")
+    for i in range(len(_histogram_names)):
+        j = i * _HIST_WIDTH
+        h = _histograms
+        buckets = ",".join([str(h[k]) for k in range(j + 3, j + _HIST_WIDTH)])
+        parts.append(f"{_histogram_names[i]}={h[j]}/{h[j + 1]}/{h[j + 2]}/{buckets}")
+    for fn in _sources:
+        text = fn()
+        if len(text) > 0:
+            parts.append(text)
+    return " ".join(parts)
+
+
+def reset():
+    for i in range(len(_counters)):
+        _counters[i] = 0
+    for i in range(len(_gauges)):
+        _gauges[i] = 0
+    for i in range(len(_histograms)):
+        _histograms[i] = 0
+
+
+def _names_crc() -> int:
+    return binascii.crc32(" ".join(_counter_names).encode())
+
+
+def _rtc():
+    try:
+        from machine import RTC
+        return RTC()
+    except Exception:
+        return None
+
+
+def save(rtc=None):
+    """Write the counters to RTC memory (which survives soft resets)."""
+    rtc = rtc or _rtc()
+    if rtc is None:
+        return
+    n = len(_counter_names)
+    data = bytearray(_RTC_HEADER_LEN + 4 * n)
+    struct.pack_into(_RTC_HEADER, data, 0, _RTC_MAGIC, n, _names_crc())
+    for i in range(n):
+        struct.pack_into("<L", data, _RTC_HEADER_LEN + 4 * i, _counters[i])
+    try:
+        rtc.memory(data)
+    except Exception as e:
+        print(f"Error {e} saving metrics to RTC memory.")
+
+
+def restore(rtc=None) -> bool:
+    """Add the counters saved in RTC memory, call once every module has registered its
+    metrics. Saved counters from a different set of metrics are ignored."""
+    rtc = rtc or _rtc()
+    if rtc is None:
+        return False
+    try:
+        data = rtc.memory()
+        if len(data) < _RTC_HEADER_LEN:
+            return False
+        magic, n, crc = struct.unpack_from(_RTC_HEADER, data, 0)
+        if magic != _RTC_MAGIC or n != len(_counter_names) or crc != _names_crc() or \
+                len(data) < _RTC_HEADER_LEN + 4 * n:
+            return False
+        for i in range(n):
+            _counters[i] += struct.unpack_from("<L", data, _RTC_HEADER_LEN + 4 * i)[0]
+        return True
+    except Exception as e:
+        print(f"Error {e} restoring metrics from RTC memory.")
+        return False
+
+
+_M_GC = counter("gc.collects")
+_G_FREE = gauge("heap.free")
+_G_MIN_FREE = gauge("heap.min_free")
+_last_alloc = 0
+
+
+def sample():
+    """Update the heap gauges. MicroPython doesn't count collections, so one is assumed
+    whenever the allocated bytes went down since the last sample."""
+    global _last_alloc
+    if not hasattr(gc, "mem_free"):
+        return
+    free = gc.mem_free()
+    alloc = gc.mem_alloc()
+    if alloc < _last_alloc:
+        _counters[_M_GC] += 1
+    _last_alloc = alloc
+    _gauges[_G_FREE] = free
+    if _gauges[_G_MIN_FREE] == 0 or free < _gauges[_G_MIN_FREE]:
+        _gauges[_G_MIN_FREE] = free
+
+
+async def run(period=_DEFAULT_PERIOD):
+    """Sample the heap and save the counters every period seconds."""
+    while True:
+        sample()
+        save()
+        await uasyncio.sleep(period)
+
+
+class TimedLock():
+    """A uasyncio.Lock which records how long callers wait for and hold it (ms)."""
+
+    def __init__(self, wait_histogram: int, hold_histogram: int):
+        self._lock = uasyncio.Lock()
+        self._wait = wait_histogram
+        self._hold = hold_histogram
+        self._acquired = 0
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+    async def acquire(self):
+        start = time.ticks_ms()
+        await self._lock.acquire()
+        self._acquired = time.ticks_ms()
+        observe(self._wait, time.ticks_diff(self._acquired, start))
+
+    def release(self):
+        observe(self._hold, time.ticks_diff(time.ticks_ms(), self._acquired))
+        self._lock.release()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
@@ -0,0 +1,162 @@
+def _value(field: str) -> str:
+    """Strip an optional KEY= prefix from a field."""
+    i = field.find("=")
+    if i < 0:
+        return field
+    return field[i + 1:]
+
+
+class ModemMsg():
+    """A validated line from the modem. Only the command is extracted up front,
+    everything else is parsed on first access."""
+    __slots__ = ("raw", "cmd", "_sp")
+
+    def __init__(self, raw: str, cmd: str, sp: int):
+        self.raw = raw
+        self.cmd = cmd
+        self._sp = sp
+
+    @property
+    def contents(self) -> str:
+        """Everything after the command."""
+        if self._sp < 0:
+            return ""
+        return self.raw[self._sp + 1:]
+
+    def __str__(self):
+        return self.raw
+
+
+class RDMsg(ModemMsg):
+    """$RD AI=<app_id>,RSSI=<rssi>,SNR=<snr>,FDEV=<fdev>,<data>"""
+    __slots__ = ("_parts",)
+
+    def __init__(self, raw: str, cmd: str, sp: int):
+        super().__init__(raw, cmd, sp)
+        self._parts = None
+
+    def _field(self, idx: int) -> str:
+        if self._parts is None:
+            # Data is last so it may safely contain commas.
+            self._parts = self.contents.split(",", 4)
+        return _value(self._parts[idx])
+
+    @property
+    def app_id(self) -> int:
+        return int(self._field(0))
+
+    @property
+    def rssi(self) -> int:
+        return int(self._field(1))
+
+    @property
+    def snr(self) -> int:
+        return int(self._field(2))
+
+    @property
+    def fdev(self) -> int:
+        return int(self._field(3))
+
+    @property
+    def data(self) -> str:
+        if self._parts is None:
+            self._field(4)
+        return self._parts[4]
+
+
+class TDMsg(ModemMsg):
+    """$TD OK,<msg_id> / $TD SENT RSSI=..,SNR=..,FDEV=..,<msg_id> / $TD ERR,..."""
+    __slots__ = ()
+
+    @property
+    def status(self) -> str:
+        contents = self.contents
+        end = contents.find(" ")
+        comma = contents.find(",")
+        if end < 0 or 0 <= comma < end:
+            end = comma
+        return contents if end < 0 else contents[:end]
+
+    @property
+    def msg_id(self) -> str:
+        contents = self.contents
+        return contents[contents.rfind(",") + 1:]
+
+
+class MMMsg(ModemMsg):
+    """$MM AI=<app_id>,<data>,ID=<msg_id>,RT=<timestamp>, a msg read from the inbox."""
+    __slots__ = ("_parts",)
+
+    def __init__(self, raw: str, cmd: str, sp: int):
+        super().__init__(raw, cmd, sp)
+        self._parts = None
+
+    def _field(self, idx: int) -> str:
+        if self._parts is None:
+            self._parts = self.contents.split(",")
+            if len(self._parts) != 4:
+                raise ValueError(f"Not a msg {self.raw}")
+        return _value(self._parts[idx])
+
+    @property
+    def app_id(self) -> int:
+        return int(self._field(0))
+
+    @property
+    def data(self) -> str:
+        return self._field(1)
+
+    @property
+    def msg_id(self) -> str:
+        return self._field(2)
+
+    @property
+    def timestamp(self) -> str:
+        return self._field(3)
+
+
+class TimeMsg(ModemMsg):
+    """$RT RSSI=..,SNR=..,FDEV=..,TS=<timestamp>,DI=.. or $DT <timestamp>,V"""
+    __slots__ = ()
+
+    @property
+    def timestamp(self) -> str:
+        contents = self.contents
+        if self.cmd == "DT":
+            end = contents.find(",")
+            return contents if end < 0 else contents[:end]
+        start = contents.find("TS=")
+        if start < 0:
+            return None
+        start += 3
+        end = contents.find(",", start)
+        return contents[start:] if end < 0 else contents[start:end]
+
+
+class Dispatcher():
+    """Routes validated modem lines to handlers keyed by command (e.g. "RD").
+
+    Handlers are called synchronously with an instance of the registered msg class,
+    they should create a task for any slow / async work.
+    """
+
+    def __init__(self):
+        self._handlers = {}
+
+    def register(self, cmd: str, handler, msg_cls=ModemMsg):
+        """Register handler for cmd (without the leading $), replacing any existing one."""
+        self._handlers[cmd] = (handler, msg_cls)
+
+    def unregister(self, cmd: str):
+        self._handlers.pop(cmd, None)
+
+    def dispatch(self, raw: str) -> bool:
+        """Dispatch raw, returns False if no handler is registered."""
+        sp = raw.find(" ")
+        cmd = raw[1:] if sp < 0 else raw[1:sp]
+        entry = self._handlers.get(cmd)
+        if entry is None:
+            return False
+        handler, msg_cls = entry
+        handler(msg_cls(raw, cmd, sp))
+        return True
@@ -0,0 +1,510 @@
+import gc
+import math
+import random
+import sys
+import time
+import uasyncio
+from micropython import const
+from nmea import checksum
+
+# A stateful M138 simulator behind the same interface as test_utils.FakeUART, for
+# soak / load testing Satellite without a modem (or the sky).
+#
+# Time is simulated: the sim's clock runs speedup times faster than real time, so
+# hours of passes, msg arrivals and acks go by in seconds.
+_BAUD = const(115200)
+# Simulated time starts at 2023-01-01T00:00:00Z.
+_START_EPOCH = const(1672531200)
+_FIRST_MSG_ID = 5354468575000
+_MAX_PACKET = const(192)
+_DEFAULT_TD_CAPACITY = const(2048)
+_DEFAULT_INBOX_CAPACITY = const(2048)
+
+BOOT_SEQUENCE = (
+    "$M138 BOOT,RESTART",
+    "$M138 BOOT,POWERON,LPWR=N,WDOG=N,SWRST=Y,PIN=N",
+    "$M138 BOOT,VERSION,2021-07-16T00:28:00,v1.1.0",
+    "$M138 BOOT,DEVICEID,DI=%s",
+    "$M138 BOOT,RUNNING",
+)
+
+
+def _uniform() -> float:
+    return random.getrandbits(24) / 16777216
+
+
+def _exp(mean: float) -> float:
+    """Exponentially distributed delay, e.g. the gap between msg arrivals."""
+    return -math.log(1 - _uniform()) * mean
+
+
+def _is_hex(data: str) -> bool:
+    if len(data) % 2 != 0:
+        return False
+    for c in data:
+        if c not in "0123456789abcdefABCDEF":
+            return False
+    return True
+
+
+class M138Sim():
+    """Simulated M138 modem.
+
+    Handles the boot sequence, $CS / $FV, the $MM inbox (counts, reads, marks, deletes
+    and $RD pushes with N=E), $TD queuing with SENT acks after a random delay, $MT C=U,
+    $DT / $RT at the rate they're configured to, $SL sleep (woken by the timer or any
+    command, which is lost), $GP 6 (rx_indicator) and checksum errors on commands. Msgs arrive at
+    msgs_per_hour on average. Lines from the modem may be dropped, garbled or given a
+    bad checksum with the given probabilities, and each takes the time it would on a
+    115200 baud line.
+    """
+
+    def __init__(self, speedup=1, seed=1, msgs_per_hour=0, sent_delay=600,
+                 cmd_latency=0.05, drop_rate=0.0, garble_rate=0.0, bad_checksum_rate=0.0,
+                 boot_sequence=BOOT_SEQUENCE, boot_time=2, fix_time=30, app_ids=(1,),
+                 device_id="0x000e57", td_capacity=_DEFAULT_TD_CAPACITY,
+                 inbox_capacity=_DEFAULT_INBOX_CAPACITY):
+        random.seed(seed)
+        self.speedup = speedup
+        self.msgs_per_hour = msgs_per_hour
+        self.sent_delay = sent_delay
+        self.cmd_latency = cmd_latency
+        self.drop_rate = drop_rate
+        self.garble_rate = garble_rate
+        self.bad_checksum_rate = bad_checksum_rate
+        self.app_ids = app_ids
+        self.device_id = device_id
+        self.td_capacity = td_capacity
+        self.inbox_capacity = inbox_capacity
+        # Same attributes as FakeUART so Satellite can init it.
+        self.baudrate = None
+        self.tx = None
+        self.rx = None
+        self.sent_lines = []
+        self._start = time.ticks_ms()
+        # [time, seq, fn, arg] sorted by time.
+        self._events = []
+        self._seq = 0
+        self._out = []
+        self._partial = ""
+        self._wake = uasyncio.Event()
+        self._next_id = _FIRST_MSG_ID
+        # [msg_id, app_id, data, epoch, read]
+        self.inbox = []
+        self.notify = False
+        self.dt_rate = 0
+        self.rt_rate = 0
+        # msg_id -> (app_id, data, queued at)
+        self.td_queue = {}
+        self.gpio_mode = 0
+        self.asleep = False
+        # Bumped on every sleep so a stale timer wake is ignored.
+        self._sleep_seq = 0
+        self._asleep_at = 0
+        # Msgs which arrived while asleep, the sats resend them once we listen again.
+        self._missed = []
+        # Sim times msgs arrived (by data) and $TD msgs were acked (by msg id).
+        self.arrived = {}
+        self.acked = {}
+        self.stats = {"lines": 0, "commands": 0, "bad_commands": 0, "dropped": 0,
+                      "garbled": 0, "bad_checksums": 0, "msgs": 0, "inbox_full": 0,
+                      "td": 0, "td_full": 0, "td_sent": 0, "sleeps": 0, "asleep_s": 0}
+        for i in range(len(boot_sequence)):
+            line = boot_sequence[i]
+            if "%s" in line:
+                line = line % device_id
+            self._schedule(boot_time + i * 0.01, self._emit, line)
+        self._schedule(boot_time + fix_time, self._fix, None)
+        if msgs_per_hour > 0:
+            self._schedule(_exp(3600 / msgs_per_hour), self._arrive, None)
+
+    def now(self) -> float:
+        """Seconds of simulated time since the sim started."""
+        return time.ticks_diff(time.ticks_ms(), self._start) * self.speedup / 1000
+
+    def epoch(self) -> int:
+        return _START_EPOCH + int(self.now())
+
+    def _timestamp(self) -> str:
+        t = time.gmtime(self.epoch())
+        return "%04d%02d%02d%02d%02d%02d" % (t[0], t[1], t[2], t[3], t[4], t[5])
+
+    def _schedule(self, delay: float, fn, arg):
+        at = self.now() + delay
+        self._seq += 1
+        i = len(self._events)
+        while i > 0 and self._events[i - 1][0] > at:
+            i -= 1
+        self._events.insert(i, [at, self._seq, fn, arg])
+        self._wake.set()
+
+    def _run_due(self):
+        now = self.now()
+        while len(self._events) > 0 and self._events[0][0] <= now:
+            _, _, fn, arg = self._events.pop(0)
+            fn(arg)
+
+    def _emit(self, body: str):
+        """Queue a line from the modem, possibly mangling it."""
+        self.stats["lines"] += 1
+        if self.drop_rate > 0 and _uniform() < self.drop_rate:
+            self.stats["dropped"] += 1
+            return
+        data = body.encode()
+        cs = checksum(data, 0, len(data))
+        if self.bad_checksum_rate > 0 and _uniform() < self.bad_checksum_rate:
+            self.stats["bad_checksums"] += 1
+            cs ^= 0x5A
+        line = bytearray(data + ("*%02X\n" % cs).encode())
+        if self.garble_rate > 0 and _uniform() < self.garble_rate and len(data) > 1:
+            self.stats["garbled"] += 1
+            i = 1 + random.getrandbits(16) % (len(data) - 1)
+            line[i] = 0x21 + (line[i] + 1 + random.getrandbits(6)) % 90
+        self._out.append(bytes(line))
+
+    def _reply(self, body: str):
+        self._schedule(self.cmd_latency, self._emit, body)
+
+    # UART interface
+
+    def init(self, baudrate=0, tx=None, rx=None):
+        self.baudrate = baudrate
+        self.tx = tx
+        self.rx = rx
+
+    async def readline(self):
+        while True:
+            self._run_due()
+            if len(self._out) > 0:
+                line = self._out.pop(0)
+                # Time on the wire, 10 bits a byte.
+                await uasyncio.sleep(len(line) * 10 / _BAUD / self.speedup)
+                return line
+            timeout = 1.0
+            if len(self._events) > 0:
+                timeout = max(0, self._events[0][0] - self.now()) / self.speedup
+            self._wake.clear()
+            try:
+                await uasyncio.wait_for(self._wake.wait(), timeout)
+            except uasyncio.TimeoutError:
+                pass
+
+    def write(self, data):
+        if not isinstance(data, str):
+            data = str(bytes(data), "utf8")
+        self._partial += data
+        while "\n" in self._partial:
+            line, self._partial = self._partial.split("\n", 1)
+            line = line.strip()
+            if len(line) > 0:
+                self.sent_lines.append(line)
+                self._command(line)
+
+    async def drain(self, *args):
+        return True
+
+    # Commands
+
+    def _command(self, line: str):
+        self.stats["commands"] += 1
+        if self.asleep:
+            self._wake_up("SERIAL")
+            return
+        star = line.rfind("*")
+        sp = line.find(" ")
+        cmd = line[:sp] if 0 <= sp and (star < 0 or sp < star) else line[:max(star, 0)]
+        body = line if star < 0 else line[:star]
+        if star < 0 or not line.startswith("$"):
+            self.stats["bad_commands"] += 1
+            self._reply(f"{cmd or line} ERR,NOCHECKSUM")
+            return
+        data = body.encode()
+        try:
+            ok = int(line[star + 1:star + 3], 16) == checksum(data, 0, len(data))
+        except ValueError:
+            ok = False
+        if not ok:
+            self.stats["bad_commands"] += 1
+            self._reply(f"{cmd} ERR,BADCHECKSUM")
+            return
+        args = body[len(cmd) + 1:] if len(body) > len(cmd) else ""
+        handler = getattr(self, "_cmd_" + cmd[1:], None)
+        if handler is None:
+            self._reply(f"{cmd} OK")
+        else:
+            handler(args)
+
+    def _cmd_CS(self, args):
+        self._reply(f"$CS DI={self.device_id},DN=M138")
+
+    def _cmd_FV(self, args):
+        self._reply("$FV 2021-07-16T00:28:00,v1.1.0")
+
+    def _cmd_DT(self, args):
+        self._rate_cmd("$DT", "dt_rate", self._dt, args)
+
+    def _cmd_RT(self, args):
+        self._rate_cmd("$RT", "rt_rate", self._rt, args)
+
+    def _rate_cmd(self, cmd, attr, fn, args):
+        if args == "@":
+            fn(False)
+            return
+        if args in ("?", ""):
+            self._reply(f"{cmd} {getattr(self, attr)}")
+            return
+        try:
+            rate = int(args)
+        except ValueError:
+            self._reply(f"{cmd} ERR,BADPARAM")
+            return
+        start = getattr(self, attr) == 0
+        setattr(self, attr, rate)
+        self._reply(f"{cmd} OK")
+        if start and rate > 0:
+            self._schedule(rate, fn, True)
+
+    def _cmd_MM(self, args):
+        eq = args.find("=")
+        key = args[:eq] if eq >= 0 else args
+        value = args[eq + 1:] if eq >= 0 else ""
+        if key == "C":
+            count = len(self.inbox) if value == "**" else \
+                len([m for m in self.inbox if not m[4]])
+            self._reply(f"$MM {count}")
+        elif key == "R":
+            msg = self._find_msg(value, unread=True)
+            if msg is None:
+                self._reply("$MM ERR,DBXNOMORE")
+                return
+            msg[4] = True
+            self._reply(f"$MM AI={msg[1]},{msg[2]},ID={msg[0]},RT={msg[3]}")
+        elif key == "M":
+            count = 0
+            for m in self.inbox:
+                if value == "**" or str(m[0]) == value:
+                    m[4] = True
+                    count += 1
+            self._reply(f"$MM MARKED,{count}")
+        elif key == "D":
+            before = len(self.inbox)
+            if value == "**":
+                self.inbox = []
+            elif value == "R":
+                self.inbox = [m for m in self.inbox if not m[4]]
+            else:
+                self.inbox = [m for m in self.inbox if str(m[0]) != value]
+            self._reply(f"$MM DELETED,{before - len(self.inbox)}")
+        elif key == "N":
+            self.notify = value == "E"
+            self._reply("$MM OK")
+        else:
+            self._reply("$MM ERR,BADPARAM")
+
+    def _cmd_MT(self, args):
+        if args == "C=U":
+            self._reply(f"$MT {len(self.td_queue)}")
+        else:
+            self._reply("$MT ERR,BADPARAM")
+
+    def _cmd_GP(self, args):
+        try:
+            self.gpio_mode = int(args)
+        except ValueError:
+            self._reply("$GP ERR,BADPARAM")
+            return
+        self._reply("$GP OK")
+
+    def _cmd_SL(self, args):
+        if not args.startswith("S="):
+            self._reply("$SL ERR,BADPARAM")
+            return
+        seconds = int(args[2:])
+        self._reply("$SL OK")
+        self._schedule(self.cmd_latency, self._sleep, seconds)
+
+    def rx_indicator(self) -> int:
+        """Level of GPIO1, in mode 6 it's high while unread msgs are waiting."""
+        if self.gpio_mode != 6:
+            return 0
+        for m in self.inbox:
+            if not m[4]:
+                return 1
+        return 0
+
+    def _find_msg(self, which, unread):
+        candidates = [m for m in self.inbox if not (unread and m[4])]
+        if which in ("O", "N"):
+            if len(candidates) == 0:
+                return None
+            return candidates[0] if which == "O" else candidates[-1]
+        for m in self.inbox:
+            if str(m[0]) == which:
+                return m
+        return None
+
+    def _cmd_TD(self, args):
+        fields = args.split(",")
+        app_id = 0
+        for f in fields[:-1]:
+            if f.startswith("AI="):
+                app_id = int(f[3:])
+        data = fields[-1]
+        if not _is_hex(data):
+            self._reply("$TD ERR,HEXNOTVALID")
+            return
+        if len(data) // 2 > _MAX_PACKET:
+            self._reply("$TD ERR,DATATOOLONG")
+            return
+        if len(self.td_queue) >= self.td_capacity:
+            self.stats["td_full"] += 1
+            self._reply("$TD ERR,DBXTOHIVEFULL")
+            return
+        msg_id = self._next_id
+        self._next_id += 1
+        self.td_queue[msg_id] = (app_id, data, self.now())
+        self.stats["td"] += 1
+        self._reply(f"$TD OK,{msg_id}")
+        self._schedule(self.cmd_latency + _exp(self.sent_delay), self._sent, msg_id)
+
+    # Scheduled events
+
+    def _sleep(self, seconds):
+        self.asleep = True
+        self._asleep_at = self.now()
+        self._sleep_seq += 1
+        self.stats["sleeps"] += 1
+        self._schedule(seconds, self._timer_wake, self._sleep_seq)
+
+    def _timer_wake(self, seq):
+        if self.asleep and seq == self._sleep_seq:
+            self._wake_up("TIME")
+
+    def _wake_up(self, reason):
+        self.asleep = False
+        self.stats["asleep_s"] += self.now() - self._asleep_at
+        self._emit(f"$SL WAKE,{reason}")
+        missed = self._missed
+        self._missed = []
+        for app_id, data in missed:
+            self.deliver(app_id, data)
+
+    def _fix(self, _):
+        self._emit("$M138 DATETIME")
+        self._emit("$M138 POSITION")
+
+    def _sent(self, msg_id):
+        if self.td_queue.pop(msg_id, None) is None:
+            return
+        self.stats["td_sent"] += 1
+        self.acked[str(msg_id)] = self.now()
+        self._emit(f"$TD SENT RSSI=-{100 + random.getrandbits(4)},SNR=5,FDEV=100,{msg_id}")
+
+    def _dt(self, repeat):
+        self._emit(f"$DT {self._timestamp()},V")
+        if repeat and self.dt_rate > 0:
+            self._schedule(self.dt_rate, self._dt, True)
+
+    def _rt(self, repeat):
+        rssi = 100 + random.getrandbits(4)
+        self._emit(f"$RT RSSI=-{rssi},SNR=-2,FDEV=0,TS={self._timestamp()},DI={self.device_id}")
+        if repeat and self.rt_rate > 0:
+            self._schedule(self.rt_rate, self._rt, True)
+
+    def _arrive(self, _):
+        self.deliver(self.app_ids[random.getrandbits(8) % len(self.app_ids)],
+                     "%08x%04x" % (self.stats["msgs"], random.getrandbits(16)))
+        self._schedule(_exp(3600 / self.msgs_per_hour), self._arrive, None)
+
+    def deliver(self, app_id: int, data: str):
+        """A msg arrives from the satellites now."""
+        if self.asleep:
+            self._missed.append((app_id, data))
+            return
+        self.stats["msgs"] += 1
+        if len(self.inbox) >= self.inbox_capacity:
+            self.stats["inbox_full"] += 1
+            return
+        msg_id = self._next_id
+        self._next_id += 1
+        self.inbox.append([msg_id, app_id, data, self.epoch(), False])
+        self.arrived[data] = self.now()
+        if self.notify:
+            rssi = 100 + random.getrandbits(4)
+            self._emit(f"$RD AI={app_id},RSSI=-{rssi},SNR=5,FDEV=100,{data}")
+        self._wake.set()
+
+
+async def soak(hours=1.0, speedup=36000, sends_per_hour=10, clear_every=600, **sim_args):
+    """Run a Satellite against the sim for hours of simulated time, returns a report of
+    msgs delivered / acked, their latencies (simulated seconds) and heap use."""
+    from Satellite import Satellite
+    sim = M138Sim(speedup=speedup, **sim_args)
+    delivered = {}
+    acked = {}
+    sent = {}
+    # Responses lost to faults are waited on for 30 simulated seconds.
+    s = Satellite(
+        1, myconn=sim, delay=0, expect_timeout=max(30 / speedup, 0.05),
+        new_msg_callback=lambda app_id, data: delivered.setdefault(data, sim.now()),
+        msg_acked_callback=lambda msg_id: acked.setdefault(msg_id, sim.now()),
+        client_ready=uasyncio.ThreadSafeFlag())
+    free = gc.mem_free() if hasattr(gc, "mem_free") else 0
+    s.start()
+    s.client_ready.set()
+    end = hours * 3600
+    next_send = _exp(3600 / sends_per_hour) if sends_per_hour > 0 else end
+    next_clear = clear_every
+    next_reconnect = 0
+    while sim.now() < end:
+        now = sim.now()
+        if not s.ready and s.client_task is not None and now >= next_reconnect:
+            # The phone reconnects after a failed setup (e.g. a lost reply during the drain).
+            s.client_ready.set()
+            next_reconnect = now + 60
+        if now >= next_send and s.ready:
+            try:
+                msg_id = await s.send_msg(1, "%08x" % len(sent))
+                if msg_id:
+                    sent[msg_id] = now
+            except Exception as e:
+                print(f"Error {e} sending in soak.")
+            next_send = now + _exp(3600 / sends_per_hour)
+        if now >= next_clear and s.ready:
+            await s.clear_delivered()
+            next_clear = now + clear_every
+        await uasyncio.sleep_ms(1)
+    s.satelite_task.cancel()
+    if s.client_task is not None:
+        s.client_task.cancel()
+
+    def latency(done, started):
+        waits = [done[k] - started[k] for k in done if k in started]
+        if len(waits) == 0:
+            return (0, 0)
+        return (sum(waits) / len(waits), max(waits))
+
+    if hasattr(gc, "mem_free"):
+        gc.collect()
+    report = {
+        "hours": hours,
+        "arrived": len(sim.arrived),
+        "delivered": len(delivered),
+        "delivery_latency": latency(delivered, sim.arrived),
+        "sent": len(sent),
+        "acked": len(acked),
+        "ack_latency": latency(acked, sent),
+        "inbox": len(sim.inbox),
+        "heap_growth": (free - gc.mem_free()) if hasattr(gc, "mem_free") else 0,
+    }
+    report.update(sim.stats)
+    return report
+
+
+if __name__ == "__main__":
+    import log
+    log.set_level("*", log.WARN)
+    hours = float(sys.argv[1]) if len(sys.argv) > 1 else 4
+    result = uasyncio.run(soak(hours, msgs_per_hour=20, boot_sequence=("$M138 BOOT,RUNNING",)))
+    for k in sorted(result):
+        print(f"{k} {result[k]}")
@@ -0,0 +1,149 @@
+import gc
+from micropython import const
+
+_DOLLAR = const(0x24)  # $
+_STAR = const(0x2A)  # *
+_NL = const(0x0A)
+_CR = const(0x0D)
+_HEX = b"0123456789ABCDEF"
+
+# Longest sentence the M138 produces is well under this (192 byte payloads hex encoded
+# on a $TD / $RD line fit comfortably).
+MAX_LINE = const(512)
+
+
+def _hex_val(c: int) -> int:
+    """Value of an ASCII hex digit, or -1."""
+    if 0x30 <= c <= 0x39:
+        return c - 0x30
+    if 0x41 <= c <= 0x46:
+        return c - 0x37
+    if 0x61 <= c <= 0x66:
+        return c - 0x57
+    return -1
+
+
+def checksum(buf, start: int, end: int) -> int:
+    """XOR checksum over buf[start:end] without slicing. Skips a leading $."""
+    if end > start and buf[start] == _DOLLAR:
+        start += 1
+    calc_cksum = 0
+    for i in range(start, end):
+        calc_cksum ^= buf[i]
+    return calc_cksum
+
+
+def _mem_alloc() -> int:
+    # gc.mem_alloc only exists on MicroPython, on the host we just report 0.
+    try:
+        return gc.mem_alloc()
+    except AttributeError:
+        return 0
+
+
+class NMEACodec():
+    """Frames M138 lines and encodes commands using preallocated buffers.
+
+    Incoming lines are copied into rx while the checksum is computed, so no intermediate
+    str/bytes objects are created. After a successful frame() the sentence body (without
+    the *XX) is rx_mv[0:length].
+    Outgoing commands are written into tx with the checksum and trailing newline appended.
+    """
+
+    def __init__(self, size=MAX_LINE, track_allocs=False):
+        self.rx = bytearray(size)
+        self.rx_mv = memoryview(self.rx)
+        self.tx = bytearray(size)
+        self.tx_mv = memoryview(self.tx)
+        self.length = 0
+        self.lines = 0
+        self.bad_checksums = 0
+        self.track_allocs = track_allocs
+        self.last_alloc = 0
+        self.max_alloc = 0
+
+    def frame(self, line) -> int:
+        """Validate a raw line from the modem, copying it into rx.
+        Returns the length of the body, or -1 if it is malformed or fails the checksum.
+        """
+        before = _mem_alloc() if self.track_allocs else 0
+        if isinstance(line, str):
+            # Only used by tests & the host, the UART hands us bytes.
+            line = line.encode()
+        n = len(line)
+        if n > len(self.rx):
+            n = len(self.rx)
+        # Drop the trailing newline (and CR if present)
+        while n > 0 and (line[n - 1] == _NL or line[n - 1] == _CR):
+            n -= 1
+        self.lines += 1
+        self.length = -1
+        if n < 4 or line[n - 3] != _STAR:
+            self.bad_checksums += 1
+            return self._done(before)
+        end = n - 3
+        rx = self.rx
+        calc_cksum = 0
+        i = 0
+        # Copy + checksum in a single pass, skipping the leading $ for the checksum.
+        if line[0] == _DOLLAR:
+            rx[0] = _DOLLAR
+            i = 1
+        while i < end:
+            c = line[i]
+            rx[i] = c
+            calc_cksum ^= c
+            i += 1
+        hi = _hex_val(line[n - 2])
+        lo = _hex_val(line[n - 1])
+        if hi < 0 or lo < 0 or (hi << 4 | lo) != calc_cksum:
+            self.bad_checksums += 1
+        else:
+            self.length = end
+        return self._done(before)
+
+    def _done(self, before: int) -> int:
+        if self.track_allocs:
+            used = _mem_alloc() - before
+            self.last_alloc = used
+            if used > self.max_alloc:
+                self.max_alloc = used
+        return self.length
+
+    def text(self) -> str:
+        """Decode the last framed body. This allocates, so only call it when a str is needed."""
+        if self.length < 0:
+            return None
+        return str(self.rx_mv[0:self.length], "utf8")
+
+    def startswith(self, prefix) -> bool:
+        """Check the framed body against a bytes prefix without allocating."""
+        if self.length < len(prefix):
+            return False
+        rx = self.rx
+        for i in range(len(prefix)):
+            if rx[i] != prefix[i]:
+                return False
+        return True
+
+    def encode(self, *parts) -> int:
+        """Write parts (bytes like or str) into tx followed by *XX\\n.
+        Returns the number of bytes written, the frame is tx_mv[0:n].
+        """
+        tx = self.tx
+        limit = len(tx) - 4
+        n = 0
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode()
+            for i in range(len(part)):
+                if n >= limit:
+                    raise ValueError("Command too long")
+                tx[n] = part[i]
+                n += 1
+        calc_cksum = checksum(tx, 0, n)
+        tx[n] = _STAR
+        tx[n + 1] = _HEX[calc_cksum >> 4]
+        tx[n + 2] = _HEX[calc_cksum & 0xF]
+        tx[n + 3] = _NL
+        return n + 4
@@ -0,0 +1,358 @@
+import binascii
+import os
+import time
+import uasyncio
+from micropython import const
+import log
+import payload
+
+_log = log.logger("outbox")
+_DEFAULT_CAPACITY = const(16)
+# Give up on a msg the modem keeps rejecting after this many attempts.
+_MAX_ATTEMPTS = const(5)
+_MAX_BACKOFF = const(60)
+# Swarm's max $TD payload.
+_PACKET_SIZE = const(192)
+# Sent fragmented msgs whose $TD SENTs are tracked, and for how long after the last
+# fragment (the modem's default hold is 48h), a SENT that never comes isn't kept forever.
+_MAX_UNACKED = const(8)
+_UNACKED_MS = const(172800000)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class _Entry():
+    __slots__ = ("ticket", "app_id", "data", "hold", "expiry", "attempts", "queued", "raw",
+                 "small", "msg_ids")
+
+    def __init__(self, ticket, app_id, data, hold, expiry):
+        self.ticket = ticket
+        self.app_id = app_id
+        self.data = data
+        self.hold = hold
+        self.expiry = expiry
+        self.attempts = 0
+        self.queued = time.ticks_ms()
+        # Decoded payload when it's hex, needed to aggregate / fragment.
+        self.raw = None
+        try:
+            self.raw = binascii.unhexlify(data)
+        except Exception:
+            pass
+        # Can share a packet, see Outbox._small_run.
+        self.small = self.raw is not None and hold is None and expiry is None and \
+            len(self.raw) <= payload.MAX_RECORD
+        # Modem msg ids of the fragments sent so far.
+        self.msg_ids = []
+
+
+def _opt(v) -> str:
+    return "-" if v is None else str(v)
+
+
+def _parse_opt(v):
+    return None if v == b"-" else int(v)
+
+
+class Outbox():
+    """Outbound msgs waiting to be handed to the modem, journaled to flash.
+
+    Every put appends an "A" record (header line followed by the raw data) and every msg
+    the modem accepts appends a "D" record, so the queue survives a reboot by replaying
+    the journal. The journal is compacted once it's mostly done records.
+    Hex msgs bigger than packet_size are sent as numbered fragments (see
+    payload.fragment), each accepted fragment appends an "F" record with its modem msg id
+    so a reboot resumes from the next fragment. The msg's ticket gets the first
+    fragment's msg id and acked() holds back the $TD SENT until every fragment is sent
+    (see _purge_unacked for how long it waits).
+    send is an async callable (app_id, data, hold=, expiry=) returning the modem msg id.
+    When aggregate_ms is set small hex msgs (no hold / expiry) are held for up to that
+    long and packed together into one packet (see payload.pack), each of their tickets
+    gets the shared modem msg id.
+    """
+
+    def __init__(self, send, ready=None, path="outbox", capacity=_DEFAULT_CAPACITY,
+                 sent_callback=None, error_callback=None, retry_delay=5, aggregate_ms=0,
+                 packet_size=_PACKET_SIZE):
+        self.send = send
+        self.ready = ready
+        self.path = path
+        self.capacity = capacity
+        self.sent_callback = sent_callback
+        self.error_callback = error_callback
+        self.retry_delay = retry_delay
+        self.aggregate_ms = aggregate_ms
+        self.packet_size = packet_size
+        # Modem packets sent and the msgs they carried.
+        self.packets = 0
+        self.msgs_sent = 0
+        # Fragment modem msg id -> ticket, and ticket -> [reported msg id, unsent ids,
+        # ticks_ms of the last fragment sent].
+        self._fragment_owner = {}
+        self._unacked = {}
+        self._queue = []
+        self._next_ticket = 1
+        self._records = 0
+        self._wake = uasyncio.Event()
+        self._load()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def _load(self):
+        """Replay the journal."""
+        torn = False
+        try:
+            with open(self.path, "rb") as f:
+                while True:
+                    header = f.readline()
+                    if not header:
+                        break
+                    parts = header.split()
+                    self._records += 1
+                    if len(parts) == 6 and parts[0] == b"A":
+                        n = int(parts[5])
+                        data = f.read(n)
+                        if len(data) < n or f.read(1) != b"\n":
+                            # Reset part way through a write, drop the partial record.
+                            torn = True
+                            break
+                        ticket = int(parts[1])
+                        self._queue.append(_Entry(
+                            ticket, int(parts[2]), str(data, "utf8"),
+                            _parse_opt(parts[3]), _parse_opt(parts[4])))
+                        if ticket >= self._next_ticket:
+                            self._next_ticket = ticket + 1
+                    elif len(parts) == 2 and parts[0] == b"D":
+                        self._remove(int(parts[1]))
+                    elif len(parts) == 3 and parts[0] == b"F":
+                        e = self._find(int(parts[1]))
+                        if e is not None:
+                            self._fragment_sent(e, str(parts[2], "utf8"))
+                    elif len(parts) == 2 and parts[0] == b"N":
+                        self._next_ticket = max(self._next_ticket, int(parts[1]))
+                    else:
+                        torn = True
+                        break
+        except OSError:
+            # No journal yet.
+            return
+        except Exception as e:
+            _log.error("Error %s replaying outbox journal", e)
+            torn = True
+        _log.info("Loaded %s queued msgs from the outbox journal", len(self._queue))
+        if torn:
+            self._compact()
+
+    def _find(self, ticket):
+        for e in self._queue:
+            if e.ticket == ticket:
+                return e
+        return None
+
+    def _remove(self, ticket):
+        for i in range(len(self._queue)):
+            if self._queue[i].ticket == ticket:
+                del self._queue[i]
+                return
+
+    def _append(self, *chunks):
+        try:
+            with open(self.path, "ab") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            self._records += 1
+        except Exception as e:
+            _log.error("Error %s writing outbox journal, msg only queued in memory", e)
+
+    def _compact(self):
+        """Rewrite the journal with only the queued msgs (write to temp then rename)."""
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                # Keep tickets unique across reboots even when the queue is empty.
+                f.write(("N %d\n" % self._next_ticket).encode())
+                for e in self._queue:
+                    f.write(self._add_header(e))
+                    f.write(e.data.encode())
+                    f.write(b"\n")
+                    for msg_id in e.msg_ids:
+                        f.write(("F %d %s\n" % (e.ticket, msg_id)).encode())
+            os.rename(tmp, self.path)
+            self._records = len(self._queue) + 1
+        except Exception as e:
+            _log.error("Error %s compacting outbox journal", e)
+
+    def _add_header(self, e) -> bytes:
+        return ("A %d %d %s %s %d\n" % (
+            e.ticket, e.app_id, _opt(e.hold), _opt(e.expiry), len(e.data.encode()))).encode()
+
+    def put(self, app_id: int, data: str, hold=None, expiry=None):
+        """Queue a msg, returns (ticket, position). Raises QueueFull when at capacity."""
+        if len(self._queue) >= self.capacity:
+            raise QueueFull()
+        e = _Entry(self._next_ticket, int(app_id), data, hold, expiry)
+        self._next_ticket += 1
+        self._append(self._add_header(e), data.encode(), b"\n")
+        self._queue.append(e)
+        self._wake.set()
+        return (e.ticket, len(self._queue))
+
+    def _done(self, e):
+        self._remove(e.ticket)
+        if len(self._queue) == 0 or self._records > 4 * self.capacity:
+            self._compact()
+        else:
+            self._append(("D %d\n" % e.ticket).encode())
+
+    def _fragment_sent(self, e, msg_id):
+        e.msg_ids.append(msg_id)
+        self._fragment_owner[msg_id] = e.ticket
+        acks = self._unacked.get(e.ticket)
+        if acks is None:
+            self._purge_unacked(_MAX_UNACKED - 1)
+            self._unacked[e.ticket] = [msg_id, [msg_id], time.ticks_ms()]
+        else:
+            acks[1].append(msg_id)
+            acks[2] = time.ticks_ms()
+
+    def _forget(self, e):
+        """Stop tracking the acks of a dropped msg's fragments."""
+        for msg_id in e.msg_ids:
+            self._fragment_owner.pop(msg_id, None)
+        self._unacked.pop(e.ticket, None)
+
+    def _purge_unacked(self, limit: int):
+        """Stop waiting on the SENTs of fully sent msgs after _UNACKED_MS, and of the
+        oldest ones while more than limit msgs are tracked."""
+        now = time.ticks_ms()
+        while len(self._unacked) > 0:
+            oldest = None
+            age = 0
+            for ticket, acks in self._unacked.items():
+                # Msgs still queued have fragments to send, they're never dropped here.
+                if self._find(ticket) is not None:
+                    continue
+                a = time.ticks_diff(now, acks[2])
+                if oldest is None or a > age:
+                    oldest = ticket
+                    age = a
+            if oldest is None or (age <= _UNACKED_MS and len(self._unacked) <= limit):
+                return
+            acks = self._unacked.pop(oldest)
+            for msg_id in acks[1]:
+                self._fragment_owner.pop(msg_id, None)
+            _log.warn("No $TD SENT for %s fragments of msg %s, not waiting for them",
+                      len(acks[1]), acks[0])
+
+    def _fragments(self, e) -> int:
+        if e.raw is None or len(e.raw) <= self.packet_size:
+            return 1
+        return payload.fragment_count(len(e.raw), self.packet_size)
+
+    def acked(self, msg_id):
+        """Call for each $TD SENT, returns the msg id to report to the phone or None while
+        other fragments of the same msg are outstanding."""
+        self._purge_unacked(_MAX_UNACKED)
+        ticket = self._fragment_owner.pop(msg_id, None)
+        if ticket is None:
+            return msg_id
+        acks = self._unacked[ticket]
+        acks[1].remove(msg_id)
+        if len(acks[1]) > 0 or self._find(ticket) is not None:
+            return None
+        del self._unacked[ticket]
+        return acks[0]
+
+    def _small_run(self):
+        """The leading msgs which fit in one packet together, and whether it's full."""
+        batch = []
+        size = payload.HEADER_LEN
+        for e in self._queue:
+            if not e.small:
+                break
+            size += payload.RECORD_HEADER_LEN + len(e.raw)
+            if size > self.packet_size:
+                return (batch, True)
+            batch.append(e)
+        return (batch, False)
+
+    async def _take(self):
+        """The next msgs to send, holding small ones until the aggregation window since
+        the oldest closes, the packet fills up or a msg which can't be packed is queued."""
+        while True:
+            if self.aggregate_ms <= 0:
+                return [self._queue[0]]
+            batch, full = self._small_run()
+            if len(batch) == 0:
+                return [self._queue[0]]
+            wait = self.aggregate_ms - time.ticks_diff(time.ticks_ms(), batch[0].queued)
+            if full or wait <= 0 or len(batch) < len(self._queue):
+                return batch
+            self._wake.clear()
+            try:
+                await uasyncio.wait_for_ms(self._wake.wait(), wait)
+            except uasyncio.TimeoutError:
+                pass
+
+    async def _send(self, batch):
+        e = batch[0]
+        count = self._fragments(e)
+        if len(batch) == 1 and count > 1:
+            while len(e.msg_ids) < count:
+                packet = payload.fragment(e.raw, e.ticket, len(e.msg_ids), self.packet_size)
+                msg_id = await self.send(e.app_id, str(binascii.hexlify(packet), "utf8"),
+                                         hold=e.hold, expiry=e.expiry)
+                if not msg_id:
+                    return None
+                self._fragment_sent(e, msg_id)
+                self._append(("F %d %s\n" % (e.ticket, msg_id)).encode())
+                self.packets += 1
+            return e.msg_ids[0]
+        if len(batch) == 1:
+            msg_id = await self.send(e.app_id, e.data, hold=e.hold, expiry=e.expiry)
+        else:
+            packet = payload.pack([(e.app_id, e.raw) for e in batch])
+            msg_id = await self.send(e.app_id, str(binascii.hexlify(packet), "utf8"))
+        if msg_id:
+            self.packets += 1
+        return msg_id
+
+    async def run(self):
+        """Hand queued msgs to the modem, backing off when it refuses."""
+        failures = 0
+        while True:
+            if len(self._queue) == 0:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            if self.ready is not None and not self.ready():
+                await uasyncio.sleep(1)
+                continue
+            batch = await self._take()
+            for e in batch:
+                e.attempts += 1
+            msg_id = None
+            try:
+                msg_id = await self._send(batch)
+            except Exception as err:
+                _log.error("Error %s sending queued msg %s", err, batch[0].ticket)
+            if msg_id:
+                failures = 0
+                self.msgs_sent += len(batch)
+                for e in batch:
+                    self._done(e)
+                    if self.sent_callback is not None:
+                        self.sent_callback(e.ticket, msg_id)
+            elif batch[0].attempts >= _MAX_ATTEMPTS:
+                for e in batch:
+                    _log.warn("Dropping queued msg %s after %s attempts", e.ticket, e.attempts)
+                    self._done(e)
+                    self._forget(e)
+                    if self.error_callback is not None:
+                        self.error_callback(f"msg {e.ticket} rejected by modem")
+            else:
+                failures += 1
+                await uasyncio.sleep(min(self.retry_delay * failures, _MAX_BACKOFF))
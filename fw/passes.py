@@ -0,0 +1,162 @@
+import time
+from micropython import const
+import log
+import metrics
+
+# Learns when satellites pass over from what the modem hears.
+#
+# Swarm's satellites are in sun synchronous orbits so passes over a fixed spot recur at
+# about the same times each day. The day is split into 15 minute slots with a score
+# each (one byte, so the whole history is 96 bytes on flash). Satellites heard ($RT with
+# a TS) and msgs acked ($TD SENT) add to their slot, every score decays by 1/8 a day so
+# the model follows the constellation (and the device) moving. Slots scoring well are
+# the predicted pass windows.
+_log = log.logger("passes")
+_M_HEARD = metrics.counter("passes.heard")
+_G_NEXT = metrics.gauge("passes.next_s")
+
+_SLOTS = const(96)
+_SLOT_S = const(900)
+_DAY_S = const(86400)
+_DAY_MS = const(86400000)
+_HEARD_SCORE = const(16)
+_ACK_SCORE = const(32)
+# A slot needs a couple of observations, and a quarter of the best slot's score, to
+# count as a window.
+_MIN_SCORE = const(32)
+# Scores are only written to flash this often.
+_SAVE_MS = const(3600000)
+# The estimated clock drifts (and ticks wrap), past this long ask the modem again.
+_CLOCK_MAX_MS = const(6 * 3600000)
+
+
+def seconds_of_day(ts: str):
+    """Seconds since midnight (UTC) of a modem timestamp, either $DT's YYYYMMDDhhmmss or
+    $RT's YYYY-MM-DD hh:mm:ss. None if it isn't one."""
+    if ts is None:
+        return None
+    digits = "".join([c for c in ts if "0" <= c <= "9"])
+    if len(digits) < 14:
+        return None
+    return int(digits[8:10]) * 3600 + int(digits[10:12]) * 60 + int(digits[12:14])
+
+
+class PassPredictor():
+    """Predicts the next pass window from a decaying per slot history.
+
+    The clock comes from the modem (set_time), everything else works in seconds of the
+    day. Until the clock is known and some slot has enough history every prediction is
+    None, callers should treat that as "always".
+    """
+
+    def __init__(self, path="passes"):
+        self.path = path
+        self.scores = bytearray(_SLOTS)
+        self.heard_count = 0
+        self._clock = None
+        self._clock_at = 0
+        self._last_ts = None
+        self._decayed_at = time.ticks_ms()
+        self._saved_at = time.ticks_ms()
+        self.dirty = False
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+            if len(data) == _SLOTS:
+                self.scores[:] = data
+        except OSError:
+            pass
+
+    def save(self):
+        try:
+            with open(self.path, "wb") as f:
+                f.write(self.scores)
+            self.dirty = False
+        except Exception as e:
+            _log.error("Error %s saving pass history", e)
+        self._saved_at = time.ticks_ms()
+
+    def set_time(self, ts: str):
+        """Sync the clock to a modem timestamp."""
+        sod = seconds_of_day(ts)
+        if sod is not None:
+            self._clock = sod
+            self._clock_at = time.ticks_ms()
+
+    def clock_stale(self) -> bool:
+        return self._clock is None or \
+            time.ticks_diff(time.ticks_ms(), self._clock_at) > _CLOCK_MAX_MS
+
+    def now(self):
+        """Estimated seconds of the day, None until the modem's told us the time."""
+        if self._clock is None:
+            return None
+        return (self._clock + time.ticks_diff(time.ticks_ms(), self._clock_at) // 1000) % _DAY_S
+
+    def _decay(self):
+        days = time.ticks_diff(time.ticks_ms(), self._decayed_at) // _DAY_MS
+        if days <= 0:
+            return
+        self._decayed_at = time.ticks_add(self._decayed_at, days * _DAY_MS)
+        scores = self.scores
+        for _ in range(min(days, 8)):
+            for i in range(_SLOTS):
+                scores[i] -= scores[i] >> 3
+        self.dirty = True
+
+    def _add(self, sod, score: int):
+        if sod is None:
+            return
+        self._decay()
+        i = sod // _SLOT_S
+        self.scores[i] = min(255, self.scores[i] + score)
+        self.heard_count += 1
+        metrics.inc(_M_HEARD)
+        self.dirty = True
+        if time.ticks_diff(time.ticks_ms(), self._saved_at) > _SAVE_MS:
+            self.save()
+
+    def heard(self, ts: str):
+        """A satellite was heard at ts ($RT TS=), repeats of the same ts are ignored."""
+        if ts is None or ts == self._last_ts:
+            return
+        self._last_ts = ts
+        self._add(seconds_of_day(ts), _HEARD_SCORE)
+
+    def acked(self):
+        """A $TD SENT just now, so a satellite is overhead."""
+        self._add(self.now(), _ACK_SCORE)
+
+    def _threshold(self) -> int:
+        return max(_MIN_SCORE, max(self.scores) // 4)
+
+    def next_window(self):
+        """(seconds until the next window starts, its length in seconds), 0 to start if
+        we're in one now. None when there's no clock or not enough history."""
+        now = self.now()
+        if now is None:
+            return None
+        self._decay()
+        threshold = self._threshold()
+        scores = self.scores
+        first = now // _SLOT_S
+        for k in range(_SLOTS):
+            i = (first + k) % _SLOTS
+            if scores[i] < threshold:
+                continue
+            n = 1
+            while n < _SLOTS and scores[(i + n) % _SLOTS] >= threshold:
+                n += 1
+            start = 0 if k == 0 else (first + k) * _SLOT_S - now
+            end = (first + k + n) * _SLOT_S - now
+            metrics.set_gauge(_G_NEXT, start)
+            return (start, end - start)
+        return None
+
+    def in_window(self) -> bool:
+        """True in a predicted window, or when there's no prediction."""
+        window = self.next_window()
+        return window is None or window[0] == 0
@@ -0,0 +1,388 @@
+import binascii
+import struct
+import time
+from micropython import const
+import log
+import metrics
+
+# Encoded packets start with MAGIC followed by a kind byte, anything else is passed
+# through untouched. Raw packets which happen to start with MAGIC are escaped with
+# KIND_RAW so the receive side never misreads them.
+MAGIC = const(0xB7)
+KIND_RAW = const(0x00)
+KIND_DICT = const(0x01)
+# Several small msgs in one packet, each record is app_id (u16), length (u8), data.
+KIND_AGG = const(0x02)
+HEADER_LEN = const(2)
+RECORD_HEADER = "<HB"
+RECORD_HEADER_LEN = const(3)
+MAX_RECORD = const(255)
+# One piece of a msg too big for a packet, then group (u16), index (u8), count (u8), data.
+KIND_FRAG = const(0x03)
+FRAG_HEADER = "<BBHBB"
+FRAG_HEADER_LEN = const(6)
+MAX_FRAGMENTS = const(255)
+_DEFAULT_REASSEMBLY_BYTES = const(4096)
+# Largest decoded msg, as hex in a MSG line it still fits UARTBluetooth's 2KB tx ring.
+MAX_MSG = const(960)
+# Fragments can be a few passes apart.
+_DEFAULT_REASSEMBLY_MS = const(6 * 60 * 60 * 1000)
+
+_log = log.logger("payload")
+_M_FRAG_ERRORS = metrics.counter("sat.frag_errors")
+_M_FRAG_EXPIRED = metrics.counter("sat.frag_expired")
+
+# LZ77 over a preset dictionary. Tokens:
+#   0x00-0x7F: (token + 1) literal bytes follow
+#   0x80-0xFF: match of (token & 0x7F) + _MIN_MATCH bytes, u16 little endian distance
+#              back from the current position (the dictionary precedes the data).
+_MIN_MATCH = const(4)
+_MAX_MATCH = const(131)
+_MAX_LITERALS = const(128)
+
+# Tuned for short human msgs and our app's JSON. The phone / backend decoders must use
+# the exact same bytes, so only ever append to this.
+DICTIONARY = (
+    b'{"lat":"lon":"alt":"ts":"id":"msg":"type":"status":"battery":"'
+    b'","":true,"":false,"":null}]}'
+    b' the and you are for with that have this will not your what'
+    b' from just know here there when where please thanks thank you'
+    b' OK okay yes no help need safe camp back home tomorrow today'
+    b' tonight morning evening location arrived leaving weather ing tion'
+    b' I am I\'m we are all good love see soon call me water food'
+)
+
+_dict_index = None
+
+
+def _key(buf, i: int) -> int:
+    return buf[i] << 16 | buf[i + 1] << 8 | buf[i + 2]
+
+
+def _index_dict():
+    global _dict_index
+    if _dict_index is None:
+        index = {}
+        for i in range(len(DICTIONARY) - 2):
+            index[_key(DICTIONARY, i)] = i
+        _dict_index = index
+    return _dict_index
+
+
+def _flush_literals(out, window, start: int, end: int):
+    while start < end:
+        n = min(end - start, _MAX_LITERALS)
+        out.append(n - 1)
+        out.extend(window[start:start + n])
+        start += n
+
+
+def compress(data) -> bytes:
+    """Dictionary LZ77 compress data, may be bigger than the input."""
+    window = DICTIONARY + bytes(data)
+    end = len(window)
+    # Copy so positions in this msg don't leak into the shared dictionary index.
+    index = dict(_index_dict())
+    out = bytearray()
+    i = len(DICTIONARY)
+    lit_start = i
+    while i < end:
+        best = 0
+        best_pos = 0
+        if i + _MIN_MATCH <= end:
+            pos = index.get(_key(window, i))
+            if pos is not None:
+                limit = min(_MAX_MATCH, end - i)
+                n = 0
+                while n < limit and window[pos + n] == window[i + n]:
+                    n += 1
+                if n >= _MIN_MATCH:
+                    best = n
+                    best_pos = pos
+        if best == 0:
+            if i + 3 <= end:
+                index[_key(window, i)] = i
+            i += 1
+            continue
+        _flush_literals(out, window, lit_start, i)
+        out.append(0x80 | (best - _MIN_MATCH))
+        dist = i - best_pos
+        out.append(dist & 0xFF)
+        out.append(dist >> 8)
+        for j in range(i, i + best):
+            if j + 3 <= end:
+                index[_key(window, j)] = j
+        i += best
+        lit_start = i
+    _flush_literals(out, window, lit_start, end)
+    return bytes(out)
+
+
+def decompress(data, limit=None) -> bytes:
+    """Undo compress, raises ValueError if the output would be over limit bytes."""
+    out = bytearray(DICTIONARY)
+    if limit is not None:
+        limit += len(DICTIONARY)
+    i = 0
+    n = len(data)
+    while i < n:
+        t = data[i]
+        i += 1
+        if t < 0x80:
+            count = t + 1
+            if i + count > n:
+                raise ValueError("Truncated literals")
+            out.extend(data[i:i + count])
+            i += count
+            if limit is not None and len(out) > limit:
+                raise ValueError("Decompressed msg too big")
+        else:
+            if i + 2 > n:
+                raise ValueError("Truncated match")
+            count = (t & 0x7F) + _MIN_MATCH
+            start = len(out) - (data[i] | data[i + 1] << 8)
+            i += 2
+            if start < 0:
+                raise ValueError("Bad match distance")
+            if limit is not None and len(out) + count > limit:
+                raise ValueError("Decompressed msg too big")
+            for j in range(count):
+                out.append(out[start + j])
+    return bytes(out[len(DICTIONARY):])
+
+
+def pack(records) -> bytes:
+    """Aggregate (app_id, raw bytes) records into one packet."""
+    packet = bytearray((MAGIC, KIND_AGG))
+    for app_id, raw in records:
+        packet.extend(struct.pack(RECORD_HEADER, app_id, len(raw)))
+        packet.extend(raw)
+    return bytes(packet)
+
+
+def unpack(packet) -> list:
+    """Split an aggregate packet back into (app_id, raw bytes) records."""
+    records = []
+    i = HEADER_LEN
+    n = len(packet)
+    while i < n:
+        if i + RECORD_HEADER_LEN > n:
+            raise ValueError("Truncated record header")
+        app_id, length = struct.unpack_from(RECORD_HEADER, packet, i)
+        i += RECORD_HEADER_LEN
+        if i + length > n:
+            raise ValueError("Truncated record")
+        records.append((app_id, bytes(packet[i:i + length])))
+        i += length
+    return records
+
+
+def fragment_count(length: int, packet_size: int) -> int:
+    chunk = packet_size - FRAG_HEADER_LEN
+    return (length + chunk - 1) // chunk
+
+
+def fragment(raw, group: int, index: int, packet_size: int) -> bytes:
+    """The index'th fragment of raw when split to fit packet_size."""
+    chunk = packet_size - FRAG_HEADER_LEN
+    count = fragment_count(len(raw), packet_size)
+    if count > MAX_FRAGMENTS:
+        raise ValueError("Too many fragments")
+    start = index * chunk
+    return struct.pack(FRAG_HEADER, MAGIC, KIND_FRAG, group & 0xFFFF, index, count) + \
+        raw[start:start + chunk]
+
+
+class Reassembly():
+    """Collects $RD fragments until a msg is complete.
+
+    Partial msgs are keyed by (app_id, group) and dropped once they're older than
+    timeout_ms, or oldest first when the buffered bytes would pass max_bytes. A msg
+    growing past max_msg bytes is dropped, nothing could deliver it.
+    """
+
+    def __init__(self, max_bytes=_DEFAULT_REASSEMBLY_BYTES, timeout_ms=_DEFAULT_REASSEMBLY_MS,
+                 max_msg=MAX_MSG):
+        self.max_bytes = max_bytes
+        self.timeout_ms = timeout_ms
+        self.max_msg = max_msg
+        # (app_id, group) -> [started ticks, count, received, parts, bytes]
+        self._partial = {}
+        self._bytes = 0
+        self.completed = 0
+        self.expired = 0
+        self.errors = 0
+
+    def __len__(self):
+        return len(self._partial)
+
+    def _error(self):
+        self.errors += 1
+        metrics.inc(_M_FRAG_ERRORS)
+
+    def _drop(self, key):
+        p = self._partial.pop(key)
+        for part in p[3]:
+            if part is not None:
+                self._bytes -= len(part)
+
+    def expire(self):
+        now = time.ticks_ms()
+        for key in list(self._partial):
+            if time.ticks_diff(now, self._partial[key][0]) > self.timeout_ms:
+                _log.warn("Dropping partial msg %s after timeout", key)
+                self._drop(key)
+                self.expired += 1
+                metrics.inc(_M_FRAG_EXPIRED)
+
+    def add(self, app_id, packet):
+        """Add a KIND_FRAG packet, returns the whole msg once every fragment is in."""
+        self.expire()
+        if len(packet) < FRAG_HEADER_LEN:
+            self._error()
+            return None
+        _, _, group, index, count = struct.unpack_from(FRAG_HEADER, packet, 0)
+        data = bytes(packet[FRAG_HEADER_LEN:])
+        key = (app_id, group)
+        p = self._partial.get(key)
+        if p is not None and p[1] != count:
+            # Group ids wrap, a different msg is reusing this one.
+            self._drop(key)
+            p = None
+        if index >= count or len(data) > self.max_bytes:
+            self._error()
+            return None
+        if p is None:
+            p = [time.ticks_ms(), count, 0, [None] * count, 0]
+            self._partial[key] = p
+        if p[3][index] is not None:
+            # Duplicate.
+            return None
+        if p[4] + len(data) > self.max_msg:
+            _log.warn("Fragmented msg %s is over %s bytes, dropping it", key, self.max_msg)
+            self._drop(key)
+            self._error()
+            return None
+        while self._bytes + len(data) > self.max_bytes:
+            oldest = None
+            for k in self._partial:
+                if k != key and (oldest is None or
+                                 time.ticks_diff(self._partial[k][0],
+                                                 self._partial[oldest][0]) < 0):
+                    oldest = k
+            if oldest is None:
+                self._drop(key)
+                self._error()
+                return None
+            _log.warn("Reassembly buffer full, dropping partial msg %s", oldest)
+            self._drop(oldest)
+        p[3][index] = data
+        p[2] += 1
+        p[4] += len(data)
+        self._bytes += len(data)
+        if p[2] < count:
+            return None
+        self._drop(key)
+        self.completed += 1
+        return b"".join(p[3])
+
+
+class PayloadCodec():
+    """Encodes hex $TD payloads and decodes hex $RD payloads.
+
+    Payloads are compressed when that makes them smaller and marked with a header so
+    decode can undo it, non hex payloads pass straight through. Per app_id raw vs sent
+    byte counts are kept so the compression ratio can be reported. Decoded msgs are at
+    most MAX_MSG bytes, bigger ones are passed through still encoded.
+    """
+
+    def __init__(self, compress=True, reassembly=None):
+        self.compress = compress
+        self.reassembly = reassembly if reassembly is not None else Reassembly()
+        # app_id -> [raw bytes, encoded bytes, packets]
+        self.stats = {}
+
+    def _count(self, app_id, raw: int, encoded: int):
+        s = self.stats.get(app_id)
+        if s is None:
+            s = [0, 0, 0]
+            self.stats[app_id] = s
+        s[0] += raw
+        s[1] += encoded
+        s[2] += 1
+
+    def ratio(self, app_id) -> int:
+        """Encoded size as a percentage of the raw size for app_id (100 = no gain)."""
+        s = self.stats.get(app_id)
+        if s is None or s[0] == 0:
+            return 100
+        return s[1] * 100 // s[0]
+
+    def report(self) -> str:
+        """payload.ratio.{app_id}={ratio} for each app_id sent, e.g. for metrics.add_source."""
+        return " ".join([f"payload.ratio.{app_id}={self.ratio(app_id)}"
+                         for app_id in sorted(self.stats)])
+
+    def encode(self, app_id, data: str) -> str:
+        """Encode a hex payload for the modem."""
+        try:
+            raw = binascii.unhexlify(data)
+        except Exception:
+            return data
+        packet = raw
+        if self.compress and len(raw) > 0:
+            packed = compress(raw)
+            if len(packed) + HEADER_LEN < len(raw):
+                packet = bytes((MAGIC, KIND_DICT)) + packed
+        if packet is raw and len(raw) > 0 and raw[0] == MAGIC:
+            packet = bytes((MAGIC, KIND_RAW)) + raw
+        self._count(app_id, len(raw), len(packet))
+        if packet is raw:
+            return data
+        return str(binascii.hexlify(packet), "utf8")
+
+    def decode(self, app_id, data: str) -> str:
+        """Undo encode on a hex payload from the modem."""
+        try:
+            packet = binascii.unhexlify(data)
+        except Exception:
+            return data
+        if len(packet) < HEADER_LEN or packet[0] != MAGIC:
+            return data
+        kind = packet[1]
+        try:
+            if kind == KIND_RAW:
+                raw = packet[HEADER_LEN:]
+            elif kind == KIND_DICT:
+                raw = decompress(memoryview(packet)[HEADER_LEN:], MAX_MSG)
+            else:
+                return data
+        except Exception as e:
+            _log.error("Error %s decoding payload for %s, passing it through", e, app_id)
+            return data
+        return str(binascii.hexlify(raw), "utf8")
+
+    def decode_all(self, app_id, data: str) -> list:
+        """Like decode but splits aggregate packets and reassembles fragments, returns
+        [(app_id, hex data)] which is empty while fragments are outstanding."""
+        try:
+            packet = binascii.unhexlify(data)
+        except Exception:
+            return [(app_id, data)]
+        if len(packet) >= HEADER_LEN and packet[0] == MAGIC and packet[1] == KIND_FRAG:
+            whole = self.reassembly.add(app_id, packet)
+            if whole is None:
+                return []
+            return self.decode_all(app_id, str(binascii.hexlify(whole), "utf8"))
+        if len(packet) < HEADER_LEN or packet[0] != MAGIC or packet[1] != KIND_AGG:
+            return [(app_id, self.decode(app_id, data))]
+        try:
+            records = unpack(packet)
+        except Exception as e:
+            _log.error("Error %s unpacking aggregate for %s, passing it through", e, app_id)
+            return [(app_id, data)]
+        msgs = []
+        for record_app_id, raw in records:
+            msgs.append((record_app_id,
+                         self.decode(record_app_id, str(binascii.hexlify(raw), "utf8"))))
+        return msgs
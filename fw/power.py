@@ -0,0 +1,192 @@
+import time
+import uasyncio
+from micropython import const
+import governor
+import log
+import metrics
+
+# Sleeps the modem and the ESP32 while no phone is connected and nothing is queued.
+#
+# Each cycle the modem first listens (awake) for listen_s while the ESP32 dozes, then
+# sleeps ($SL) for modem_sleep_s while the ESP32 keeps dozing. A doze is a light sleep
+# of at most latency_ms followed by a short awake window for BLE and the other tasks, so
+# a phone connecting, a msg waiting (the modem's GPIO1 on rx_pin, which also wakes a
+# light sleep) or the modem's timer wake is noticed within latency_ms. On waking the
+# modem's inbox is drained to flash. A light sleep suspends BLE advertising too, so
+# dozes are plain uasyncio sleeps until the advertiser is at its slow stage.
+#
+# With a PassPredictor the cycle follows the predicted pass windows instead: listen
+# through a window, then sleep the modem until the next one (checking the inbox on each
+# wake). Every few cycles the fixed listen / sleep cycle runs anyway so passes outside
+# the known windows are still heard and learnt.
+#
+# UART input during a light sleep is lost. Msgs the modem pushes stay unread on it until
+# the drain, the $SL WAKE is followed up by Satellite.wake, and we don't doze at all
+# while the modem has msgs to send (their $TD SENT acks would be lost).
+_log = log.logger("power")
+_M_MODEM_SLEEPS = metrics.counter("power.modem_sleeps")
+_M_DOZE_MS = metrics.counter("power.doze_ms")
+_M_SLOW_WAKES = metrics.counter("power.slow_wakes")
+_H_WAKE = metrics.histogram("power.wake_ms")
+
+_DEFAULT_LISTEN_S = const(300)
+_DEFAULT_MODEM_SLEEP_S = const(900)
+_DEFAULT_LATENCY_MS = const(1000)
+# Awake between dozes, long enough for BLE connects and queued tasks.
+_AWAKE_MS = const(50)
+# Don't doze within this long of work being signalled (see governor.busy).
+_QUIET_MS = const(2000)
+# The modem's own wake can be a little late.
+_WAKE_SLACK_MS = const(5000)
+# How often to check again while the modem still has msgs to send.
+_UNSENT_RECHECK_S = const(60)
+_DEFAULT_MAX_SLEEP_S = const(3600)
+# Shorter gaps before a window are spent listening.
+_MIN_SLEEP_S = const(60)
+# Every this many cycles ignore the predicted windows.
+_EXPLORE_EVERY = const(4)
+# $RT output rate (s) while the ESP32 is awake to hear it.
+_RT_RATE_S = const(60)
+
+
+class PowerManager():
+    """Runs the sleep cycle for sat (a Satellite).
+
+    idle is a callable returning True when nothing needs the device awake (no phone
+    connected, nothing queued). rx_pin is the pin wired to the modem's GPIO1 (a
+    machine.Pin or any callable returning its level), None to rely on timers alone.
+    lightsleep is machine.lightsleep, without it dozes are plain uasyncio sleeps.
+    advertiser is the advertising.Advertiser, light sleeps wait for it to be slow.
+    passes is a PassPredictor, the modem then sleeps (for up to max_sleep_s) between the
+    predicted windows.
+    """
+
+    def __init__(self, sat, idle, rx_pin=None, listen_s=_DEFAULT_LISTEN_S,
+                 modem_sleep_s=_DEFAULT_MODEM_SLEEP_S, latency_ms=_DEFAULT_LATENCY_MS,
+                 lightsleep=None, awake_ms=_AWAKE_MS, passes=None,
+                 max_sleep_s=_DEFAULT_MAX_SLEEP_S, advertiser=None):
+        self.sat = sat
+        self.idle = idle
+        self.rx_pin = rx_pin
+        self.listen_s = listen_s
+        self.modem_sleep_s = modem_sleep_s
+        self.latency_ms = latency_ms
+        self.awake_ms = awake_ms
+        self._lightsleep = lightsleep
+        self.passes = passes
+        self.max_sleep_s = max_sleep_s
+        self.advertiser = advertiser
+        self.cycles = 0
+        self.dozes = 0
+        self.wakes = 0
+        # Set when the pin stayed high after a drain, ignored until it goes low.
+        self._rx_stuck = False
+
+    def _rx_waiting(self) -> bool:
+        if self.rx_pin is None:
+            return False
+        high = self.rx_pin() == 1
+        if not high:
+            self._rx_stuck = False
+        return high and not self._rx_stuck
+
+    async def _doze(self):
+        quiet = governor.quiet_ms()
+        if self._lightsleep is not None and (quiet is None or quiet >= _QUIET_MS) and \
+                (self.advertiser is None or self.advertiser.slow()):
+            self._lightsleep(self.latency_ms)
+            self.dozes += 1
+            metrics.inc(_M_DOZE_MS, self.latency_ms)
+            await uasyncio.sleep_ms(self.awake_ms)
+        else:
+            await uasyncio.sleep_ms(self.latency_ms)
+
+    async def _doze_until(self, ms: int, modem_wake=False) -> bool:
+        """Doze for up to ms, returns True if it ended early because the phone connected,
+        a msg is waiting or (with modem_wake) the modem woke up."""
+        start = time.ticks_ms()
+        while time.ticks_diff(time.ticks_ms(), start) < ms:
+            if not self.idle() or self._rx_waiting() or (modem_wake and self.sat.awake):
+                return True
+            await self._doze()
+        return False
+
+    async def _drain(self):
+        await self.sat.read_all_msgs()
+        if self.passes is not None:
+            # The last satellite heard, and the time if ours has drifted.
+            await self.sat.send_command("$RT @")
+            if self.passes.clock_stale():
+                await self.sat.send_command("$DT @")
+
+    async def _resume(self, start):
+        """Wake the modem if needed and drain its inbox, start is when we noticed."""
+        try:
+            if not self.sat.awake:
+                await self.sat.wake()
+            await self._drain()
+        except Exception as e:
+            _log.error("Error %s draining the modem after waking", e)
+        self._rx_stuck = self.rx_pin is not None and self.rx_pin() == 1
+        ms = time.ticks_diff(time.ticks_ms(), start)
+        self.wakes += 1
+        metrics.observe(_H_WAKE, ms)
+        if ms > self.latency_ms:
+            metrics.inc(_M_SLOW_WAKES)
+            _log.warn("Wake took %sms, over the %sms budget", ms, self.latency_ms)
+
+    def plan(self):
+        """(listen_s, modem_sleep_s) for the next cycle."""
+        self.cycles += 1
+        window = None
+        if self.passes is not None and self.cycles % _EXPLORE_EVERY != 0:
+            window = self.passes.next_window()
+        if window is None:
+            return (self.listen_s, self.modem_sleep_s)
+        start, length = window
+        if start == 0:
+            return (length, 0)
+        if start < _MIN_SLEEP_S:
+            return (start, 0)
+        return (0, min(start, self.max_sleep_s))
+
+    async def cycle(self):
+        """One listen / sleep cycle, returns early once the device is needed."""
+        if await self.sat.unsent_count() != 0:
+            await uasyncio.sleep(_UNSENT_RECHECK_S)
+            return
+        listen_s, sleep_s = self.plan()
+        if await self._doze_until(listen_s * 1000):
+            await self._resume(time.ticks_ms())
+            return
+        if self.rx_pin is None and listen_s > 0:
+            # Nothing told us about msgs which arrived while listening.
+            await self._drain()
+        if sleep_s <= 0 or not self.idle():
+            return
+        if not await self.sat.sleep(sleep_s):
+            return
+        metrics.inc(_M_MODEM_SLEEPS)
+        await self._doze_until(sleep_s * 1000 + _WAKE_SLACK_MS, modem_wake=True)
+        await self._resume(time.ticks_ms())
+
+    async def run(self):
+        while not self.sat.modem_started:
+            await uasyncio.sleep(1)
+        try:
+            if not await self.sat.sleep_until_rx_watch():
+                _log.warn("Modem didn't take $GP 6, waking on timers only.")
+                self.rx_pin = None
+        except Exception as e:
+            _log.error("Error %s setting up the modem RX pin.", e)
+            self.rx_pin = None
+        if self.passes is not None:
+            await self.sat.send_command(f"$RT {_RT_RATE_S}")
+            await self.sat.send_command("$DT @")
+        while True:
+            if self.idle():
+                try:
+                    await self.cycle()
+                except Exception as e:
+                    _log.error("Error %s in sleep cycle", e)
+            await uasyncio.sleep_ms(self.latency_ms)
@@ -0,0 +1,158 @@
+import sys
+import uasyncio
+from micropython import const
+import governor
+import log
+import metrics
+
+# Modem commands from the USB serial port, for bench provisioning & debugging.
+#
+# Commands are framed as MODEM{commands}TIMBITLOVESYOU, anything outside a frame (e.g.
+# REPL noise) is ignored. Input is read in bulk into one buffer whenever the port has
+# data (no polling) and scanned a byte at a time for the framing, so frames may be split
+# over reads in any way. Each line of a frame is sent to the modem as a command and the
+# modem's reply printed. Replies are matched so a bench command never takes a line the
+# Satellite needs ($TD SENT acks, $RD msgs, $RT / $DT reports still reach its handlers).
+_log = log.logger("bridge")
+_M_FRAMES = metrics.counter("bridge.frames")
+_M_OVERFLOWS = metrics.counter("bridge.overflows")
+
+START_MAGIC = b"MODEM"
+END_MAGIC = b"TIMBITLOVESYOU"
+_BUF_SIZE = const(256)
+# Longest frame (with the end magic), longer frames are dropped.
+_MAX_FRAME = const(512)
+
+
+def _unsolicited(line: str) -> bool:
+    """Lines the modem only sends unprompted, which are never a command's reply."""
+    return line.startswith("$TD SENT") or line.startswith("$RD ") or \
+        line.startswith("$SL WAKE") or line.startswith("$M138 ")
+
+
+def _shared(line: str) -> bool:
+    """$RT / $DT reports, both the reply to a query (e.g. $RT @) and sent unprompted."""
+    return (line.startswith("$RT ") or line.startswith("$DT ")) and \
+        not line.startswith("$RT OK") and not line.startswith("$DT OK") and \
+        " ERR" not in line
+
+
+class _Matcher():
+    """Streaming (KMP) matcher for one pattern, a byte at a time."""
+    __slots__ = ("pattern", "fail", "pos")
+
+    def __init__(self, pattern: bytes):
+        self.pattern = pattern
+        # fail[i] is the length of the longest proper prefix of pattern[:i + 1] which is
+        # also its suffix, where to carry on from after a mismatch.
+        self.fail = bytearray(len(pattern))
+        k = 0
+        for i in range(1, len(pattern)):
+            while k > 0 and pattern[i] != pattern[k]:
+                k = self.fail[k - 1]
+            if pattern[i] == pattern[k]:
+                k += 1
+            self.fail[i] = k
+        self.pos = 0
+
+    def step(self, c: int) -> bool:
+        """Feed a byte, True when it completes the pattern."""
+        pattern = self.pattern
+        pos = self.pos
+        while pos > 0 and c != pattern[pos]:
+            pos = self.fail[pos - 1]
+        if c == pattern[pos]:
+            pos += 1
+        if pos == len(pattern):
+            self.pos = 0
+            return True
+        self.pos = pos
+        return False
+
+
+class SerialBridge():
+    """Forwards framed commands from stream (default stdin) to sat, a Satellite.
+
+    out is called with each modem reply (and errors), print by default.
+    """
+
+    def __init__(self, sat, stream=None, out=print, buf_size=_BUF_SIZE,
+                 max_frame=_MAX_FRAME):
+        self.sat = sat
+        self.stream = stream
+        self.out = out
+        self._buf = bytearray(buf_size)
+        self._mv = memoryview(self._buf)
+        self._start = _Matcher(START_MAGIC)
+        self._end = _Matcher(END_MAGIC)
+        self._frame = bytearray(max_frame)
+        # Bytes of the current frame, -1 outside a frame.
+        self._length = -1
+        # Complete frames waiting to be forwarded.
+        self.ready = []
+        self.frames = 0
+        self.overflows = 0
+
+    def feed(self, data):
+        """Scan data (any split of the input) for frames, adding them to ready."""
+        frame = self._frame
+        for c in data:
+            n = self._length
+            if n < 0:
+                if self._start.step(c):
+                    self._length = 0
+                continue
+            if n == len(frame):
+                # Too long, drop it and look for the next one.
+                self._length = -1
+                self._end.pos = 0
+                self.overflows += 1
+                metrics.inc(_M_OVERFLOWS)
+                _log.warn("Dropped a serial frame over %s bytes", len(frame))
+                continue
+            frame[n] = c
+            self._length = n + 1
+            if self._end.step(c):
+                self.ready.append(bytes(frame[:n + 1 - len(END_MAGIC)]))
+                self._length = -1
+                self.frames += 1
+                metrics.inc(_M_FRAMES)
+
+    async def forward(self, payload: bytes):
+        """Send each line of payload to the modem as a command, any checksum on it is
+        recomputed. The lock is only held for one command at a time."""
+        for line in payload.decode().split("\n"):
+            command = line.strip()
+            star = command.find("*")
+            if star >= 0:
+                command = command[:star]
+            if len(command) < 3:
+                continue
+            kind = command[:3]
+            try:
+                async with self.sat.lock:
+                    reply = await self.sat.send_expect(
+                        command, lambda line: line.startswith(kind) and not _unsolicited(line),
+                        retry=1)
+                if _shared(reply):
+                    # Might be the background report rather than our reply, either way
+                    # the Satellite's handlers still need to see it.
+                    self.sat.dispatcher.dispatch(reply)
+                self.out(reply)
+            except Exception as e:
+                _log.error("Error %s sending %s from serial", e, command)
+                self.out(f"ERROR {e}")
+
+    async def run(self):
+        stream = self.stream
+        if stream is None:
+            stream = uasyncio.StreamReader(sys.stdin.buffer)
+        while True:
+            n = await stream.readinto(self._buf)
+            if not n:
+                _log.warn("Serial input closed")
+                return
+            governor.busy()
+            self.feed(self._mv[:n])
+            while len(self.ready) > 0:
+                await self.forward(self.ready.pop(0))
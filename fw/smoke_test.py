@@ -2,7 +2,34 @@ import unittest
 from Satellite import Satellite
 from UARTBluetooth import UARTBluetooth
 import uasyncio
-from test_utils import FakeUART
+import os
+from test_utils import FakeBLE, FakeDisplay, FakeUART, nmea
+from display_wrapper import DisplayWrapper
+from nmea import NMEACodec
+from outbox import Outbox, QueueFull
+from inbox import Inbox
+from ble_rx import Reassembler
+import binproto
+import payload
+import log
+import metrics
+import governor
+import advertising
+from power import PowerManager
+from passes import PassPredictor, seconds_of_day
+from config import Config
+from firmware import FirmwareStore
+from serial_bridge import SerialBridge
+import firmware
+import hashlib
+import bench
+import modem_sim
+from modem_sim import M138Sim
+import sys
+import binascii
+import struct
+import time
+from modem_msgs import Dispatcher, RDMsg, TDMsg, TimeMsg
 
 
 class TestStringMethods(unittest.TestCase):
@@ -100,34 +127,1180 @@ class SatelliteSmokeTest(unittest.TestCase):
         self.assertEqual(msg_id, "1")
 
 
-class FakeBLE():
+class SatelliteDemuxTest(unittest.TestCase):
+
+    def test_unsolicited_interleaved(self):
+        acked = []
+        conn = FakeUART(lines=[
+            nmea("$TD SENT RSSI=-98,SNR=1,FDEV=2,5"),
+            nmea("$MM 3")])
+        s = Satellite(1, myconn=conn, msg_acked_callback=acked.append)
+        self.assertEqual(uasyncio.run(s.check_for_msgs()), 3)
+        self.assertEqual(acked, ["5"])
+        self.assertEqual(s._pending, [])
+
+    def test_send_msg_hold_expiry(self):
+        conn = FakeUART(lines=[nmea("$TD SENT RSSI=1,SNR=1,FDEV=1,5"), nmea("$TD OK,77")])
+        s = Satellite(1, myconn=conn)
+        s.ready = True
+        self.assertEqual(uasyncio.run(s.send_msg(3, "hi", hold=60, expiry=99)), "77")
+        self.assertEqual(conn.sent_lines[0].split("*")[0], "$TD HD=60,ET=99,AI=3,hi")
+
+    def test_route_in_order(self):
+        s = Satellite(1, myconn=FakeUART())
+        counts = []
+
+        async def pipelined():
+            s.reader_task = True
+            tasks = [uasyncio.create_task(s.check_for_msgs()) for _ in range(2)]
+            await uasyncio.sleep(0)
+            self.assertEqual(len(s._pending), 2)
+            self.assertFalse(s._route("$TD OK,1"))
+            self.assertTrue(s._route("$MM 1"))
+            self.assertTrue(s._route("$MM 2"))
+            for t in tasks:
+                counts.append(await t)
+
+        uasyncio.run(pipelined())
+        self.assertEqual(counts, [1, 2])
+
+    def test_route_mm_errors_to_their_command(self):
+        s = Satellite(1, myconn=FakeUART())
+        got = []
+
+        async def count_and_read():
+            s.reader_task = True
+            count = uasyncio.create_task(s.check_for_msgs())
+            read = uasyncio.create_task(s.read_msg())
+            await uasyncio.sleep(0)
+            self.assertEqual(len(s._pending), 2)
+            # A read's no-more-msgs error must not complete the older count.
+            self.assertTrue(s._route("$MM ERR,DBXNOMORE"))
+            got.append(await uasyncio.wait_for(read, 1))
+            self.assertTrue(s._route("$MM 2"))
+            got.append(await uasyncio.wait_for(count, 1))
+            # An error either could get goes to the oldest.
+            count = uasyncio.create_task(s.check_for_msgs())
+            read = uasyncio.create_task(s.read_msg())
+            await uasyncio.sleep(0)
+            self.assertTrue(s._route("$MM ERR,BADPARAM"))
+            got.append(await uasyncio.wait_for(count, 1))
+            self.assertEqual(len(s._pending), 1)
+            s._route("$MM ERR,DBXNOMORE")
+            got.append(await uasyncio.wait_for(read, 1))
+
+        uasyncio.run(count_and_read())
+        self.assertEqual(got, [None, 2, -1, None])
+
+
+class InboxDrainTest(unittest.TestCase):
+
+    def test_drain_bulk_delete(self):
+        lines = [nmea("$MM 3")]
+        for i in range(3):
+            lines.append(nmea(f"$MM {i},4142{i},{10 + i},1"))
+        conn = FakeUART(lines=lines)
+        got = []
+        s = Satellite(1, myconn=conn,
+                      new_msg_callback=lambda app_id, data: got.append((app_id, data)))
+        self.assertEqual(uasyncio.run(s.read_all_msgs(window=2)), 3)
+        self.assertEqual(got, [(0, "41420"), (1, "41421"), (2, "41422")])
+        sent = [line.split("*")[0] for line in conn.sent_lines]
+        self.assertEqual(sent, ["$MM C=U", "$MM R=O", "$MM R=O", "$MM R=O", "$MM D=R"])
+
+    def test_drain_partial_failure(self):
+        conn = FakeUART(lines=[nmea("$MM 2"), nmea("$MM 5,AA,50,1"), nmea("$MM garbage")])
+        s = Satellite(1, myconn=conn, new_msg_callback=lambda app_id, data: None)
+        self.assertEqual(uasyncio.run(s.read_all_msgs()), 1)
+        self.assertEqual(conn.sent_lines[-1].split("*")[0], "$MM D=50")
+
+
+class OutboxTest(unittest.TestCase):
+    path = "outbox_test"
+
+    def tearDown(self):
+        for p in (self.path, self.path + ".tmp"):
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+    def test_journal_replay(self):
+        o = Outbox(None, path=self.path, capacity=2)
+        self.assertEqual(o.put(1, "hi there"), (1, 1))
+        self.assertEqual(o.put(2, "bye,now", hold=60, expiry=1700000000), (2, 2))
+        self.assertRaises(QueueFull, o.put, 3, "nope")
+        o._done(o._queue[0])
+        replayed = Outbox(None, path=self.path)
+        self.assertEqual(len(replayed), 1)
+        e = replayed._queue[0]
+        self.assertEqual((e.ticket, e.app_id, e.data, e.hold, e.expiry),
+                         (2, 2, "bye,now", 60, 1700000000))
+        self.assertEqual(replayed.put(1, "x"), (3, 2))
+
+    def test_torn_journal(self):
+        o = Outbox(None, path=self.path)
+        o.put(1, "kept")
+        with open(self.path, "ab") as f:
+            f.write(b"A 2 1 - - 10\npart")
+        replayed = Outbox(None, path=self.path)
+        self.assertEqual(len(replayed), 1)
+        self.assertEqual(len(Outbox(None, path=self.path)), 1)
+
+    def test_run_sends_in_order(self):
+        sent = []
+        acked = []
+
+        async def send(app_id, data, hold=None, expiry=None):
+            sent.append((app_id, data, hold))
+            return str(100 + len(sent))
+
+        o = Outbox(send, path=self.path, sent_callback=lambda t, m: acked.append((t, m)))
+        o.put(1, "a", hold=5)
+        o.put(2, "b")
+
+        async def drive():
+            task = uasyncio.create_task(o.run())
+            while len(acked) < 2:
+                await uasyncio.sleep(0)
+            task.cancel()
+
+        uasyncio.run(drive())
+        self.assertEqual(sent, [(1, "a", 5), (2, "b", None)])
+        self.assertEqual(acked, [(1, "101"), (2, "102")])
+
+    def test_aggregates_small_msgs(self):
+        sent = []
+        acked = []
+
+        async def send(app_id, data, hold=None, expiry=None):
+            sent.append((app_id, data))
+            return str(100 + len(sent))
+
+        o = Outbox(send, path=self.path, sent_callback=lambda t, m: acked.append((t, m)),
+                   aggregate_ms=50)
+        o.put(1, "0102")
+        o.put(2, "03")
+        o.put(3, "not hex")
+
+        async def drive():
+            task = uasyncio.create_task(o.run())
+            while len(acked) < 3:
+                await uasyncio.sleep(0)
+            task.cancel()
+
+        uasyncio.run(drive())
+        self.assertEqual(sent, [(1, "b702" + "010002" + "0102" + "020001" + "03"),
+                                (3, "not hex")])
+        self.assertEqual(acked, [(1, "101"), (2, "101"), (3, "102")])
+        self.assertEqual((o.packets, o.msgs_sent), (2, 3))
+
+    def test_fragments_large_msgs(self):
+        sent = []
+        acked = []
+        raw = bytes(range(256)) + bytes(144)
+        fail = [2]
+
+        async def send(app_id, data, hold=None, expiry=None):
+            if len(sent) == fail[0]:
+                fail[0] = -1
+                return ""
+            sent.append(binascii.unhexlify(data))
+            return str(100 + len(sent))
+
+        o = Outbox(send, path=self.path, sent_callback=lambda t, m: acked.append((t, m)),
+                   retry_delay=0)
+        o.put(7, str(binascii.hexlify(raw), "utf8"))
+
+        async def drive(o, done):
+            task = uasyncio.create_task(o.run())
+            while not done():
+                await uasyncio.sleep(0)
+            task.cancel()
+
+        uasyncio.run(drive(o, lambda: len(sent) == 2))
+        # Resumes from the third fragment after a reboot.
+        o = Outbox(send, path=self.path, sent_callback=lambda t, m: acked.append((t, m)),
+                   retry_delay=0)
+        self.assertEqual(o._queue[0].msg_ids, ["101", "102"])
+        uasyncio.run(drive(o, lambda: len(acked) == 1))
+        self.assertEqual(len(sent), 3)
+        self.assertEqual(acked, [(1, "101")])
+        self.assertEqual([p[:6] for p in sent], [b"\xb7\x03\x01\x00\x00\x03",
+                                                 b"\xb7\x03\x01\x00\x01\x03",
+                                                 b"\xb7\x03\x01\x00\x02\x03"])
+        self.assertTrue(all(len(p) <= 192 for p in sent))
+        # Only the last fragment's SENT is passed on, as the msg id the phone got.
+        self.assertEqual([o.acked(m) for m in ["102", "101", "999", "103"]],
+                         [None, None, "999", "101"])
+        codec = payload.PayloadCodec()
+        msgs = []
+        for p in reversed(sent):
+            msgs += codec.decode_all(7, str(binascii.hexlify(p), "utf8"))
+        self.assertEqual(msgs, [(7, str(binascii.hexlify(raw), "utf8"))])
+        self.assertEqual(len(Outbox(None, path=self.path)), 0)
+
+    def test_unacked_fragments_bounded(self):
+        o = Outbox(None, path=self.path, capacity=16)
+        for i in range(10):
+            o.put(7, "AB" * 400)
+            e = o._queue[0]
+            o._fragment_sent(e, f"{i}a")
+            o._fragment_sent(e, f"{i}b")
+            o._done(e)
+        # Only the newest msgs' SENTs are still waited on.
+        self.assertEqual(sorted(o._unacked), list(range(3, 11)))
+        self.assertEqual(len(o._fragment_owner), 16)
+        self.assertEqual(o.acked("0b"), "0b")
+        # And not for longer than the modem would hold them.
+        o._unacked[3][2] = time.ticks_add(time.ticks_ms(), -172800001)
+        self.assertEqual(o.acked("9a"), None)
+        self.assertNotIn(3, o._unacked)
+        self.assertEqual(o.acked("2b"), "2b")
+        self.assertEqual(o.acked("9b"), "9a")
+        self.assertEqual(len(o._unacked), 6)
+
+
+class InboxTest(unittest.TestCase):
+    path = "inbox_test"
+
+    def tearDown(self):
+        for p in (self.path, self.path + ".tmp"):
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+    def _stream(self, inbox):
+        async def drive():
+            task = uasyncio.create_task(inbox.run())
+            for _ in range(10):
+                await uasyncio.sleep(0)
+            task.cancel()
+
+        uasyncio.run(drive())
+
+    def test_store_and_forward(self):
+        sent = []
+        acked = []
+        inbox = Inbox(lambda seq, app_id, data: sent.append((seq, app_id, data)),
+                      path=self.path, acked_callback=acked.append)
+        self.assertEqual(inbox.put(5, "AABB"), 1)
+        self.assertEqual(inbox.put(6, "CC"), 2)
+        # Nothing is sent while disconnected
+        self._stream(inbox)
+        self.assertEqual(sent, [])
+        inbox.set_connected(True)
+        self._stream(inbox)
+        self.assertEqual(sent, [(1, 5, "AABB"), (2, 6, "CC")])
+        inbox.ack(1)
+        self.assertEqual(acked, [1])
+        # Survives a reboot, and the seq keeps increasing after compaction.
+        replayed = Inbox(None, path=self.path)
+        self.assertEqual(len(replayed), 1)
+        self.assertEqual(replayed._read(replayed._index[0][1]), (6, "CC"))
+        replayed.ack(2)
+        self.assertEqual(len(Inbox(None, path=self.path)), 0)
+        self.assertEqual(Inbox(None, path=self.path).put(1, "DD"), 3)
+
+    def test_drops_msgs_too_big_to_send(self):
+        f = FakeBLE()
+        b = UARTBluetooth("test", ble=f)
+        b.connected = True
+        inbox = Inbox(lambda seq, app_id, data: b.send_msg(app_id, data, seq), path=self.path)
+        inbox.put(5, "AB" * 1100)
+        inbox.put(6, "CC")
+        inbox.set_connected(True)
+
+        async def drive():
+            task = uasyncio.create_task(inbox.run())
+            for _ in range(500):
+                if inbox._next == len(inbox) and b._tx_in == b._tx_out:
+                    break
+                await uasyncio.sleep_ms(1)
+            task.cancel()
+
+        uasyncio.run(drive())
+        # The msg behind the one that can't fit still goes out, once.
+        self.assertEqual(f.notified[1:], [b"MSG 6 CC 2"])
+        self.assertEqual(len(inbox), 1)
+        self.assertEqual(len(Inbox(None, path=self.path)), 1)
+
+    def test_bounded(self):
+        inbox = Inbox(None, path=self.path, max_bytes=64)
+        for i in range(10):
+            inbox.put(i, "0123456789")
+        self.assertTrue(inbox._size <= 64)
+        self.assertEqual(inbox._index[-1][0], 10)
+
+
+class NMEACodecTest(unittest.TestCase):
+
+    def test_frame_valid(self):
+        codec = NMEACodec()
+        self.assertEqual(codec.frame(b"$M138 BOOT,RUNNING*2A\r\n"), len("$M138 BOOT,RUNNING"))
+        self.assertEqual(codec.text(), "$M138 BOOT,RUNNING")
+        self.assertTrue(codec.startswith(b"$M138"))
+        self.assertFalse(codec.startswith(b"$MM"))
+        self.assertEqual(codec.frame("$MM 0*10"), 5)
+
+    def test_frame_invalid(self):
+        codec = NMEACodec()
+        self.assertEqual(codec.frame(b"$M138 BOOT,RUNNING*48\n"), -1)
+        self.assertEqual(codec.frame("butts"), -1)
+        self.assertEqual(codec.frame(""), -1)
+        self.assertEqual(codec.text(), None)
+        self.assertEqual(codec.bad_checksums, 3)
+
+    def test_encode(self):
+        codec = NMEACodec()
+        n = codec.encode("$MM 0")
+        self.assertEqual(bytes(codec.tx_mv[0:n]), b"$MM 0*10\n")
+        n = codec.encode(b"$TD AI=", "12", b",", b"hi")
+        self.assertEqual(codec.frame(codec.tx_mv[0:n]), n - 4)
+
+    def test_satellite_send_command(self):
+        conn = FakeUART()
+        s = Satellite(1, myconn=conn)
+        uasyncio.run(s.send_command("$MM C=U"))
+        self.assertEqual(conn.sent_lines, ["$MM C=U*%s\n" % s._checksum_formatted("$MM C=U")])
+        self.assertEqual(s._validate_msg(conn.sent_lines[0]), "$MM C=U")
+
+
+class ModemMsgTest(unittest.TestCase):
+
+    def test_lazy_fields(self):
+        d = Dispatcher()
+        got = []
+        d.register("RD", got.append, RDMsg)
+        d.register("TD", got.append, TDMsg)
+        d.register("RT", got.append, TimeMsg)
+        d.register("DT", got.append, TimeMsg)
+        self.assertTrue(d.dispatch("$RD AI=12,RSSI=-100,SNR=3,FDEV=-5,68656C6C6F2C"))
+        self.assertTrue(d.dispatch("$TD SENT RSSI=-98,SNR=1,FDEV=2,4242"))
+        self.assertTrue(d.dispatch("$RT RSSI=-104,SNR=-1,FDEV=426,TS=2021-03-01 12:00:00,DI=0x1"))
+        self.assertTrue(d.dispatch("$DT 20190408195123,V"))
+        self.assertFalse(d.dispatch("$GP 6"))
+        rd, td, rt, dt = got
+        self.assertEqual(rd.app_id, 12)
+        self.assertEqual(rd.rssi, -100)
+        self.assertEqual(rd.snr, 3)
+        self.assertEqual(rd.fdev, -5)
+        self.assertEqual(rd.data, "68656C6C6F2C")
+        self.assertEqual(td.status, "SENT")
+        self.assertEqual(td.msg_id, "4242")
+        self.assertEqual(rt.timestamp, "2021-03-01 12:00:00")
+        self.assertEqual(dt.timestamp, "20190408195123")
+
+    def test_satellite_dispatch(self):
+        acked = []
+        msgs = []
+        misc = []
+        s = Satellite(1, myconn=FakeUART(), msg_acked_callback=acked.append,
+                      new_msg_callback=lambda app_id, data: msgs.append((app_id, data)),
+                      misc_callback=misc.append)
+        uasyncio.run(s._line_handle_validated("$TD SENT RSSI=-98,SNR=1,FDEV=2,99"))
+        uasyncio.run(s._line_handle_validated("$RD AI=7,RSSI=-100,SNR=3,FDEV=-5,ABCD"))
+        uasyncio.run(s._line_handle_validated("$M138 BOOT,RUNNING"))
+        uasyncio.run(s._line_handle_validated("$GP 6"))
+        self.assertEqual(acked, ["99"])
+        self.assertEqual(msgs, [(7, "ABCD")])
+        self.assertTrue(s.modem_started)
+        self.assertEqual(misc, ["$GP 6"])
+        gp = []
+        s.register_handler("GP", gp.append)
+        uasyncio.run(s._line_handle_validated("$GP 6"))
+        self.assertEqual(gp[0].contents, "6")
+
+
+def _frame(payload: bytes) -> bytes:
+    return len(payload).to_bytes(4, "little") + payload
+
+
+class ReassemblerTest(unittest.TestCase):
+
+    def test_split_and_combined(self):
+        r = Reassembler(64)
+        data = _frame(b"Qhello") + _frame(b"") + _frame(b"P123")
+        # Byte at a time
+        for i in range(len(data)):
+            r.feed(data[i:i + 1])
+        # All at once
+        self.assertEqual(r.feed(data), 3)
+        got = []
+        while r.peek() is not None:
+            got.append(bytes(r.peek()))
+            r.release()
+        self.assertEqual(got, [b"Qhello", b"", b"P123"] * 2)
+
+    def test_wrap_and_limits(self):
+        r = Reassembler(16, max_frames=2)
+        r.feed(_frame(b"0123456789"))
+        r.release()
+        r.feed(_frame(b"abcdefgh"))
+        # Doesn't fit at the tail, wraps to the start of the ring.
+        r.feed(_frame(b"ABCDEF"))
+        self.assertEqual(bytes(r.peek()), b"abcdefgh")
+        r.release()
+        self.assertEqual(bytes(r.peek()), b"ABCDEF")
+        # Too big for the ring & a full queue are both skipped without losing sync.
+        r.feed(_frame(b"x" * 20) + _frame(b"ok"))
+        self.assertEqual(r.errors, 1)
+        r.feed(_frame(b"no"))
+        self.assertEqual(r.dropped, 1)
+        r.release()
+        self.assertEqual(bytes(r.peek()), b"ok")
+
+    def test_wrapped_full_ring(self):
+        r = Reassembler(1024)
+        r.feed(_frame(b"A" * 500) + _frame(b"B" * 500))
+        r.release()
+        r.feed(_frame(b"C" * 400) + _frame(b"D" * 100))
+        # The wrapped frames end where the B's start, so there's no room left.
+        r.feed(_frame(b"E" * 20))
+        self.assertEqual(r.dropped, 1)
+        for expected in (b"B" * 500, b"C" * 400, b"D" * 100):
+            self.assertEqual(bytes(r.peek()), expected)
+            r.release()
+
+
+class PayloadCodecTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for msg in [b"I am safe at camp, back home tomorrow. love you",
+                    b'{"lat":45.1234,"lon":-122.5678,"battery":87}',
+                    b"aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa",
+                    b"", b"x", bytes(range(200))]:
+            self.assertEqual(payload.decompress(payload.compress(msg)), msg)
+
+    def test_codec(self):
+        codec = payload.PayloadCodec()
+        text = str(binascii.hexlify(b"Need water and food, please call me when you are back"),
+                   "utf8")
+        encoded = codec.encode(3, text)
+        self.assertTrue(encoded.startswith("b701"))
+        self.assertTrue(len(encoded) < len(text))
+        self.assertEqual(codec.decode(3, encoded), text)
+        self.assertTrue(codec.ratio(3) < 80)
+        # Reported in the stats per app_id.
+        metrics.add_source(codec.report)
+        self.assertIn(f"payload.ratio.3={codec.ratio(3)}", metrics.snapshot().split())
+        # Incompressible and non hex payloads go through as is, magic is escaped.
+        self.assertEqual(codec.encode(4, "0102"), "0102")
+        self.assertEqual(codec.encode(4, "not hex"), "not hex")
+        self.assertEqual(codec.encode(4, "b70102"), "b700b70102")
+        self.assertEqual(codec.decode(4, "b700b70102"), "b70102")
+        self.assertEqual(codec.decode(4, "0102"), "0102")
+
+    def test_aggregate(self):
+        codec = payload.PayloadCodec()
+        packed = codec.encode(3, str(binascii.hexlify(b"Need water and food, please"), "utf8"))
+        packet = payload.pack([(3, binascii.unhexlify(packed)), (9, b"\x01\x02")])
+        msgs = codec.decode_all(1, str(binascii.hexlify(packet), "utf8"))
+        text = str(binascii.hexlify(b"Need water and food, please"), "utf8")
+        self.assertEqual(msgs, [(3, text), (9, "0102")])
+        self.assertEqual(codec.decode_all(1, "0102"), [(1, "0102")])
+        # Truncated aggregates are passed through rather than lost.
+        self.assertEqual(codec.decode_all(1, "b702010005aa"), [(1, "b702010005aa")])
+
+    def test_reassembly_bounds(self):
+        r = payload.Reassembly(max_bytes=300, timeout_ms=50)
+        frags = [payload.fragment(bytes(400), 1, i, 192) for i in range(3)]
+        self.assertEqual(r.add(1, frags[0]), None)
+        self.assertEqual(r.add(1, frags[0]), None)
+        # Full, the group can't complete.
+        self.assertEqual(r.add(1, frags[1]), None)
+        self.assertEqual((len(r), r.errors), (0, 1))
+        r.max_bytes = 1000
+        r.add(1, frags[0])
+        time.sleep(0.1)
+        r.add(2, frags[1])
+        self.assertEqual((len(r), r.expired), (1, 1))
+        self.assertEqual(r.add(2, frags[0]), None)
+        self.assertEqual(r.add(2, frags[2]), bytes(400))
+        self.assertEqual((len(r), r.completed), (0, 1))
+
+    def test_oversized_msgs(self):
+        # Nothing past MAX_MSG could be framed for the phone.
+        r = payload.Reassembly()
+        frags = [payload.fragment(bytes(1200), 1, i, 192) for i in range(7)]
+        self.assertEqual([r.add(1, f) for f in frags[:6]], [None] * 6)
+        self.assertEqual((len(r), r.errors), (0, 1))
+        bomb = payload.compress(bytes(5000))
+        self.assertRaises(ValueError, payload.decompress, bomb, payload.MAX_MSG)
+        packed = str(binascii.hexlify(bytes((payload.MAGIC, payload.KIND_DICT)) + bomb), "utf8")
+        self.assertEqual(payload.PayloadCodec().decode(1, packed), packed)
+
+
+class LogTest(unittest.TestCase):
+
+    def setUp(self):
+        # Nothing drains the ring in tests.
+        log.flush()
+
+    def tearDown(self):
+        log.flush()
+        log.set_sink(print)
+        log.set_level("*", log.INFO)
+
+    def test_levels_and_ring(self):
+        lines = []
+        log.set_sink(lines.append)
+        a = log.logger("a")
+        b = log.logger("b")
+        log.set_level("b", log.DEBUG)
+        a.debug("dropped %s", 1)
+        b.debug("kept %s %s", 1, None)
+        a.error("plain 100%")
+        a.warn("%s", [1, 2])
+        self.assertEqual(len(log._ring), 3)
+        log.flush()
+        self.assertEqual(lines, ["D b: kept 1 None", "E a: plain 100%", "W a: [1, 2]"])
+        self.assertEqual(log.logger("c").level, log.INFO)
+        log.set_level("*", log.OFF)
+        b.error("off")
+        self.assertEqual(len(log._ring), 0)
+
+    def test_full_ring_drops(self):
+        lines = []
+        log.set_sink(lines.append)
+        a = log.logger("a")
+        before = log.dropped()
+        for i in range(log._ring.slots + 5):
+            a.info("n %d", i)
+        self.assertEqual(log.dropped() - before, 5)
+        log.flush()
+        self.assertEqual(len(lines), log._ring.slots)
+        self.assertEqual(lines[-1], f"I a: n {log._ring.slots - 1}")
+
+
+class FakeRTC():
     def __init__(self):
-        self.hanlder = None
-        self.services = None
-        self.name = None
-        self._active = None
+        self.data = b""
+
+    def memory(self, data=None):
+        if data is None:
+            return self.data
+        self.data = bytes(data)
+
+
+class MetricsTest(unittest.TestCase):
+
+    def tearDown(self):
+        metrics.reset()
+
+    def test_snapshot(self):
+        c = metrics.counter("test.count")
+        self.assertEqual(metrics.counter("test.count"), c)
+        h = metrics.histogram("test.ms")
+        metrics.inc(c)
+        metrics.inc(c, 2)
+        for v in [0, 3, 20, 100000]:
+            metrics.observe(h, v)
+        snap = metrics.snapshot()
+        self.assertIn("test.count=3", snap)
+        self.assertIn("test.ms=4/100023/100000/1,1,0,1,0,0,0,1", snap)
+
+    def test_headroom(self):
+        # Every module (and these tests) has registered its metrics by now, a new module
+        # shouldn't fail at import for want of a slot.
+        counters, gauges, histograms = metrics.headroom()
+        self.assertTrue(counters >= 16)
+        self.assertTrue(gauges >= 8)
+        self.assertTrue(histograms >= 4)
+
+    def test_rtc_persists_counters(self):
+        rtc = FakeRTC()
+        c = metrics.counter("test.count")
+        metrics.inc(c, 5)
+        metrics.save(rtc)
+        metrics.reset()
+        metrics.inc(c)
+        self.assertTrue(metrics.restore(rtc))
+        self.assertEqual(metrics.value("test.count"), 6)
+        # Different metrics, ignore what's saved.
+        metrics.counter("test.other")
+        self.assertFalse(metrics.restore(rtc))
+        self.assertFalse(metrics.restore(FakeRTC()))
+
+    def test_timed_lock(self):
+        wait = metrics.histogram("test.wait")
+        hold = metrics.histogram("test.hold")
+        lock = metrics.TimedLock(wait, hold)
+
+        async def use():
+            async with lock:
+                await uasyncio.sleep_ms(20)
+
+        async def both():
+            await uasyncio.gather(use(), use())
+
+        uasyncio.run(both())
+        self.assertFalse(lock.locked())
+        snap = metrics.snapshot().split()
+        self.assertIn("test.hold=2/", [p[:len("test.hold=2/")] for p in snap])
+        wait_max = [p for p in snap if p.startswith("test.wait=")][0].split("/")[2]
+        self.assertTrue(int(wait_max) >= 15)
+
+
+class FakeFreq():
+    """Stands in for machine.freq, only accepts clocks in supported."""
+
+    def __init__(self, supported, freq):
+        self.supported = supported
+        self.freq = freq
+        self.calls = []
+
+    def __call__(self, f=None):
+        if f is None:
+            return self.freq
+        if f not in self.supported:
+            raise ValueError("frequency must be 80MHz or 160MHz")
+        self.calls.append(f)
+        self.freq = f
+
+
+class GovernorTest(unittest.TestCase):
+
+    def tearDown(self):
+        governor.install(None)
+
+    def test_probe(self):
+        freq = FakeFreq((20000000, 40000000, 80000000, 160000000), 160000000)
+        self.assertEqual(governor.probe(freq), [80000000, 160000000])
+        self.assertEqual(freq.freq, 160000000)
+
+    def test_boost_and_idle(self):
+        freq = FakeFreq((80000000, 160000000), 160000000)
+        g = governor.install(governor.Governor(freq, [80000000, 160000000], idle_ms=50))
+
+        async def run():
+            task = uasyncio.create_task(g.run())
+            await uasyncio.sleep_ms(80)
+            self.assertEqual(freq.freq, 80000000)
+            # A burst of work boosts once, not on every signal.
+            for _ in range(5):
+                governor.busy()
+                await uasyncio.sleep_ms(10)
+            self.assertEqual(freq.freq, 160000000)
+            self.assertEqual(g.boosts, 1)
+            await uasyncio.sleep_ms(80)
+            self.assertEqual(freq.freq, 80000000)
+            task.cancel()
+
+        uasyncio.run(run())
+        self.assertEqual(freq.calls, [80000000, 160000000, 80000000])
+        self.assertIn("80MHz=", g.report())
+        self.assertTrue(g.time_ms[80000000] >= 50)
+        self.assertTrue(g.time_ms[160000000] >= 50)
+
+
+class PowerTest(unittest.TestCase):
+
+    def test_doze_waits_for_slow_advertising(self):
+        adv = advertising.Advertiser(FakeBLE(), b"", b"")
+        slept = []
+        p = PowerManager(None, lambda: True, latency_ms=10, lightsleep=slept.append,
+                         awake_ms=1, advertiser=adv)
+        # Fast advertising right after a disconnect, a light sleep would pause it.
+        adv.start()
+        uasyncio.run(p._doze())
+        self.assertEqual(slept, [])
+        adv._set_stage(len(adv.stages) - 1)
+        uasyncio.run(p._doze())
+        self.assertEqual(slept, [10])
+
+    def test_sleep_cycle(self):
+        sim = M138Sim(speedup=1000, boot_time=0, boot_sequence=("$M138 BOOT,RUNNING",))
+        delivered = []
+        s = Satellite(1, myconn=sim, delay=0, expect_timeout=0.5,
+                      client_ready=uasyncio.ThreadSafeFlag(),
+                      new_msg_callback=lambda app_id, data: delivered.append(data))
+        connected = [False]
+        slept = []
+        p = PowerManager(s, lambda: not connected[0], rx_pin=sim.rx_indicator, listen_s=1,
+                         modem_sleep_s=100, latency_ms=10, lightsleep=slept.append,
+                         awake_ms=1)
 
-    def irq(self, handler):
-        self.hanlder = handler
+        async def run():
+            s.start()
+            task = uasyncio.create_task(p.run())
+            while sim.gpio_mode != 6:
+                await uasyncio.sleep_ms(5)
+            # A msg waiting raises the pin, which wakes us to drain it.
+            sim.deliver(1, "0102")
+            # The wake is counted once the drain (which delivers first) finishes.
+            while p.wakes == 0:
+                await uasyncio.sleep_ms(5)
+            self.assertEqual(p.wakes, 1)
+            self.assertEqual(delivered, ["0102"])
+            # Nothing else arrives, so after listening the modem sleeps until its timer.
+            while sim.stats["sleeps"] == 0 or s.awake:
+                await uasyncio.sleep_ms(5)
+            self.assertFalse(s.awake)
+            self.assertFalse(s.is_ready())
+            while p.wakes < 2:
+                await uasyncio.sleep_ms(5)
+            self.assertTrue(s.awake)
+            self.assertEqual(s.wake_reason, "TIME")
+            # A phone connecting wakes the modem straight away.
+            while sim.stats["sleeps"] < 2:
+                await uasyncio.sleep_ms(5)
+            connected[0] = True
+            while p.wakes < 3:
+                await uasyncio.sleep_ms(5)
+            self.assertTrue(s.awake)
+            self.assertEqual(s.wake_reason, "SERIAL")
+            task.cancel()
+            s.satelite_task.cancel()
 
-    def gatts_register_services(self, services):
-        self.services = services
-        return ((None, None), None)
+        uasyncio.run(run())
+        self.assertEqual(delivered, ["0102"])
+        self.assertTrue(len(slept) > 0)
+        self.assertEqual(slept[0], 10)
 
-    def gatts_notify(self, conn_handle, value_handle, data):
-        return
 
-    def gap_advertise(self, interval, param, resp_data=None):
-        return
+class PassPredictorTest(unittest.TestCase):
 
-    def active(self, act):
-        self._active = act
+    def setUp(self):
+        self.path = "passes_test"
+        if self.path in os.listdir():
+            os.remove(self.path)
 
-    def config(self, gap_name=None):
-        self.name = gap_name
+    def tearDown(self):
+        self.setUp()
 
-    def gatts_set_buffer(self, handle, rxbuf, b):
-        return
+    def test_predicts_windows(self):
+        self.assertEqual(seconds_of_day("20230102030405"), 3 * 3600 + 4 * 60 + 5)
+        self.assertEqual(seconds_of_day("2023-01-02 03:04:05"), 3 * 3600 + 4 * 60 + 5)
+        self.assertEqual(seconds_of_day("bad"), None)
+        p = PassPredictor(self.path)
+        p.heard("2023-01-01 10:05:00")
+        # No clock or history yet, so no prediction and every time is fine.
+        self.assertEqual(p.next_window(), None)
+        self.assertTrue(p.in_window())
+        p.set_time("20230102080000")
+        self.assertEqual(p.next_window(), None)
+        # The same pass heard again the next day, a repeat of one ts doesn't count.
+        p.heard("2023-01-02 10:10:00")
+        p.heard("2023-01-02 10:10:00")
+        self.assertEqual(p.heard_count, 2)
+        start, length = p.next_window()
+        self.assertTrue(2 * 3600 - 5 <= start <= 2 * 3600)
+        self.assertEqual(length, 900)
+        self.assertFalse(p.in_window())
+        p.set_time("20230103101200")
+        self.assertEqual(p.next_window()[0], 0)
+        self.assertTrue(p.in_window())
+        p.save()
+        self.assertEqual(PassPredictor(self.path).scores, p.scores)
+
+    def test_power_follows_windows(self):
+        p = PassPredictor(self.path)
+        p.set_time("20230102080000")
+        p.heard("2023-01-01 10:05:00")
+        p.heard("2023-01-02 10:10:00")
+        pm = PowerManager(None, lambda: True, passes=p)
+        listen_s, sleep_s = pm.plan()
+        self.assertEqual(listen_s, 0)
+        self.assertEqual(sleep_s, 3600)
+        pm.plan()
+        pm.plan()
+        # Every few cycles the plain cycle runs so new passes get heard.
+        self.assertEqual(pm.plan(), (pm.listen_s, pm.modem_sleep_s))
+        p.set_time("20230103100100")
+        self.assertEqual(pm.plan(), (14 * 60, 0))
+
+
+class ConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = "config_test"
+        for path in (self.path, self.path + ".tmp", "phone_id_test"):
+            if path in os.listdir():
+                os.remove(path)
+
+    def tearDown(self):
+        self.setUp()
+
+    def test_debounced_atomic_saves(self):
+        with open("phone_id_test", "w") as f:
+            f.write("phone1\n")
+
+        async def run():
+            c = Config(self.path, delay_ms=50)
+            c.migrate("phone_id", "phone_id_test")
+            self.assertFalse("phone_id_test" in os.listdir())
+            self.assertEqual(c.saves, 1)
+            task = uasyncio.create_task(c.run())
+            c.set("device_id", "0x000e57")
+            c.set("power.listen_s", 60)
+            c.set("power.listen_s", 60)
+            self.assertEqual(c.get("device_id"), "0x000e57")
+            await uasyncio.sleep_ms(100)
+            # Both sets in one write.
+            self.assertEqual(c.saves, 2)
+            task.cancel()
+
+        uasyncio.run(run())
+        self.assertFalse(self.path + ".tmp" in os.listdir())
+        c = Config(self.path)
+        self.assertEqual(c.get("phone_id"), "phone1")
+        self.assertEqual(c.get("power.listen_s"), 60)
+        self.assertEqual(c.get("missing", 5), 5)
+        # Left over from a reset after removing the old file.
+        os.rename(self.path, self.path + ".tmp")
+        self.assertEqual(Config(self.path).get("device_id"), "0x000e57")
+
+
+class FirmwareTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = "fw_test"
+        for path in (self.path, "fw_config_test", "fw_config_test.tmp"):
+            if path in os.listdir():
+                os.remove(path)
+
+    def tearDown(self):
+        self.setUp()
+
+    def test_resumable_upload(self):
+        image = bytes(range(256)) * 5
+        sha = binascii.hexlify(hashlib.sha256(image).digest()).decode()
+        config = Config("fw_config_test")
+        f = FirmwareStore(config, self.path)
+        self.assertEqual(f.begin(len(image), sha, "2022-01-01T00:00:00,v1.2.0"), 0)
+        self.assertEqual(f.write(0, image[:500]), 500)
+        # Repeats / out of order chunks are told where to carry on from.
+        self.assertEqual(f.write(0, image[:500]), 500)
+        self.assertEqual(f.write(700, image[700:800]), 500)
+        # A BLE drop, then a reset, resumes from what's on flash.
+        self.assertEqual(f.begin(len(image), sha, "2022-01-01T00:00:00,v1.2.0"), 500)
+        f.write(500, image[500:800])
+        config.flush()
+        f = FirmwareStore(Config("fw_config_test"), self.path)
+        self.assertEqual(f.begin(len(image), sha, "2022-01-01T00:00:00,v1.2.0"), 800)
+        self.assertEqual(f.write(800, image[800:]), len(image))
+        self.assertTrue(f.verified)
+        with open(self.path, "rb") as fw:
+            self.assertEqual(fw.read(), image)
+        self.assertTrue(firmware.is_newer("2022-01-01T00:00:00,v1.2.0",
+                                          "2021-07-16T00:28:00,v1.1.0"))
+        self.assertFalse(firmware.is_newer("2021-07-16T00:28:00,v1.1.0",
+                                           "2021-07-16T00:28:00,v1.1.0"))
+        # A corrupt image is thrown away.
+        f.begin(4, sha, "2022-01-02T00:00:00,v1.2.1")
+        f.write(0, b"abcd")
+        self.assertFalse(f.verified)
+        self.assertFalse(self.path in os.listdir())
+
+
+class _Chunks():
+    """Stream handing out chunks as readinto would."""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    async def readinto(self, buf):
+        if len(self.chunks) == 0:
+            return 0
+        chunk = self.chunks.pop(0)
+        buf[:len(chunk)] = chunk
+        return len(chunk)
+
+
+class SerialBridgeTest(unittest.TestCase):
+
+    def test_matches_split_frames(self):
+        b = SerialBridge(None, max_frame=32)
+        # Noise, a near miss of the start magic and frames split at awkward places.
+        for chunk in (b">>> MOMOD", b"EM$CS*10TIMBITLOVE", b"SYOUxMODEM$FV\n$MM C=UTIMB",
+                      b"ITLOVESYOU", b"MODEM" + b"x" * 40 + b"TIMBITLOVESYOU"):
+            b.feed(chunk)
+        self.assertEqual(b.ready, [b"$CS*10", b"$FV\n$MM C=U"])
+        self.assertEqual(b.overflows, 1)
+
+    def test_forwards_to_modem(self):
+        sim = M138Sim(boot_time=0, cmd_latency=0.001)
+        s = Satellite(1, myconn=sim, delay=0, client_ready=uasyncio.ThreadSafeFlag())
+        out = []
+
+        async def run():
+            s.start()
+            while s.reader_task is None:
+                await uasyncio.sleep_ms(1)
+            b = SerialBridge(s, _Chunks([b"MODEM$CS*10\n$F", b"VTIMBITLOVESYOU"]), out.append)
+            await b.run()
+            s.satelite_task.cancel()
+
+        uasyncio.run(run())
+        self.assertEqual(len(out), 2)
+        self.assertTrue(out[0].startswith("$CS DI=0x000e57"))
+        self.assertTrue(out[1].startswith("$FV "))
+
+    def test_leaves_unsolicited_lines(self):
+        acked = []
+        conn = FakeUART(lines=[
+            nmea("$TD SENT RSSI=-98,SNR=1,FDEV=2,5"),
+            nmea("$TD OK,6")], verbose=False)
+        s = Satellite(1, myconn=conn, msg_acked_callback=acked.append)
+        out = []
+        b = SerialBridge(s, _Chunks([b"MODEM$TD AI=3,aabbTIMBITLOVESYOU"]), out.append)
+        uasyncio.run(b.run())
+        # The ack still reaches the Satellite, the bench gets the command's own reply.
+        self.assertEqual(acked, ["5"])
+        self.assertEqual(out, ["$TD OK,6"])
+
+
+class ModemSimTest(unittest.TestCase):
+
+    def _read(self, sim, n):
+        async def read():
+            return [str(await sim.readline(), "utf8").split("*")[0] for _ in range(n)]
+
+        return uasyncio.run(read())
+
+    def test_commands(self):
+        sim = M138Sim(speedup=3600, sent_delay=60, boot_sequence=("$M138 BOOT,RUNNING",))
+        self.assertEqual(self._read(sim, 1), ["$M138 BOOT,RUNNING"])
+        sim.deliver(7, "0102")
+        sim.write(nmea("$MM C=U"))
+        sim.write(nmea("$MM R=O"))
+        sim.write(nmea("$MM D=R"))
+        sim.write(nmea("$TD AI=3,aabb"))
+        sim.write("$TD AI=3,aabb*00\n")
+        lines = self._read(sim, 5)
+        self.assertEqual(lines[0], "$MM 1")
+        self.assertTrue(lines[1].startswith("$MM AI=7,0102,ID=5354468575000,RT=16725312"))
+        self.assertEqual(lines[2], "$MM DELETED,1")
+        self.assertEqual(lines[3:], ["$TD OK,5354468575001", "$TD ERR,BADCHECKSUM"])
+        # The ack comes after the simulated pass, along with the GPS fix.
+        lines = self._read(sim, 3)
+        self.assertEqual(sorted(lines)[0], "$M138 DATETIME")
+        self.assertTrue(sorted(lines)[2].startswith("$TD SENT "))
+        self.assertTrue(sorted(lines)[2].endswith(",5354468575001"))
+
+    def test_interleaved_mm_commands(self):
+        sim = M138Sim(boot_time=0, cmd_latency=0.001)
+        s = Satellite(1, myconn=sim, delay=0, client_ready=uasyncio.ThreadSafeFlag())
+        sim.deliver(7, "0102")
+        sim.deliver(7, "0304")
+
+        async def run():
+            s.start()
+            while s.reader_task is None:
+                await uasyncio.sleep_ms(1)
+            # Each reply goes to its own command, not the first $MM waiter.
+            got = await uasyncio.gather(s._enable_msg_watch(), s.check_for_msgs(),
+                                        s.del_read_msgs(), s.read_msg("O"),
+                                        s.del_msg("1"), s.check_for_msgs())
+            s.satelite_task.cancel()
+            return got
+
+        _, count, deleted, msg, _, unread = uasyncio.run(run())
+        self.assertEqual(count, 2)
+        self.assertTrue(deleted)
+        self.assertEqual(msg[:2], (7, "0102"))
+        self.assertEqual(unread, 1)
+
+    def test_msg_before_watch_not_lost(self):
+        class LateSim(M138Sim):
+            def _cmd_MM(self, args):
+                # Arrives after the drain, just before watch comes on so it isn't pushed.
+                if args == "N=E":
+                    self.deliver(7, "0506")
+                super()._cmd_MM(args)
+
+        sim = LateSim(boot_time=0, cmd_latency=0.001)
+        got = []
+        s = Satellite(1, myconn=sim, delay=0, client_ready=uasyncio.ThreadSafeFlag(),
+                      new_msg_callback=lambda app_id, data: got.append((app_id, data)))
+
+        async def run():
+            s.start()
+            s.client_ready.set()
+            while not s.msg_watch:
+                await uasyncio.sleep_ms(1)
+            await uasyncio.sleep_ms(50)
+            await s.clear_delivered()
+            s.satelite_task.cancel()
+            s.client_task.cancel()
+
+        uasyncio.run(run())
+        self.assertEqual(got, [(7, "0506")])
+        self.assertEqual(sim.inbox, [])
+
+    def test_fast_boot(self):
+        sim = M138Sim(boot_time=0, cmd_latency=0.001)
+        s = Satellite(1, myconn=sim, delay=0, client_ready=uasyncio.ThreadSafeFlag())
+
+        async def boot():
+            start = time.ticks_ms()
+            s.start()
+            while s.reader_task is None:
+                await uasyncio.sleep_ms(1)
+            self.assertEqual(await s.device_id(), "0x000e57")
+            self.assertEqual(s.firmware_version, "2021-07-16T00:28:00,v1.1.0")
+            s.satelite_task.cancel()
+            return time.ticks_diff(time.ticks_ms(), start)
+
+        # Boot lines and the first device id query aren't padded out with sleeps.
+        self.assertTrue(uasyncio.run(boot()) < 500)
+        self.assertTrue(metrics.value("sat.boot_ms") > 0)
+
+    def test_soak(self):
+        log.set_level("*", log.OFF)
+        try:
+            report = uasyncio.run(modem_sim.soak(
+                2, msgs_per_hour=30, boot_sequence=("$M138 BOOT,RUNNING",)))
+            self.assertTrue(report["arrived"] > 0)
+            self.assertEqual(report["delivered"], report["arrived"])
+            self.assertTrue(report["acked"] > 0)
+            self.assertEqual(report["bad_commands"], 0)
+            # Mangled lines are dropped by the validator without upsetting the rest.
+            report = uasyncio.run(modem_sim.soak(
+                2, msgs_per_hour=30, garble_rate=0.2, drop_rate=0.05,
+                boot_sequence=("$M138 BOOT,RUNNING",)))
+            self.assertTrue(report["garbled"] > 0)
+            self.assertTrue(report["delivered"] > 0)
+        finally:
+            log.set_level("*", log.INFO)
+
+
+class BenchTest(unittest.TestCase):
+
+    def test_compare(self):
+        baseline = bench.format_results([("a", 1000, "ops/s", 10), ("b", 1000, "ops/s", None)])
+        self.assertEqual(bench.parse_results(baseline),
+                         (sys.implementation.name, {"a": (1000, 10), "b": (1000, None)}))
+        self.assertEqual(bench.compare([("a", 900, "ops/s", 10), ("b", 10, "ops/s", 5)],
+                                       baseline, 25),
+                         ["b 10 ops/s vs baseline 1000"])
+        self.assertEqual(len(bench.compare([("a", 900, "ops/s", 11)], baseline, 25)), 1)
+        # Rates from another implementation aren't comparable, allocations are.
+        other = baseline.replace(sys.implementation.name, "other")
+        self.assertEqual(bench.compare([("b", 10, "ops/s", None)], other, 25), [])
+
+    def test_missing_baseline_fails(self):
+        log.set_level("*", log.OFF)
+        try:
+            self.assertEqual(bench.main(["--baseline", "no_such_baseline"]), 1)
+        finally:
+            log.set_level("*", log.INFO)
+
+    def test_alloc_per_op_excludes_setup(self):
+        class FakeGC():
+            allocated = 0
+
+            def collect(self):
+                pass
+
+            def disable(self):
+                pass
+
+            def enable(self):
+                pass
+
+            def mem_alloc(self):
+                return self.allocated
+
+        fake = FakeGC()
+
+        def setup():
+            fake.allocated += 1000
+
+            async def run(n):
+                fake.allocated += 8 * n
+                return n
+            return run
+
+        real = bench.gc
+        bench.gc = fake
+        try:
+            self.assertEqual(bench._alloc_per_op(setup), 8)
+        finally:
+            bench.gc = real
+
+    def test_benches_run(self):
+        for name, n, unit, setup in bench.BENCHES:
+            self.assertTrue(uasyncio.run(setup()(1)) > 0, name)
+
+
+class DisplayTest(unittest.TestCase):
+
+    def test_coalesces_and_sends_dirty_pages(self):
+        d = FakeDisplay()
+
+        async def run():
+            w = DisplayWrapper(d)
+            w.write("Connected!")
+            w.write("Sending msg to modem")
+            await uasyncio.sleep_ms(100)
+            # Only the last write is drawn, wrapped over rows 1 and 2.
+            self.assertEqual(d.text_calls, [("Sending msg to m", 8), ("odem", 16)])
+            self.assertEqual(d.cmds[-2:], [1, 2])
+            self.assertEqual(d.sent, [2 * 128])
+            self.assertEqual(w.coalesced, 1)
+            # A counter on the status line only sends its page.
+            w.status(1, "Q 3")
+            await uasyncio.sleep_ms(100)
+            self.assertEqual(d.text_calls[-1], ("        Q 3", 0))
+            self.assertEqual(d.sent[-1], 128)
+            # Nothing changed, nothing sent.
+            w.status(1, "Q 3")
+            await uasyncio.sleep_ms(100)
+            self.assertEqual(len(d.sent), 2)
+            self.assertEqual(w.renders, 2)
+            w.task.cancel()
+
+        uasyncio.run(run())
+
+
+class AdvertisingTest(unittest.TestCase):
+
+    def test_payloads_fit(self):
+        adv, resp = advertising.payloads("SpaceBeaver (PCFL LLC)", (), 5184)
+        self.assertEqual(adv, bytes([2, 1, 6, 3, 0x19, 0x40, 0x14]))
+        self.assertEqual(resp, bytes([23, 9]) + b"SpaceBeaver (PCFL LLC)")
+        # Too long names are shortened to fit.
+        adv, resp = advertising.payloads("x" * 40)
+        self.assertEqual(len(resp), 31)
+        self.assertEqual(resp[1], 8)
+
+    def test_backs_off_and_boosts(self):
+        f = FakeBLE()
+
+        async def run():
+            a = advertising.Advertiser(f, b"adv", b"resp", ((20000, 30), (152500, 30),
+                                                            (1022500, None)))
+            task = uasyncio.create_task(a.run())
+            a.start()
+            await uasyncio.sleep_ms(100)
+            self.assertEqual([c[0] for c in f.advertised], [20000, 152500, 1022500])
+            self.assertEqual(f.advertised[0][1:], (b"adv", b"resp"))
+            a.boost()
+            await uasyncio.sleep_ms(10)
+            self.assertEqual(f.advertised[-1][0], 20000)
+            a.stop()
+            await uasyncio.sleep_ms(100)
+            # Connected, so no more backing off (or boosts).
+            a.boost()
+            self.assertEqual(len(f.advertised), 4)
+            self.assertGreater(a.events, 0)
+            self.assertGreater(a.adv_ms, 0)
+            task.cancel()
+
+        uasyncio.run(run())
+
+    def test_uart_advertises_on_disconnect(self):
+        f = FakeBLE()
+        b = UARTBluetooth("test", ble=f, client_ready_callback=lambda flag: None)
+        self.assertEqual(f.advertised[-1][0], 20000)
+        f.advertised = []
+        b.ble_irq(1, (1, 0, None))
+        b.ble_irq(2, None)
+        self.assertEqual([c[0] for c in f.advertised], [20000])
+        b.adv_task.cancel()
 
 
 class UARTSmokeTest(unittest.TestCase):
@@ -144,3 +1317,173 @@ class UARTSmokeTest(unittest.TestCase):
             print(e)
             raise e
         print(f"Created {b}")
+
+    def _flush(self, b):
+        async def drain():
+            while b._tx_in != b._tx_out or len(b.ble.notified) == 0:
+                await uasyncio.sleep_ms(1)
+            await uasyncio.sleep_ms(1)
+
+        uasyncio.run(drain())
+
+    def test_send_chunks_by_mtu(self):
+        f = FakeBLE()
+        b = UARTBluetooth("test", ble=f)
+        b.connected = True
+        b.mtu = 13
+        b.send("0123456789ABCDEFGHIJK")
+        self._flush(b)
+        self.assertEqual(f.notified, [
+            (21).to_bytes(4, "little"), b"0123456789", b"ABCDEFGHIJ", b"K"])
+        self.assertEqual(b.tx_bytes, 25)
+
+    def test_send_retries_when_full(self):
+        f = FakeBLE()
+        b = UARTBluetooth("test", ble=f)
+        b.connected = True
+        f.fail_notifies = 3
+        b.send(b"hi")
+        self._flush(b)
+        self.assertEqual(f.notified, [(2).to_bytes(4, "little"), b"hi"])
+        self.assertEqual(b.notify_failures, 3)
+
+    def test_bounded_tx_ring(self):
+        f = FakeBLE()
+        b = UARTBluetooth("test", ble=f)
+        b.connected = True
+        b.mtu = 203
+        # Fill the ring, the next frame doesn't fit and is dropped, not queued.
+        self.assertTrue(b.send(b"a" * 1500))
+        self.assertFalse(b.send(b"b" * 600))
+        self.assertEqual(b.tx_dropped, 1)
+        self._flush(b)
+        # Frames wrapping around the end of the ring arrive intact.
+        f.notified = []
+        self.assertTrue(b.send(b"c" * 1000))
+        self._flush(b)
+        self.assertEqual(f.notified[0], (1000).to_bytes(4, "little"))
+        self.assertEqual(b"".join(f.notified[1:]), b"c" * 1000)
+
+    def test_resyncs_after_partial_frame(self):
+        class FailingBLE(FakeBLE):
+            def gatts_notify(self, conn_handle, value_handle, data):
+                # The length goes out, then the controller stays out of buffers.
+                if len(self.notified) > 0 and self.disconnects == 0:
+                    raise OSError(12)
+                self.notified.append(bytes(data))
+
+        f = FailingBLE()
+        b = UARTBluetooth("test", ble=f)
+        b.connected = True
+        b.send(b"lost")
+        b.send(b"also lost")
+
+        async def wait():
+            while f.disconnects == 0:
+                await uasyncio.sleep_ms(10)
+
+        uasyncio.run(wait())
+        # Everything queued went with the connection, later frames start in sync.
+        self.assertEqual(b._tx_in, b._tx_out)
+        f.notified = []
+        b.send(b"ok")
+        self._flush(b)
+        self.assertEqual(f.notified, [(2).to_bytes(4, "little"), b"ok"])
+
+    def test_send_during_notify_retry(self):
+        f = FakeBLE()
+        b = UARTBluetooth("test", ble=f)
+        b.connected = True
+        f.fail_notifies = 2
+        b.send(b"0123456789")
+
+        async def run():
+            # The length notify is backing off when another (longer) msg is queued.
+            while f.fail_notifies > 0:
+                await uasyncio.sleep_ms(1)
+            b.send(b"x" * 300)
+            while b._tx_in != b._tx_out:
+                await uasyncio.sleep_ms(1)
+
+        uasyncio.run(run())
+        self.assertEqual(f.notified[0], (10).to_bytes(4, "little"))
+        self.assertEqual(f.notified[1], b"0123456789")
+        self.assertEqual(f.notified[2], (300).to_bytes(4, "little"))
+
+    def test_write_firmware_unsupported(self):
+        f = FakeBLE()
+        b = UARTBluetooth("test", ble=f)
+        b.connected = True
+        f.writes = [_frame(b"W")]
+        b.ble_irq(3, None)
+        self._flush(b)
+        self.assertEqual(b"".join(f.notified[1:]), b"ERROR: firmware update not supported")
+
+    def test_stats_command(self):
+        f = FakeBLE()
+        b = UARTBluetooth("test", ble=f)
+        b.connected = True
+        f.writes = [_frame(b"S")]
+        b.ble_irq(3, None)
+        self._flush(b)
+        reply = b"".join(f.notified[1:])
+        self.assertTrue(reply.startswith(b"STATS "))
+        self.assertIn(b"ble.rx_frames=", reply)
+
+    def test_back_to_back_writes(self):
+        f = FakeBLE()
+        got = []
+
+        async def set_phone_id(phone_id):
+            got.append(phone_id)
+
+        b = UARTBluetooth("test", ble=f, set_phone_id=set_phone_id)
+        data = _frame(b"P  phone-1 ") + _frame(b"Pphone-2")
+        f.writes = [data[:3], data[3:12], data[12:]]
+
+        async def writes():
+            for _ in range(3):
+                b.ble_irq(3, None)
+            await uasyncio.sleep_ms(1)
+
+        uasyncio.run(writes())
+        self.assertEqual(got, ["phone-1", "phone-2"])
+
+    def test_binary_pipelined(self):
+        f = FakeBLE()
+        queued = []
+
+        async def msg_callback(app_id, msg, raw=False):
+            queued.append((app_id, msg, raw))
+            return (len(queued), len(queued))
+
+        async def get_device_id():
+            return "0x1234"
+
+        b = UARTBluetooth("test", ble=f, msg_callback=msg_callback,
+                          get_device_id=get_device_id)
+        b.connected = True
+        data = (_frame(b"B") +
+                _frame(binproto.encode(binproto.OP_SEND_MSG, 7, 300, b"\x01\xff")) +
+                _frame(binproto.encode(binproto.OP_GET_DEVICE_ID, 8)))
+        f.writes = [data]
+
+        async def run():
+            b.ble_irq(3, None)
+            await uasyncio.sleep_ms(5)
+            b.send_msg_id(1, "5354468575916")
+            b.send_msg(300, "CAFE", 4)
+            await uasyncio.sleep_ms(5)
+
+        uasyncio.run(run())
+        self.assertEqual(queued, [(300, "01ff", True)])
+        frames = [x for x in f.notified if len(x) != 4 or x == b"BIN 1"]
+        self.assertEqual(frames[0], b"BIN 1")
+        replies = [binproto.decode(memoryview(x)) for x in frames[1:]]
+        ops = [(op, req_id) for op, req_id, _, _ in replies]
+        self.assertEqual(ops, [(binproto.OP_QUEUED, 7), (binproto.OP_DEVICE_ID, 8),
+                               (binproto.OP_MSGID, 7), (binproto.OP_MSG, 0)])
+        self.assertEqual(struct.unpack("<IH", replies[0][3]), (1, 1))
+        self.assertEqual(bytes(replies[1][3]), b"0x1234")
+        self.assertEqual(struct.unpack("<Q", replies[2][3])[0], 5354468575916)
+        self.assertEqual(bytes(replies[3][3]), b"\x04\x00\x00\x00\xca\xfe")
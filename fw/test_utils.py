@@ -1,6 +1,17 @@
+from nmea import checksum
+
+
+def nmea(body: str) -> str:
+    """Frame body as the modem would, with the checksum and trailing newline."""
+    data = body.encode()
+    return "%s*%02X\n" % (body, checksum(data, 0, len(data)))
+
+
 class FakeUART():
-    def __init__(self, lines=None):
-        print(f"Making fake uart with lines {lines}")
+    def __init__(self, lines=None, verbose=True):
+        self.verbose = verbose
+        if verbose:
+            print(f"Making fake uart with lines {lines}")
         self.baudrate = None
         self.tx = None
         self.rx = None
@@ -17,14 +28,19 @@ class FakeUART():
 
     async def readline(self):
         line = self.lines.pop(0)
-        print(f"Serving fake line {line}")
+        if self.verbose:
+            print(f"Serving fake line {line}")
         return line
 
     def len(self):
         return len(self.lines)
 
     def write(self, cmd):
-        print(f"Sendig fake line {cmd}")
+        # Writers may hand us a view into a reused buffer so take a copy.
+        if not isinstance(cmd, str):
+            cmd = str(bytes(cmd), "utf8")
+        if self.verbose:
+            print(f"Sendig fake line {cmd}")
         self.sent_lines.append(cmd)
 
     async def drain(self, *args):
@@ -32,3 +48,73 @@ class FakeUART():
 
     async def flush(self):
         return True
+
+
+class FakeBLE():
+    def __init__(self):
+        self.hanlder = None
+        self.services = None
+        self.name = None
+        self._active = None
+        self.notified = []
+        self.fail_notifies = 0
+        self.writes = []
+        self.advertised = []
+        self.disconnects = 0
+
+    def gatts_read(self, handle):
+        return self.writes.pop(0)
+
+    def irq(self, handler):
+        self.hanlder = handler
+
+    def gatts_register_services(self, services):
+        self.services = services
+        return ((None, None), None)
+
+    def gatts_notify(self, conn_handle, value_handle, data):
+        if self.fail_notifies > 0:
+            self.fail_notifies -= 1
+            raise OSError(12)
+        self.notified.append(bytes(data))
+
+    def gap_advertise(self, interval, param, resp_data=None):
+        self.advertised.append((interval, param, resp_data))
+
+    def gap_disconnect(self, conn_handle):
+        self.disconnects += 1
+
+    def active(self, act):
+        self._active = act
+
+    def config(self, gap_name=None):
+        self.name = gap_name
+
+    def gatts_set_buffer(self, handle, rxbuf, b):
+        return
+
+
+class FakeDisplay():
+    """Records what an SSD1306 would draw and which pages get sent."""
+
+    def __init__(self, width=128, height=64):
+        self.buffer = bytearray(width * height // 8)
+        self.text_calls = []
+        self.cmds = []
+        self.sent = []
+        self.shows = 0
+
+    def fill_rect(self, x, y, w, h, c):
+        pass
+
+    def text(self, txt, x, y):
+        self.text_calls.append((txt, y))
+
+    def write_cmd(self, cmd):
+        self.cmds.append(cmd)
+
+    def write_data(self, buf):
+        self.sent.append(len(buf))
+
+    def show(self):
+        self.shows += 1